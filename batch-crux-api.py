@@ -1,575 +1,2145 @@
-import requests
 import json
-import pandas as pd
 import time
-from google.colab import files
+import sys
+import bisect
+import contextlib
+import contextvars
+import concurrent.futures
+import threading
+import collections
+import queue
+import itertools
+import zlib
+import xml.etree.ElementTree as ET
+import random
+import email.utils
+import os
+import gzip
+import hashlib
+import sqlite3
+import socket
+import datetime
 import re
+import fnmatch
+from urllib.parse import urlsplit, urlunsplit
 
 # Constants
 API_KEY = 'YOUR_API_KEY'  # Replace with your actual API key
 API_URL = 'https://chromeuxreport.googleapis.com/v1/records:queryRecord'
+HISTORY_API_URL = 'https://chromeuxreport.googleapis.com/v1/records:queryHistoryRecord'
+ARCHIVE_ENABLED = False  # Keep every raw response, so new columns can be re-extracted offline
+ARCHIVE_DIR = 'crux_archive'
+JOURNAL_ENABLED = True              # Write every result to a journal so interrupted runs can be resumed
+JOURNAL_PATH = 'crux_journal.jsonl'
 
-# Ask user how to collect URLs
-print("How would you like to collect URLs for analysis?")
-print("1. Fetch URLs from a website's sitemap")
-print("2. Upload a text file with URLs (one URL per line)")
-url_source_choice = input("Enter your choice (1 or 2): ")
+# URL canonicalization rules: variants of the same page are queried once and the result is
+# copied to every variant in the output (set CANONICALIZE_URLS = False to only drop exact duplicates)
+CANONICALIZE_URLS = True
+CANONICAL_RULES = {
+    'force_https': True,           # http:// and https:// variants are the same page
+    'lowercase_host': True,        # Host names are case-insensitive
+    'strip_default_port': True,    # :80 and :443
+    'strip_fragment': True,        # #section is never sent to the server
+    'strip_trailing_slash': True,  # /page/ and /page (the root path stays /)
+    'strip_query_params': ['utm_*', 'gclid', 'fbclid', 'msclkid', 'dclid', 'mc_cid', 'mc_eid', '_ga', '_gl'],
+}
 
-urls = []
-domain = None
+# Rate limiting constants
+RATE_LIMIT_QUERIES = 150  # CrUX API default quota is 150 queries per minute per project
+RATE_LIMIT_WINDOW = 60    # 60 seconds window
+RATE_LIMIT_BURST = 10     # Requests that may start back-to-back before the steady rate applies
+MAX_CONCURRENT_REQUESTS = 32  # Upper bound of requests in flight (the adaptive controller finds the level in use)
 
-if url_source_choice == '2':
-    # Upload file with URLs
-    print("\nPlease upload a text file containing URLs (one URL per line):")
-    uploaded = files.upload()
+# Retry constants
+MAX_RETRIES = 3           # Retries for a single query before giving up
+RETRY_BASE_DELAY = 2      # Backoff in seconds before the first retry, doubled on every attempt
+RETRY_MAX_DELAY = 60      # Upper bound for a single backoff
+RETRY_BUDGET_RATIO = 0.2  # Retries allowed for the whole run, as a share of the query count (at least 10)
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# Adaptive concurrency constants (AIMD): requests in flight grow by one per round of successful
+# requests while latency stays near its baseline, and are cut on overload responses and connection
+# errors; a 429 also lowers the request rate below RATE_LIMIT_QUERIES, which then grows back
+ADAPTIVE_CONCURRENCY = True  # False keeps MAX_CONCURRENT_REQUESTS in flight at the full rate
+INITIAL_CONCURRENCY = 4
+MIN_CONCURRENCY = 1
+AIMD_DECREASE = 0.5           # Factor applied to the limits after an overload signal
+AIMD_LATENCY_TOLERANCE = 2.0  # No increase while latency is above this multiple of its baseline
+MIN_RATE_SHARE = 0.1          # Lowest request rate, as a share of RATE_LIMIT_QUERIES
+OVERLOAD_STATUSES = (429, 502, 503, 504)  # Responses of an overloaded API or an exhausted quota
+
+# Distributed run constants: a run with a work queue pushes its tasks to the queue instead of
+# querying, and workers (--worker, on any number of processes and machines) lease and run them
+WORK_QUEUE_NAME = 'crux'         # Key prefix of the job in a Redis queue
+LEASE_TIMEOUT = 120             # Seconds a leased task stays with its worker without a renewal
+WORK_QUEUE_POLL_INTERVAL = 1     # Seconds between queue polls of the coordinator and of idle workers
+WORK_QUEUE_BATCH = 500           # Tasks pushed ahead of the results (and per transaction)
+
+# HTTP transport constants
+MAX_REQUESTS_PER_HOST = MAX_CONCURRENT_REQUESTS  # Concurrent requests allowed to a single host
+HTTP2_ENABLED = False  # Use HTTP/2 via httpx (needs: pip install "httpx[http2]")
+
+# Request metrics constants: per-request phase timings aggregated into histograms, written at the
+# end of the run and every METRICS_FLUSH_INTERVAL seconds while it runs
+METRICS_ENABLED = True
+METRICS_FORMAT = 'prometheus'  # 'prometheus' (text format, e.g. for the node_exporter textfile collector), 'openmetrics' or 'jsonl'
+METRICS_PATH = 'crux_metrics'   # Output file without extension (.prom, .om or .jsonl is added)
+METRICS_FLUSH_INTERVAL = 30    # Seconds between writes during the run (0 only writes at the end)
+METRICS_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]  # Histogram bounds in seconds
+
+# Phases of a request, in the order they happen (total is the whole request including its retries)
+REQUEST_PHASES = ['queue_wait', 'limiter_wait', 'retry_wait', 'connect', 'ttfb', 'download', 'parse', 'extract', 'total']
+
+# Timings of the request being processed by the current thread or asyncio task: {phase: seconds}
+request_timings = contextvars.ContextVar('request_timings', default=None)
+
+# Function to add time spent in a phase to the timings of the current request (no-op outside a request)
+def add_timing(phase, seconds):
+    timings = request_timings.get()
+    if timings is not None:
+        timings[phase] = timings.get(phase, 0) + seconds
+
+# Request metrics: the phase timings of every request aggregated into histograms (and, in the
+# jsonl format, one record per request), so the wall-clock time of a run can be traced to
+# limiter waits, API latency, retry backoff or parsing
+class RequestMetrics:
+    def __init__(self, namespace, path, output_format, buckets):
+        self.lock = threading.Lock()
+        self.namespace = namespace
+        self.format = output_format
+        self.path = path + {'prometheus': '.prom', 'openmetrics': '.om', 'jsonl': '.jsonl'}[output_format]
+        self.buckets = buckets
+        self.histograms = {}  # {phase: [count per bucket..., count above the last bucket, sum]}
+        self.pending = []     # Request records not written yet (jsonl)
+        self.active = False
+        self.stop_event = threading.Event()
+        self.flusher = None
     
-    if not uploaded:
-        print("No file was uploaded. Please run the script again.")
-        raise SystemExit
+    @contextlib.contextmanager
+    def track(self, queued_at=None, **labels):
+        """Collect the timings of one request in this thread or asyncio task and record them at the end"""
+        timings = {}
+        if queued_at is not None:
+            timings['queue_wait'] = time.perf_counter() - queued_at
+        token = request_timings.set(timings)
+        start = time.perf_counter()
+        try:
+            yield timings
+        finally:
+            request_timings.reset(token)
+            timings['total'] = time.perf_counter() - start + timings.get('queue_wait', 0)
+            self.record(labels, timings)
     
-    # Get the filename and content
-    file_name = list(uploaded.keys())[0]
-    file_content = uploaded[file_name]
+    def run(self, function, *args, queued_at=None, **labels):
+        """Call function(*args) with the timings of its requests tracked"""
+        with self.track(queued_at, **labels):
+            return function(*args)
+    
+    def record(self, labels, timings):
+        with self.lock:
+            for phase, seconds in timings.items():
+                histogram = self.histograms.setdefault(phase, [0] * (len(self.buckets) + 2))
+                histogram[bisect.bisect_left(self.buckets, seconds)] += 1
+                histogram[-1] += seconds
+            if self.active and self.format == 'jsonl':
+                self.pending.append({'type': 'request', **labels, **{phase: round(seconds, 6) for phase, seconds in timings.items()}})
+    
+    def cumulative(self, histogram):
+        """(upper bound, cumulative count) pairs of a histogram, ending with +Inf"""
+        return list(zip([str(float(bound)) for bound in self.buckets] + ['+Inf'], itertools.accumulate(histogram[:-1])))
+    
+    def render(self):
+        """Prometheus text format (or OpenMetrics) of the histograms"""
+        name = f"{self.namespace}_request_phase_seconds"
+        lines = [f"# HELP {name} Time spent in each phase of the API requests",
+                 f"# TYPE {name} histogram"]
+        if self.format == 'openmetrics':
+            lines.append(f"# UNIT {name} seconds")
+        with self.lock:
+            for phase in sorted(self.histograms, key=self.phase_order):
+                histogram = self.histograms[phase]
+                buckets = self.cumulative(histogram)
+                lines += [f'{name}_bucket{{phase="{phase}",le="{bound}"}} {count}' for bound, count in buckets]
+                lines.append(f'{name}_sum{{phase="{phase}"}} {histogram[-1]:.6f}')
+                lines.append(f'{name}_count{{phase="{phase}"}} {buckets[-1][1]}')
+        if self.format == 'openmetrics':
+            lines.append("# EOF")
+        return '\n'.join(lines) + '\n'
+    
+    def phase_order(self, phase):
+        return REQUEST_PHASES.index(phase) if phase in REQUEST_PHASES else len(REQUEST_PHASES)
+    
+    def flush(self, final=False):
+        """Write the metrics: the histogram file is replaced atomically, JSONL records are appended"""
+        if self.format != 'jsonl':
+            with open(self.path + '.tmp', 'w') as f:
+                f.write(self.render())
+            os.replace(self.path + '.tmp', self.path)
+            return
+        with self.lock:
+            records, self.pending = self.pending, []
+            if final:
+                records += [{'type': 'histogram', 'phase': phase, 'buckets': dict(self.cumulative(histogram)),
+                             'sum': round(histogram[-1], 6), 'count': sum(histogram[:-1])}
+                            for phase, histogram in self.histograms.items()]
+        with open(self.path, 'a') as f:
+            f.writelines(json.dumps(record) + '\n' for record in records)
+    
+    def start(self, flush_interval):
+        """Start collecting per-request records and flush every flush_interval seconds"""
+        if self.format == 'jsonl' and os.path.exists(self.path):
+            os.remove(self.path)
+        self.active = True
+        if flush_interval > 0:
+            def flush_periodically():
+                while not self.stop_event.wait(flush_interval):
+                    self.flush()
+            self.flusher = threading.Thread(target=flush_periodically, daemon=True)
+            self.flusher.start()
+    
+    def close(self):
+        self.stop_event.set()
+        if self.flusher:
+            self.flusher.join()
+        self.flush(final=True)
+        self.active = False
+    
+    def summary(self):
+        """One line per phase: requests, total seconds, mean and the bucket holding the 95th percentile"""
+        lines = []
+        with self.lock:
+            for phase in sorted(self.histograms, key=self.phase_order):
+                histogram = self.histograms[phase]
+                buckets = self.cumulative(histogram)
+                count = buckets[-1][1]
+                p95 = next(bound for bound, cumulative in buckets if cumulative >= 0.95 * count)
+                lines.append(f"{phase}: {count} requests, {histogram[-1]:.1f} s total, "
+                             f"{histogram[-1] / count * 1000:.0f} ms mean, p95 <= {p95} s")
+        return lines
+
+# Function to subclass a urllib3 connection pool so that opening a connection (TCP and TLS)
+# is added to the connect phase of the current request
+def timed_pool(pool_class):
+    class TimedConnection(pool_class.ConnectionCls):
+        def connect(self):
+            start = time.perf_counter()
+            try:
+                super().connect()
+            finally:
+                add_timing('connect', time.perf_counter() - start)
+    return type(f"Timed{pool_class.__name__}", (pool_class,), {'ConnectionCls': TimedConnection})
+
+# Function to add the connect, TTFB and download phases of a request from its httpx trace events
+def add_trace_timings(events, start, end):
+    connect_start = events.get('connection.connect_tcp.started')
+    connect_end = events.get('connection.start_tls.complete') or events.get('connection.connect_tcp.complete')
+    connect = connect_end - connect_start if connect_start and connect_end else 0
+    headers = events.get('http11.receive_response_headers.complete') or events.get('http2.receive_response_headers.complete') or end
+    if connect:
+        add_timing('connect', connect)
+    add_timing('ttfb', headers - start - connect)
+    add_timing('download', end - headers)
+
+# Shared HTTP transport: one keep-alive connection pool for API calls and sitemap fetches,
+# with gzip compression, optional HTTP/2 and a concurrency cap per host
+# (the client library is only imported when the first request is sent)
+class HttpTransport:
+    def __init__(self, pool_size, per_host_limit, http2=False):
+        self.lock = threading.Lock()
+        self.pool_size = pool_size
+        self.per_host_limit = per_host_limit
+        self.http2 = http2
+        self.host_slots = {}
+        self.session = None
+    
+    @property
+    def client(self):
+        """HTTP client, created on first use (and again after close())"""
+        with self.lock:
+            if self.session is None:
+                self.session = self.create_client()
+            return self.session
+    
+    def create_client(self):
+        headers = {'Accept-Encoding': 'gzip, deflate'}
+        if self.http2:
+            import httpx
+            return httpx.Client(http2=True, headers=headers, follow_redirects=True,
+                                limits=httpx.Limits(max_connections=self.pool_size,
+                                                    max_keepalive_connections=self.pool_size))
+        import requests
+        from requests.adapters import HTTPAdapter
+        client = requests.Session()
+        client.headers.update(headers)
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.pool_size)
+        adapter.poolmanager.pool_classes_by_scheme = {scheme: timed_pool(pool_class) for scheme, pool_class
+                                                      in adapter.poolmanager.pool_classes_by_scheme.items()}
+        client.mount('https://', adapter)
+        client.mount('http://', adapter)
+        return client
+    
+    @property
+    def timeout_errors(self):
+        if self.http2:
+            import httpx
+            return (httpx.TimeoutException,)
+        import requests
+        return (requests.exceptions.Timeout,)
+    
+    @property
+    def connection_errors(self):
+        if self.http2:
+            import httpx
+            return (httpx.TransportError,)
+        import requests
+        return (requests.exceptions.ConnectionError,)
+    
+    def host_slot(self, url):
+        """Semaphore limiting concurrent requests to the host of the URL"""
+        host = urlsplit(url).netloc
+        with self.lock:
+            if host not in self.host_slots:
+                self.host_slots[host] = threading.BoundedSemaphore(self.per_host_limit)
+            return self.host_slots[host]
+    
+    def request(self, method, url, **kwargs):
+        """Send a request and add its connect, TTFB and download phases to the current request timings"""
+        with self.host_slot(url):
+            start = time.perf_counter()
+            if self.http2:
+                events = {}
+                def trace(event_name, info):
+                    events[event_name] = time.perf_counter()
+                response = self.client.request(method, url, extensions={'trace': trace}, **kwargs)
+                add_trace_timings(events, start, time.perf_counter())
+                return response
+            
+            # The body is read separately (stream=True) so time to first byte and download are split
+            timings = request_timings.get() or {}
+            connect = timings.get('connect', 0)
+            response = self.client.request(method, url, stream=True, **kwargs)
+            headers = time.perf_counter()
+            response.content
+            add_timing('ttfb', headers - start - (timings.get('connect', 0) - connect))
+            add_timing('download', time.perf_counter() - headers)
+            return response
+    
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+    
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+    
+    def stream(self, url, chunk_size=65536, **kwargs):
+        """Yield the body of a GET request in chunks as it downloads"""
+        with self.host_slot(url):
+            if not self.http2:
+                with self.client.get(url, stream=True, **kwargs) as response:
+                    response.raise_for_status()
+                    yield from response.iter_content(chunk_size)
+            else:
+                with self.client.stream('GET', url, **kwargs) as response:
+                    response.raise_for_status()
+                    yield from response.iter_bytes(chunk_size)
+    
+    def close(self):
+        with self.lock:
+            if self.session is not None:
+                self.session.close()
+                self.session = None
+
+http_transport = HttpTransport(MAX_CONCURRENT_REQUESTS, MAX_REQUESTS_PER_HOST, HTTP2_ENABLED)
+
+# Run journal: every completed result is appended to a JSONL file as soon as it arrives, so an
+# interrupted run (disconnect, crash, Ctrl-C) can be resumed without repeating its queries
+class RunJournal:
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.path = path
+        self.file = None
+    
+    def load(self, config):
+        """Return the entries of an interrupted run with the same settings (empty list if none)"""
+        if not os.path.exists(self.path):
+            return []
+        entries = []
+        with open(self.path, encoding='utf-8') as f:
+            try:
+                if json.loads(f.readline()).get('config') != config:
+                    return []
+                for line in f:
+                    entries.append(json.loads(line))
+            except ValueError:
+                pass  # A line cut off by the interruption ends the journal
+        return entries
+    
+    def start(self, config, entries=()):
+        """Start a new journal, keeping the entries of a resumed run"""
+        self.file = open(self.path, 'w', encoding='utf-8')
+        self.file.write(json.dumps({'config': config}) + '\n')
+        for entry in entries:
+            self.file.write(json.dumps(entry, default=str) + '\n')
+        self.file.flush()
+    
+    def write(self, entry):
+        with self.lock:
+            self.file.write(json.dumps(entry, default=str) + '\n')
+            self.file.flush()
+            os.fsync(self.file.fileno())
+    
+    def finish(self):
+        """Remove the journal once the output file has been written"""
+        with self.lock:
+            self.file.close()
+            os.remove(self.path)
+
+# Work queue of a distributed run in an SQLite file: the coordinator pushes tasks and collects
+# their results, workers in other processes lease tasks for a limited time and write the results
+# back (SQLite's file locking serializes them: use a local disk, or a network file system with
+# working locks for several machines). A task whose lease runs out goes to the next worker, so
+# every task is done at least once; the first result written for a task is kept.
+class SqliteWorkQueue:
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        with self.lock:
+            self.conn.executescript("""
+                CREATE TABLE IF NOT EXISTS job (key TEXT PRIMARY KEY, value TEXT);
+                CREATE TABLE IF NOT EXISTS tasks (
+                    id INTEGER PRIMARY KEY,
+                    task TEXT UNIQUE NOT NULL,
+                    worker TEXT,
+                    lease_until REAL NOT NULL DEFAULT 0,
+                    leases INTEGER NOT NULL DEFAULT 0,
+                    done_seq INTEGER,
+                    result TEXT
+                );
+                CREATE INDEX IF NOT EXISTS tasks_done_seq ON tasks (done_seq);
+            """)
+    
+    @contextlib.contextmanager
+    def transaction(self):
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield self.conn
+            except BaseException:
+                self.conn.execute('ROLLBACK')
+                raise
+            self.conn.execute('COMMIT')
+    
+    def open_job(self, config, resume=True):
+        """Open a job with these settings: an unfinished earlier job with the same settings is resumed,
+        any other job (a finished one included) is replaced (returns the number of tasks already done)"""
+        with self.transaction() as conn:
+            row = conn.execute("SELECT value FROM job WHERE key = 'config'").fetchone()
+            finished = conn.execute("SELECT 1 FROM job WHERE key = 'finished'").fetchone()
+            if resume and row and not finished and json.loads(row[0]) == config:
+                return conn.execute("SELECT COUNT(*) FROM tasks WHERE done_seq IS NOT NULL").fetchone()[0]
+            conn.execute("DELETE FROM tasks")
+            conn.execute("DELETE FROM job")
+            conn.execute("INSERT INTO job VALUES ('config', ?)", (json.dumps(config),))
+            return 0
+    
+    def job_config(self):
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM job WHERE key = 'config'").fetchone()
+        return json.loads(row[0]) if row else None
+    
+    def finished(self):
+        with self.lock:
+            return self.conn.execute("SELECT 1 FROM job WHERE key = 'finished'").fetchone() is not None
+    
+    def finish(self):
+        """Mark the job as finished, so idle workers stop and the next run starts a new job"""
+        with self.transaction() as conn:
+            conn.execute("INSERT OR REPLACE INTO job VALUES ('finished', '1')")
+    
+    def push(self, tasks):
+        """Add tasks (tasks already in the queue are not added again)"""
+        if tasks:
+            with self.transaction() as conn:
+                conn.executemany("INSERT OR IGNORE INTO tasks (task) VALUES (?)", [(json.dumps(task),) for task in tasks])
+    
+    def lease(self, worker, count, timeout):
+        """Lease up to count open tasks (never leased, or with an expired lease): [(task id, task)]"""
+        if count <= 0:
+            return []
+        now = time.time()
+        with self.transaction() as conn:
+            rows = conn.execute("SELECT id, task FROM tasks WHERE done_seq IS NULL AND lease_until < ? ORDER BY id LIMIT ?",
+                                (now, count)).fetchall()
+            conn.executemany("UPDATE tasks SET worker = ?, lease_until = ?, leases = leases + 1 WHERE id = ?",
+                             [(worker, now + timeout, task_id) for task_id, _ in rows])
+        return [(task_id, tuple(json.loads(task))) for task_id, task in rows]
+    
+    def renew(self, worker, task_ids, timeout):
+        """Extend the leases of tasks that are still running"""
+        with self.transaction() as conn:
+            conn.executemany("UPDATE tasks SET lease_until = ? WHERE id = ? AND worker = ? AND done_seq IS NULL",
+                             [(time.time() + timeout, task_id, worker) for task_id in task_ids])
+    
+    def complete(self, task_id, result):
+        with self.transaction() as conn:
+            conn.execute("UPDATE tasks SET result = ?, done_seq = (SELECT COALESCE(MAX(done_seq), 0) + 1 FROM tasks) "
+                         "WHERE id = ? AND done_seq IS NULL", (json.dumps(result, default=str), task_id))
+    
+    def results_since(self, cursor):
+        """Results written after the cursor: ([(task, result)], new cursor)"""
+        with self.lock:
+            rows = self.conn.execute("SELECT task, result, done_seq FROM tasks WHERE done_seq > ? ORDER BY done_seq",
+                                     (cursor,)).fetchall()
+        entries = [(tuple(json.loads(task)), json.loads(result)) for task, result, _ in rows]
+        return entries, rows[-1][2] if rows else cursor
+    
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+# The same work queue in Redis (or a server speaking its protocol, such as Valkey or KeyDB), for
+# workers on several machines (needs: pip install redis). Open tasks are a sorted set scored by
+# the time they can be leased (0 when new, the lease expiry once leased), so a task stays in the
+# set until its result is written and a crashed worker never loses it.
+class RedisWorkQueue:
+    def __init__(self, url, name):
+        import redis
+        self.client = redis.Redis.from_url(url, decode_responses=True)
+        self.keys = {part: f"{name}:{part}" for part in ('config', 'finished', 'open', 'results', 'done')}
+    
+    def open_job(self, config, resume=True):
+        stored = self.client.get(self.keys['config'])
+        if resume and stored and not self.finished() and json.loads(stored) == config:
+            return self.client.hlen(self.keys['results'])
+        self.client.delete(*self.keys.values())
+        self.client.set(self.keys['config'], json.dumps(config))
+        return 0
+    
+    def job_config(self):
+        stored = self.client.get(self.keys['config'])
+        return json.loads(stored) if stored else None
+    
+    def finished(self):
+        return bool(self.client.exists(self.keys['finished']))
+    
+    def finish(self):
+        self.client.set(self.keys['finished'], 1)
+    
+    def push(self, tasks):
+        encoded = [json.dumps(task) for task in tasks]
+        if encoded:
+            done = self.client.hmget(self.keys['results'], encoded)
+            new = {task: 0 for task, result in zip(encoded, done) if result is None}
+            if new:
+                self.client.zadd(self.keys['open'], new, nx=True)
+    
+    def lease(self, worker, count, timeout):
+        if count <= 0:
+            return []
+        
+        # Optimistic transaction: retried if another worker leased from the set in the meantime
+        def claim(pipe):
+            now = time.time()
+            tasks = pipe.zrangebyscore(self.keys['open'], '-inf', now, start=0, num=count)
+            pipe.multi()
+            if tasks:
+                pipe.zadd(self.keys['open'], {task: now + timeout for task in tasks}, xx=True)
+            return tasks
+        tasks = self.client.transaction(claim, self.keys['open'], value_from_callable=True)
+        return [(task, tuple(json.loads(task))) for task in tasks]
+    
+    def renew(self, worker, task_ids, timeout):
+        if task_ids:
+            self.client.zadd(self.keys['open'], {task: time.time() + timeout for task in task_ids}, xx=True)
     
-    # Read URLs from the file
-    urls = [line.strip() for line in file_content.decode('utf-8').split('\n') if line.strip()]
-    print(f"Found {len(urls)} URLs in {file_name}")
+    def complete(self, task_id, result):
+        pipe = self.client.pipeline()
+        pipe.zrem(self.keys['open'], task_id)
+        pipe.hsetnx(self.keys['results'], task_id, json.dumps(result, default=str))
+        pipe.rpush(self.keys['done'], task_id)
+        pipe.execute()
     
-    # Try to determine domain from first URL for naming the output file
-    if urls:
+    def results_since(self, cursor):
+        tasks = self.client.lrange(self.keys['done'], cursor, -1)
+        results = self.client.hmget(self.keys['results'], tasks) if tasks else []
+        return [(tuple(json.loads(task)), json.loads(result)) for task, result in zip(tasks, results)], cursor + len(tasks)
+    
+    def close(self):
+        self.client.close()
+
+# Function to open the work queue of a distributed run: a redis:// (or rediss://) URL, or an SQLite file
+def open_work_queue(spec):
+    if spec.startswith(('redis://', 'rediss://')):
+        return RedisWorkQueue(spec, WORK_QUEUE_NAME)
+    return SqliteWorkQueue(spec)
+
+# Raw response archive: every API response is stored compressed under the SHA-256 of its body
+# (identical responses are stored once), with an SQLite index by URL, variant and fetch time
+class ResponseArchive:
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.path = path
+        os.makedirs(os.path.join(path, 'objects'), exist_ok=True)
+        
+        # zstd when available (pip install zstandard), gzip otherwise
         try:
-            domain_parts = urls[0].replace('https://', '').replace('http://', '').split('/')
-            domain = domain_parts[0]
-        except:
-            domain = "custom"
-else:
-    # Default to option 1 (sitemap) if anything else is entered
-    # Get domain for sitemap
-    domain = input("\nEnter the domain to analyze (e.g., https://www.example.com): ")
-    if not domain.startswith(('http://', 'https://')):
-        domain = 'https://' + domain
+            import zstandard
+            self.codec = 'zst'
+            # One-shot functions: compressor objects must not be shared between threads
+            self.compress = lambda body: zstandard.compress(body, 10)
+            self.decompressors = {'zst': zstandard.decompress, 'gz': gzip.decompress}
+        except ImportError:
+            self.codec = 'gz'
+            self.compress = gzip.compress
+            self.decompressors = {'gz': gzip.decompress}
+        
+        self.conn = sqlite3.connect(os.path.join(path, 'index.sqlite'), check_same_thread=False)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                url TEXT NOT NULL,
+                variant TEXT NOT NULL,
+                fetched_at REAL NOT NULL,
+                digest TEXT NOT NULL,
+                codec TEXT NOT NULL
+            )""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_url ON responses (url, variant, fetched_at)")
     
-    print(f"\nFetching sitemap from {domain}...")
+    def object_path(self, digest, codec):
+        return os.path.join(self.path, 'objects', digest[:2], f"{digest}.json.{codec}")
+    
+    def put(self, url, variant, body):
+        """Store a raw response body for the URL and variant (strategy or form factor)"""
+        digest = hashlib.sha256(body).hexdigest()
+        path = self.object_path(digest, self.codec)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(self.compress(body))
+            os.replace(tmp_path, path)
+        with self.lock:
+            self.conn.execute("INSERT INTO responses VALUES (?, ?, ?, ?, ?)",
+                              (url, variant, time.time(), digest, self.codec))
+            self.conn.commit()
+    
+    def get_latest(self, url, variant):
+        """Return the most recent archived response for the URL and variant, or None"""
+        with self.lock:
+            row = self.conn.execute("""
+                SELECT digest, codec FROM responses WHERE url = ? AND variant = ?
+                ORDER BY fetched_at DESC LIMIT 1""", (url, variant)).fetchone()
+        if not row or row[1] not in self.decompressors:
+            return None
+        with open(self.object_path(*row), 'rb') as f:
+            return json.loads(self.decompressors[row[1]](f.read()))
+    
+    def urls(self):
+        """All archived URLs in the order they were first stored"""
+        with self.lock:
+            rows = self.conn.execute("SELECT url FROM responses GROUP BY url ORDER BY MIN(rowid)").fetchall()
+        return [row[0] for row in rows]
     
-    # Get URLs from sitemap
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+# URL index: groups the input URLs that are the same page after canonicalization so that each
+# page is queried once, under the first of its URLs exactly as written (the APIs match URLs
+# exactly, so the canonical form is only the grouping key), and remembers the aliases so each
+# result can be copied back to them
+class UrlIndex:
+    def __init__(self, rules):
+        self.lock = threading.Lock()
+        self.rules = rules
+        self.aliases = {}  # {canonical URL: [input URLs], the first of which is queried}
+        self.duplicates = 0
+    
+    def canonicalize(self, url):
+        """Apply the canonicalization rules to a URL (without rules it is only stripped of whitespace)"""
+        rules = self.rules
+        if not rules:
+            return url.strip()
+        parts = urlsplit(url.strip())
+        scheme = parts.scheme.lower() if rules.get('lowercase_host') else parts.scheme
+        netloc = parts.netloc.lower() if rules.get('lowercase_host') else parts.netloc
+        if rules.get('force_https') and scheme == 'http':
+            scheme = 'https'
+            netloc = netloc[:-len(':80')] if netloc.endswith(':80') else netloc
+        if rules.get('strip_default_port'):
+            default_port = {'http': ':80', 'https': ':443'}.get(scheme)
+            if default_port and netloc.endswith(default_port):
+                netloc = netloc[:-len(default_port)]
+        
+        path = parts.path
+        if rules.get('strip_trailing_slash'):
+            path = path.rstrip('/') or '/'
+        
+        query = parts.query
+        patterns = rules.get('strip_query_params')
+        if patterns and query:
+            query = '&'.join(param for param in query.split('&')
+                             if not any(fnmatch.fnmatchcase(param.split('=', 1)[0], pattern) for pattern in patterns))
+        
+        fragment = '' if rules.get('strip_fragment') else parts.fragment
+        return urlunsplit((scheme, netloc, path, query, fragment))
+    
+    def dedup(self, urls):
+        """Yield every URL whose page was not seen before, as written"""
+        for url in urls:
+            url = url.strip()
+            canonical = self.canonicalize(url)
+            with self.lock:
+                seen = canonical in self.aliases
+                self.aliases.setdefault(canonical, []).append(url)
+                if seen:
+                    self.duplicates += 1
+            if not seen:
+                yield url
+    
+    def alias_frame(self, column):
+        """DataFrame mapping every queried URL (queried_url) to the input URLs it stands for"""
+        import pandas as pd
+        with self.lock:
+            pairs = [(urls[0], url) for urls in self.aliases.values() for url in urls]
+        return pd.DataFrame(pairs, columns=['queried_url', column])
+
+# Function to copy the result rows of every queried URL to all of its input URLs
+def fan_out(df, column='url'):
+    df = df.rename(columns={column: 'queried_url'}).merge(url_index.alias_frame(column), on='queried_url', how='left')
+    df.insert(0, column, df.pop(column))
+    return df
+
+url_index = UrlIndex(CANONICAL_RULES if CANONICALIZE_URLS else {})
+
+# Sitemap constants
+SITEMAP_WORKERS = 4         # Child sitemaps of a sitemap index that are read in parallel
+SITEMAP_QUEUE_SIZE = 10000  # URLs read ahead of the API queries (keeps memory flat for huge sitemaps)
+
+# Function to find the sitemaps of a site: the Sitemap: lines of robots.txt, else /sitemap.xml
+def find_sitemaps(domain):
     try:
-        sitemap_url = f"{domain}/sitemap.xml"
-        response = requests.get(sitemap_url)
+        response = http_transport.get(f"{domain}/robots.txt", timeout=30)
         if response.status_code == 200:
-            # Extract URLs using regex (simple approach)
-            urls = re.findall(r'<loc>(.*?)</loc>', response.text)
-            print(f"Found {len(urls)} URLs in sitemap.")
-        else:
-            print(f"Failed to fetch sitemap: {response.status_code}")
+            sitemaps = re.findall(r'^\s*sitemap:\s*(\S+)', response.text, re.I | re.M)
+            if sitemaps:
+                return sitemaps
     except Exception as e:
-        print(f"Error fetching sitemap: {e}")
+        print(f"Error fetching robots.txt: {e}")
+    return [f"{domain}/sitemap.xml"]
+
+# Function to stream the entries of one sitemap while it downloads: ('url', loc, lastmod, priority)
+# for pages and ('sitemap', loc, lastmod, None) for the children of a sitemap index
+def parse_sitemap_stream(sitemap_url):
+    parser = ET.XMLPullParser(events=('start', 'end'))
+    decompressor = None
+    root = None
+    for chunk in http_transport.stream(sitemap_url, timeout=30):
+        # .xml.gz sitemaps are decompressed on the fly (gzip Content-Encoding is decoded by the transport)
+        if decompressor is None:
+            decompressor = zlib.decompressobj(31) if chunk[:2] == b'\x1f\x8b' else False
+        parser.feed(decompressor.decompress(chunk) if decompressor else chunk)
+        
+        for event, element in parser.read_events():
+            if root is None:
+                root = element
+            tag = element.tag.rsplit('}', 1)[-1]
+            if event != 'end' or tag not in ('url', 'sitemap'):
+                continue
+            fields = {child.tag.rsplit('}', 1)[-1]: (child.text or '').strip() for child in element}
+            if fields.get('loc'):
+                yield tag, fields['loc'], fields.get('lastmod') or None, fields.get('priority') or None
+            # Parsed entries are dropped, so memory does not grow with the sitemap size
+            root.clear()
+
+# Function to yield (url, lastmod, priority) for every page of the given sitemaps as they are read;
+# sitemap indexes are followed and their child sitemaps are fetched in parallel
+def iter_sitemap_urls(sitemap_urls):
+    entries = queue.Queue(maxsize=SITEMAP_QUEUE_SIZE)
+    stop = threading.Event()
+    lock = threading.Lock()
+    seen = set()
+    pending = [1]  # Sitemaps still being read (plus one until all top-level sitemaps are queued)
+    jobs = queue.Queue()
     
-    # If sitemap approach fails, use a few known pages
-    if not urls:
-        print("Couldn't get URLs from sitemap. Using domain and some common paths.")
-        urls = [
-            domain,
-            f"{domain}/about",
-            f"{domain}/contact",
-            f"{domain}/services",
-            f"{domain}/blog"
-        ]
+    def put(item):
+        # Waits while the queue is full, so reading only stays a little ahead of the queries
+        while not stop.is_set():
+            try:
+                entries.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                pass
+    
+    def finished():
+        with lock:
+            pending[0] -= 1
+            done = pending[0] == 0
+        if done:
+            put(None)
+    
+    def submit(sitemap_url):
+        with lock:
+            if sitemap_url in seen:
+                return
+            seen.add(sitemap_url)
+            pending[0] += 1
+        jobs.put(sitemap_url)
+    
+    # Daemon threads, so a reader waiting on a full queue never blocks the end of the script
+    def worker():
+        while True:
+            sitemap_url = jobs.get()
+            if sitemap_url is None:
+                return
+            try:
+                for kind, loc, lastmod, priority in parse_sitemap_stream(sitemap_url):
+                    if stop.is_set():
+                        break
+                    if kind == 'sitemap':
+                        submit(loc)
+                    else:
+                        put((loc, lastmod, priority))
+            except Exception as e:
+                print(f"Error reading sitemap {sitemap_url}: {e}")
+            finished()
+    
+    for _ in range(SITEMAP_WORKERS):
+        threading.Thread(target=worker, daemon=True).start()
+    
+    try:
+        for sitemap_url in sitemap_urls:
+            submit(sitemap_url)
+        finished()
+        while True:
+            item = entries.get()
+            if item is None:
+                return
+            yield item
+    finally:
+        stop.set()
+        for _ in range(SITEMAP_WORKERS):
+            jobs.put(None)
+
+# Function to check whether an iterator yields anything (returns None if not, otherwise an equivalent iterator)
+def peek(iterator):
+    first = next(iterator, None)
+    return None if first is None else itertools.chain([first], iterator)
+
+# Form factor options of the interactive menu
+FORM_FACTOR_OPTIONS = {
+    '1': ('ALL', "All form factors"),
+    '2': ('PHONE', "Mobile phones only"),
+    '3': ('DESKTOP', "Desktop computers only"),
+    '4': ('TABLET', "Tablet devices only"),
+}
+# Device split: the ALL response carries each device's share of traffic (form_factors),
+# so per-device follow-up queries are only sent for devices above the threshold
+DEVICE_SPLIT_THRESHOLD = 20  # Minimum device share of traffic in percent
+DEVICE_FORM_FACTORS = {'phone': 'PHONE', 'desktop': 'DESKTOP', 'tablet': 'TABLET'}
+
+# Run settings used by the functions below (run_crux_batch() sets them for each run)
+CRUX_MODE = 'record'      # 'record' (latest 28-day record) or 'history' (weekly time series)
+HISTORY_LEVEL = 'url'     # 'url' or 'origin' history
+FORM_FACTORS = ['ALL']
+DEVICE_SPLIT = False
+ORIGIN_FALLBACK = False
+REEXTRACT = False
+response_archive = None
+request_metrics = RequestMetrics('crux', METRICS_PATH, METRICS_FORMAT, METRICS_BUCKETS)
+response_cache = None
+
+# Function to get the origin (scheme and host) of a URL
+def get_origin(url):
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+# Response cache constants
+CACHE_ENABLED = True                 # Set to False to always query the API
+CACHE_PATH = 'crux_cache.sqlite'     # SQLite file kept between runs
+CACHE_TTL = 24 * 60 * 60             # Maximum age of a cached response in seconds
+CACHE_MAX_ENTRIES = 500000           # Oldest entries are evicted beyond this size
+NEGATIVE_CACHE_TTL = 3 * 24 * 60 * 60  # How long a URL without CrUX data (404) is skipped
+CRUX_UPDATE_HOUR_UTC = 4             # CrUX API data is refreshed daily around 04:00 UTC
+
+# History mode constants
+HISTORY_OUTPUT_FORMAT = 'csv'        # 'csv' or 'parquet' (parquet needs pyarrow)
+
+# CrUX metrics: API key, column prefix, p75 value column, "good" and "needs improvement" thresholds
+# (adding a metric to the output only needs a new line here)
+CRUX_METRICS = [
+    ('largest_contentful_paint', 'lcp', 'lcp_value_ms', 2500, 4000),
+    ('cumulative_layout_shift', 'cls', 'cls_value', 0.1, 0.25),
+    ('first_contentful_paint', 'fcp', 'fcp_value_ms', 1800, 3000),
+    ('first_input_delay', 'fid', 'fid_value_ms', 100, 300),
+    ('interaction_to_next_paint', 'inp', 'inp_value_ms', 200, 500),
+    ('experimental_time_to_first_byte', 'ttfb', 'ttfb_value_ms', 800, 1800),
+]
+
+# Core Web Vitals used for the pass/fail status (INP replaced FID in 2024)
+CWV_METRICS = ['lcp', 'cls', 'inp']
+
+# Thread-safe counter and rate limiter
+# (GCRA scheduler: each caller reserves its own start slot under the lock and sleeps outside it)
+class RateLimiter:
+    def __init__(self, max_queries, time_window, burst=1):
+        self.lock = threading.Lock()
+        self.max_queries = max_queries
+        self.time_window = time_window
+        self.interval = time_window / max_queries  # Steady-state spacing between requests
+        self.tolerance = (min(burst, max_queries) - 1) * self.interval  # How far ahead a burst may run
+        self.next_slot = 0.0  # Theoretical arrival time of the next request
+        self.recent_slots = collections.deque(maxlen=max_queries)  # Enforces the per-window cap
+        self.counter = 0
+    
+    def increment(self):
+        with self.lock:
+            self.counter += 1
+            return self.counter
+    
+    def reserve(self):
+        """Reserve the next request slot and return the seconds to wait for it"""
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot - self.tolerance)
+            
+            # Never start more than max_queries requests within one time window
+            if len(self.recent_slots) == self.max_queries:
+                slot = max(slot, self.recent_slots[0] + self.time_window)
+            
+            self.next_slot = max(self.next_slot, slot) + self.interval
+            self.recent_slots.append(slot)
+        return slot - now
+    
+    def wait_if_needed(self):
+        delay = self.reserve()
+        if delay > 0:
+            add_timing('limiter_wait', delay)
+            time.sleep(delay)
+    
+    def set_rate(self, max_queries):
+        """Change the steady request rate (the cap per time window stays at the quota)"""
+        with self.lock:
+            self.interval = self.time_window / max_queries
+
+# Adaptive concurrency controller (AIMD): requests take a slot before they are sent; the number
+# of slots grows additively while responses succeed at a stable latency and is cut
+# multiplicatively on overload, so the run converges on the highest level the API key sustains
+class ConcurrencyController:
+    def __init__(self, initial, min_limit, max_limit, rate_limiter=None, decrease=0.5,
+                 latency_tolerance=2.0, min_rate_share=0.1):
+        self.condition = threading.Condition()
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = float(min(max(initial, min_limit), max_limit))
+        self.peak_limit = self.limit
+        self.in_flight = 0
+        self.decrease = decrease
+        self.latency_tolerance = latency_tolerance
+        self.recent_latency = None    # Smoothed latency of the latest responses
+        self.baseline_latency = None  # Latency without queueing at the API (slowly forgotten minimum)
+        self.last_decrease = float('-inf')
+        self.last_rate_decrease = float('-inf')
+        self.decreases = 0
+        
+        # Sustained 429s also lower the request rate of the rate limiter, which then recovers toward the quota
+        self.rate_limiter = rate_limiter
+        self.throttled = collections.deque(maxlen=50)  # Whether each of the latest responses was a 429
+        if rate_limiter:
+            self.max_rate = rate_limiter.max_queries
+            self.min_rate = max(1, self.max_rate * min_rate_share)
+            self.rate = self.max_rate
+    
+    def try_acquire(self):
+        if self.in_flight < int(self.limit):
+            self.in_flight += 1
+            return True
+        return False
+    
+    @contextlib.contextmanager
+    def slot(self):
+        """Hold a request slot while sending; set outcome['status'] to the HTTP status of the response"""
+        with self.condition:
+            self.condition.wait_for(self.try_acquire)
+        outcome = {'status': None}
+        start = time.perf_counter()
+        try:
+            yield outcome
+        finally:
+            with self.condition:
+                self.update(time.perf_counter() - start, outcome['status'])
+                self.condition.notify_all()
+    
+    def update(self, latency, status):
+        """Release a slot and adjust the limits to the outcome of its request"""
+        saturated = self.in_flight >= int(self.limit)
+        self.in_flight -= 1
+        self.throttled.append(status == 429)
+        
+        if status is None or status in OVERLOAD_STATUSES:
+            now = time.monotonic()
+            
+            # Overload: cut once per round trip, the other failures of the same burst carry the same signal
+            if now - self.last_decrease >= (self.recent_latency or 0):
+                self.last_decrease = now
+                self.decreases += 1
+                self.limit = max(self.min_limit, self.limit * self.decrease)
+            
+            # An occasional 429 is noise, a run of them means the key's quota is below the rate
+            # (cut once per quota window: the window keeps answering 429 for a while after a cut)
+            if (status == 429 and self.rate_limiter and sum(self.throttled) >= 0.1 * len(self.throttled)
+                    and now - self.last_rate_decrease >= self.rate_limiter.time_window):
+                self.last_rate_decrease = now
+                self.rate = max(self.min_rate, self.rate * self.decrease)
+                self.rate_limiter.set_rate(self.rate)
+            return
+        
+        self.recent_latency = latency if self.recent_latency is None else 0.7 * self.recent_latency + 0.3 * latency
+        self.baseline_latency = min(self.recent_latency, (self.baseline_latency or latency) * 1.01)
+        
+        # The rate grows back by 10% of the quota per round of successful requests
+        if self.rate_limiter and self.rate < self.max_rate:
+            self.rate = min(self.max_rate, self.rate + self.max_rate * 0.1 / self.rate)
+            self.rate_limiter.set_rate(self.rate)
+        
+        # One more slot per round of requests (twice as many per round until the first overload, like
+        # TCP slow start), as long as the slots are used and latency holds
+        if saturated and self.recent_latency <= self.baseline_latency * self.latency_tolerance:
+            self.limit = min(self.max_limit, self.limit + (1 if self.decreases == 0 else 1 / self.limit))
+            self.peak_limit = max(self.peak_limit, self.limit)
+    
+    def summary(self):
+        text = f"{self.limit:.1f} requests in flight at the end (peak {self.peak_limit:.1f}), {self.decreases} backoffs"
+        if self.rate_limiter:
+            text += f", request rate {self.rate:.0f} of {self.max_rate} per window"
+        return text
+
+# Function to create the concurrency controller of a run: adaptive between MIN_CONCURRENCY and
+# max_concurrency, or fixed at max_concurrency with ADAPTIVE_CONCURRENCY = False
+def new_concurrency_controller(max_concurrency, rate_limiter):
+    if not ADAPTIVE_CONCURRENCY:
+        return ConcurrencyController(max_concurrency, max_concurrency, max_concurrency)
+    return ConcurrencyController(INITIAL_CONCURRENCY, MIN_CONCURRENCY, max_concurrency, rate_limiter,
+                                 AIMD_DECREASE, AIMD_LATENCY_TOLERANCE, MIN_RATE_SHARE)
 
-# Check if we have URLs to process
-if not urls:
-    print("No URLs found. Please run the script again.")
-    raise SystemExit
-
-# Limit URLs if needed
-max_urls = input("\nEnter maximum number of URLs to analyze (leave blank for all): ")
-if max_urls.strip() and max_urls.isdigit():
-    max_urls = int(max_urls)
-    if max_urls < len(urls):
-        print(f"Limiting analysis to {max_urls} URLs out of {len(urls)} found.")
-        urls = urls[:max_urls]
-
-# Form factor selection
-print("\nSelect form factor for CrUX data:")
-print("1. All form factors (Default)")
-print("2. Mobile only (PHONE)")
-print("3. Desktop only (DESKTOP)")
-print("4. Tablet only (TABLET)")
-
-form_factor_choice = input("Enter your choice (1-4): ").strip()
-
-# Set form factor based on user choice
-if form_factor_choice == '2':
-    FORM_FACTOR = 'PHONE'
-    print("Selected: Mobile phones only")
-elif form_factor_choice == '3':
-    FORM_FACTOR = 'DESKTOP'
-    print("Selected: Desktop computers only")
-elif form_factor_choice == '4':
-    FORM_FACTOR = 'TABLET'
-    print("Selected: Tablet devices only")
-elif form_factor_choice == '' or form_factor_choice == '1':
-    FORM_FACTOR = None
-    print("Selected: All form factors")
-else:
-    # For any other invalid input
-    FORM_FACTOR = None
-    print("Invalid choice. Defaulting to: All form factors")
-
-# Function to get data from CrUX API for a specific URL
-def get_crux_data(url):
+concurrency_controller = new_concurrency_controller(MAX_CONCURRENT_REQUESTS, None)
+
+# Thread-safe retry policy with capped exponential backoff, full jitter and a per-run budget
+class RetryPolicy:
+    def __init__(self, max_retries, base_delay, max_delay, budget):
+        self.lock = threading.Lock()
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = budget
+        self.retries = collections.Counter()   # Retries by reason
+        self.failures = collections.Counter()  # Requests given up by reason
+        # Transport errors worth retrying (the async engine adds the httpx equivalents)
+        self.timeout_errors = http_transport.timeout_errors
+        self.connection_errors = http_transport.connection_errors
+    
+    def classify(self, response=None, error=None):
+        """Return the failure reason and whether it is worth retrying"""
+        if error is not None:
+            if isinstance(error, self.timeout_errors):
+                return "timeout", True
+            if isinstance(error, self.connection_errors):
+                return "connection error", True
+            return type(error).__name__, False
+        return f"HTTP {response.status_code}", response.status_code in RETRYABLE_STATUS_CODES
+    
+    def retry_after(self, response):
+        """Seconds requested by a Retry-After header (delta-seconds or HTTP date)"""
+        value = response.headers.get('Retry-After') if response is not None else None
+        if not value:
+            return 0
+        if value.strip().isdigit():
+            return int(value)
+        try:
+            return max(0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return 0
+    
+    def extend_budget(self, amount):
+        """Allow more retries (streamed runs grow the budget with every URL queued)"""
+        with self.lock:
+            self.budget += amount
+    
+    def next_delay(self, attempt, response=None, error=None):
+        """Return the seconds to wait before retrying, or None to give up"""
+        reason, retryable = self.classify(response, error)
+        with self.lock:
+            if not retryable or attempt >= self.max_retries or self.budget <= 0:
+                self.failures[reason] += 1
+                return None
+            self.budget -= 1
+            self.retries[reason] += 1
+        
+        # Full jitter spreads retries of concurrent workers instead of firing them together
+        backoff = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        return max(backoff, self.retry_after(response))
+
+retry_policy = RetryPolicy(MAX_RETRIES, RETRY_BASE_DELAY, RETRY_MAX_DELAY, 10)
+
+# Function to return the timestamp of the most recent daily CrUX data refresh
+def last_crux_update():
+    now = datetime.datetime.now(datetime.timezone.utc)
+    update = now.replace(hour=CRUX_UPDATE_HOUR_UTC, minute=0, second=0, microsecond=0)
+    if update > now:
+        update -= datetime.timedelta(days=1)
+    return update.timestamp()
+
+# Persistent SQLite cache for CrUX API responses
+class ResponseCache:
+    def __init__(self, path, ttl, max_entries, negative_ttl):
+        self.lock = threading.Lock()
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS crux_records (
+                url TEXT NOT NULL,
+                form_factor TEXT NOT NULL,
+                period_end TEXT NOT NULL,
+                fetched_at REAL NOT NULL,
+                response TEXT NOT NULL,
+                PRIMARY KEY (url, form_factor, period_end)
+            )""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS crux_records_fetched_at ON crux_records (fetched_at)")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS crux_missing (
+                url TEXT NOT NULL,
+                form_factor TEXT NOT NULL,
+                recorded_at REAL NOT NULL,
+                PRIMARY KEY (url, form_factor)
+            )""")
+        self.evict()
+    
+    def evict(self):
+        """Drop expired entries and trim the cache to max_entries"""
+        with self.lock:
+            self.conn.execute("DELETE FROM crux_records WHERE fetched_at < ?", (time.time() - self.ttl,))
+            self.conn.execute("""
+                DELETE FROM crux_records WHERE rowid IN (
+                    SELECT rowid FROM crux_records ORDER BY fetched_at DESC LIMIT -1 OFFSET ?
+                )""", (self.max_entries,))
+            self.conn.execute("DELETE FROM crux_missing WHERE recorded_at < ?", (time.time() - self.negative_ttl,))
+            self.conn.commit()
+    
+    def get(self, url, form_factor):
+        """Return the cached response for the current collection period, or None"""
+        # A response fetched before the last data refresh belongs to an older collection period
+        min_fetched_at = max(time.time() - self.ttl, last_crux_update())
+        with self.lock:
+            row = self.conn.execute("""
+                SELECT response FROM crux_records
+                WHERE url = ? AND form_factor = ? AND fetched_at >= ?
+                ORDER BY period_end DESC LIMIT 1""", (url, form_factor, min_fetched_at)).fetchone()
+            if row:
+                self.hits += 1
+                return json.loads(row[0])
+            self.misses += 1
+            return None
+    
+    def put(self, url, form_factor, response_text):
+        """Store a response keyed by URL, form factor and collection period"""
+        data = json.loads(response_text)
+        last_date = data.get('record', {}).get('collectionPeriod', {}).get('lastDate', {})
+        period_end = f"{last_date.get('year', 0):04d}-{last_date.get('month', 0):02d}-{last_date.get('day', 0):02d}"
+        with self.lock:
+            # Responses for older collection periods are superseded by this one
+            self.conn.execute("DELETE FROM crux_records WHERE url = ? AND form_factor = ? AND period_end < ?",
+                              (url, form_factor, period_end))
+            self.conn.execute("INSERT OR REPLACE INTO crux_records VALUES (?, ?, ?, ?, ?)",
+                              (url, form_factor, period_end, time.time(), response_text))
+            self.conn.execute("DELETE FROM crux_missing WHERE url = ? AND form_factor = ?", (url, form_factor))
+            self.conn.commit()
+    
+    def is_missing(self, url, form_factor):
+        """Check whether the URL recently returned 404 (not enough data in CrUX)"""
+        with self.lock:
+            row = self.conn.execute("""
+                SELECT 1 FROM crux_missing
+                WHERE url = ? AND form_factor = ? AND recorded_at >= ?""",
+                (url, form_factor, time.time() - self.negative_ttl)).fetchone()
+            if row:
+                self.negative_hits += 1
+                return True
+            return False
+    
+    def put_missing(self, url, form_factor):
+        """Remember that the URL has no CrUX record"""
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO crux_missing VALUES (?, ?, ?)", (url, form_factor, time.time()))
+            self.conn.commit()
+    
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+# Lock for the debug output below, which is shared by all worker threads
+debug_lock = threading.Lock()
+
+# Function to send a query to a CrUX API endpoint, retrying 429s, server errors and transport
+# errors under the retry policy of the run
+def post_crux_query(api_url, data, rate_limiter):
     headers = {
         'Accept': 'application/json',
         'Content-Type': 'application/json'
     }
+    label = data.get('url') or data.get('origin')
+    
+    # Debug info for first request
+    with debug_lock:
+        if not hasattr(post_crux_query, 'counter'):
+            post_crux_query.counter = 0
+        
+        show_debug = post_crux_query.counter == 0
+        if show_debug:
+            post_crux_query.counter += 1
+            print(f"\nDebug - API Request payload: {json.dumps(data)}")
+            print(f"Debug - Form factor selected: {data.get('formFactor', 'ALL')}")
+    
+    attempt = 0
+    while True:
+        # Wait if needed to respect rate limits
+        rate_limiter.wait_if_needed()
+        
+        response = error = None
+        try:
+            with concurrency_controller.slot() as outcome:
+                response = http_transport.post(f"{api_url}?key={API_KEY}", headers=headers, json=data, timeout=30)
+                outcome['status'] = response.status_code
+        except Exception as e:
+            error = e
+        
+        if show_debug and response is not None:
+            print(f"Debug - API Response status: {response.status_code}")
+            print(f"Debug - API Response preview: {response.text[:300]}...")
+        
+        # A record or a 404 (no data) is an answer
+        if response is not None and response.status_code in (200, 404):
+            break
+        
+        # Back off and retry, or give up when the error is permanent or the budget is spent
+        delay = retry_policy.next_delay(attempt, response, error)
+        if delay is None:
+            break
+        add_timing('retry_wait', delay)
+        time.sleep(delay)
+        attempt += 1
     
+    if error is not None:
+        print(f"Error fetching data for {label}: {error}")
+        return None
+    if response.status_code != 200:
+        print(f"Error fetching data for {label}: {response.status_code}")
+        with debug_lock:
+            if post_crux_query.counter <= 2:
+                print(f"Error response: {response.text}")
+                post_crux_query.counter += 1
+    return response
+
+# Function to get data from CrUX API for a specific URL (or origin, with level='origin'):
+# the response, {} when CrUX has no record of it (404), or None when the query failed
+def get_crux_data(url, form_factor, rate_limiter, level='url'):
     # Create payload based on form factor selection
-    if FORM_FACTOR:
+    if form_factor != 'ALL':
         data = {
-            'url': url,
-            'formFactor': FORM_FACTOR
+            level: url,
+            'formFactor': form_factor
         }
     else:
         data = {
-            'url': url
+            level: url
         }
     
-    # Debug info for first request
-    if not hasattr(get_crux_data, 'counter'):
-        get_crux_data.counter = 0
+    # Serve the response from the archive when re-extracting, or from the cache when it is still current
+    cache_key = url if level == 'url' else f"{level}:{url}"
+    if REEXTRACT:
+        return response_archive.get_latest(cache_key, form_factor)
+    if response_cache:
+        cached = response_cache.get(cache_key, form_factor)
+        if cached:
+            return cached
+        # Known-absent URLs are reported as "no data" without a network call
+        if response_cache.is_missing(cache_key, form_factor):
+            return {}
     
-    if get_crux_data.counter == 0:
-        print(f"\nDebug - API Request payload: {json.dumps(data)}")
-        print(f"Debug - Form factor selected: {FORM_FACTOR if FORM_FACTOR else 'ALL'}")
-    
-    response = requests.post(f"{API_URL}?key={API_KEY}", headers=headers, json=data)
+    response = post_crux_query(API_URL, data, rate_limiter)
+    if response is None:
+        return None
     
-    if get_crux_data.counter == 0:
-        print(f"Debug - API Response status: {response.status_code}")
-        print(f"Debug - API Response preview: {response.text[:300]}...")
-        get_crux_data.counter += 1
+    # 404 bodies are archived too, so re-extraction keeps the rows (and fallbacks) of URLs without data
+    if response_archive and response.status_code in (200, 404):
+        response_archive.put(cache_key, form_factor, response.content)
     
     if response.status_code == 200:
-        return response.json()
-    else:
-        print(f"Error fetching data for {url}: {response.status_code}")
-        if get_crux_data.counter <= 2:
-            print(f"Error response: {response.text}")
-            get_crux_data.counter += 1
-        return None
+        if response_cache:
+            response_cache.put(cache_key, form_factor, response.text)
+        start = time.perf_counter()
+        data = response.json()
+        add_timing('parse', time.perf_counter() - start)
+        return data
+    if response.status_code == 404:
+        if response_cache:
+            response_cache.put_missing(cache_key, form_factor)
+        return {}
+    return None
 
-# Function to determine if Core Web Vitals are passed
-def check_cwv_status(lcp_status, cls_status, inp_status):
-    if lcp_status == "good" and cls_status == "good" and inp_status == "good":
-        return "passed"
-    elif lcp_status == "unknown" or cls_status == "unknown" or inp_status == "unknown":
-        return "no data"
-    else:
-        return "failed"
+# Origin lookups shared by all URLs on the same host (one query per origin per run)
+origin_lock = threading.Lock()
+origin_lookups = {}
 
-# Function to categorize metrics as good, needs improvement, or poor
-def categorize_metric(metric_value, metric_type):
-    # Convert metric_value to float if it's not None
-    if metric_value is not None:
+# Function to get origin-level CrUX data, fetching each origin and form factor only once
+def get_origin_data(origin, form_factor, rate_limiter):
+    with origin_lock:
+        lookup = origin_lookups.get((origin, form_factor))
+        is_owner = lookup is None
+        if is_owner:
+            lookup = concurrent.futures.Future()
+            origin_lookups[(origin, form_factor)] = lookup
+    
+    # The first caller queries the API, concurrent callers wait for its result
+    if is_owner:
         try:
-            metric_value = float(metric_value)
-        except (ValueError, TypeError):
-            return "unknown"
-    else:
-        return "unknown"
+            lookup.set_result(get_crux_data(origin, form_factor, rate_limiter, level='origin'))
+        except Exception as e:
+            lookup.set_exception(e)
+    return lookup.result()
+
+# Function to get the CrUX History API time series for a URL or origin
+def get_crux_history(target, form_factor, rate_limiter):
+    data = {HISTORY_LEVEL: target}
+    if form_factor != 'ALL':
+        data['formFactor'] = form_factor
     
-    if metric_type == "LCP":
-        if metric_value <= 2500:
-            return "good"
-        elif metric_value <= 4000:
-            return "needs improvement"
-        else:
-            return "poor"
-    elif metric_type == "CLS":
-        if metric_value <= 0.1:
-            return "good"
-        elif metric_value <= 0.25:
-            return "needs improvement"
-        else:
-            return "poor"
-    elif metric_type == "FCP":
-        if metric_value <= 1800:
-            return "good"
-        elif metric_value <= 3000:
-            return "needs improvement"
-        else:
-            return "poor"
-    elif metric_type == "FID":
-        if metric_value <= 100:
-            return "good"
-        elif metric_value <= 300:
-            return "needs improvement"
-        else:
-            return "poor"
-    elif metric_type == "INP":
-        if metric_value <= 200:
-            return "good"
-        elif metric_value <= 500:
-            return "needs improvement"
-        else:
-            return "poor"
-    elif metric_type == "TTFB":
-        if metric_value <= 800:
-            return "good"
-        elif metric_value <= 1800:
-            return "needs improvement"
-        else:
-            return "poor"
-    return "unknown"
+    # History responses are archived next to the records under their own variant
+    variant = f"history:{form_factor}"
+    if REEXTRACT:
+        return response_archive.get_latest(target, variant)
+    
+    response = post_crux_query(HISTORY_API_URL, data, rate_limiter)
+    if response is not None and response.status_code == 200:
+        if response_archive:
+            response_archive.put(target, variant, response.content)
+        start = time.perf_counter()
+        data = response.json()
+        add_timing('parse', time.perf_counter() - start)
+        return data
+    return None
 
-# Function to extract metrics from CrUX data
-def extract_metrics(data):
-    if not data or 'record' not in data or 'metrics' not in data['record']:
-        return {
-            'lcp_value': None,
-            'lcp_good_pct': None,
-            'lcp_ni_pct': None,
-            'lcp_poor_pct': None,
-            
-            'cls_value': None,
-            'cls_good_pct': None,
-            'cls_ni_pct': None,
-            'cls_poor_pct': None,
-            
-            'fcp_value': None,
-            'fcp_good_pct': None,
-            'fcp_ni_pct': None,
-            'fcp_poor_pct': None,
-            
-            'fid_value': None,
-            'fid_good_pct': None,
-            'fid_ni_pct': None,
-            'fid_poor_pct': None,
+# Function to decode History API responses into a long-format DataFrame
+# (one row per target, metric and collection period)
+def history_to_frame(targets, responses):
+    import numpy as np
+    import pandas as pd
+    
+    columns = {name: [] for name in ['p75', 'good_pct', 'ni_pct', 'poor_pct']}
+    labels = {name: [] for name in [HISTORY_LEVEL, 'form_factor', 'metric', 'period_start', 'period_end']}
+    
+    for target, data in zip(targets, responses):
+        if not data or 'record' not in data:
+            continue
+        record = data['record']
+        form_factor = record.get('key', {}).get('formFactor', 'ALL')
+        periods = record.get('collectionPeriods', [])
+        n_periods = len(periods)
+        if not n_periods:
+            continue
+        
+        period_start = pd.to_datetime([f"{p['firstDate']['year']}-{p['firstDate']['month']}-{p['firstDate']['day']}" for p in periods])
+        period_end = pd.to_datetime([f"{p['lastDate']['year']}-{p['lastDate']['month']}-{p['lastDate']['day']}" for p in periods])
+        
+        for metric_key, prefix, _, _, _ in CRUX_METRICS:
+            metric = record.get('metrics', {}).get(metric_key)
+            if not metric:
+                continue
             
-            'inp_value': None,
-            'inp_good_pct': None,
-            'inp_ni_pct': None,
-            'inp_poor_pct': None,
+            # p75s and densities may contain strings (CLS) or "NaN"/None for periods without data
+            p75s = metric.get('percentilesTimeseries', {}).get('p75s', [None] * n_periods)
+            histogram = metric.get('histogramTimeseries', [])
+            densities = [pd.to_numeric(pd.Series(bin_.get('densities', [None] * n_periods)), errors='coerce').to_numpy() * 100
+                         for bin_ in histogram[:3]]
+            while len(densities) < 3:
+                densities.append(np.full(n_periods, np.nan))
             
-            'ttfb_value': None,
-            'ttfb_good_pct': None,
-            'ttfb_ni_pct': None,
-            'ttfb_poor_pct': None
-        }
+            columns['p75'].append(pd.to_numeric(pd.Series(p75s), errors='coerce').to_numpy())
+            columns['good_pct'].append(densities[0])
+            columns['ni_pct'].append(densities[1])
+            columns['poor_pct'].append(densities[2])
+            labels[HISTORY_LEVEL].append(np.repeat(target, n_periods))
+            labels['form_factor'].append(np.repeat(form_factor, n_periods))
+            labels['metric'].append(np.repeat(prefix.upper(), n_periods))
+            labels['period_start'].append(period_start)
+            labels['period_end'].append(period_end)
+    
+    if not columns['p75']:
+        return pd.DataFrame(columns=list(labels) + ['status'] + list(columns))
     
+    frame = {name: np.concatenate(parts) for name, parts in labels.items()}
+    frame.update({name: np.concatenate(parts) for name, parts in columns.items()})
+    df = pd.DataFrame(frame)
+    
+    # Categorize every period in one pass using the thresholds of its metric
+    good = df['metric'].map({prefix.upper(): good for _, prefix, _, good, _ in CRUX_METRICS})
+    poor = df['metric'].map({prefix.upper(): poor for _, prefix, _, _, poor in CRUX_METRICS})
+    status = np.select([df['p75'].isna(), df['p75'] <= good, df['p75'] <= poor],
+                       ['unknown', 'good', 'needs improvement'], default='poor')
+    df.insert(df.columns.get_loc('p75'), 'status', status)
+    return df
+
+# Function to extract metrics from CrUX data
+def extract_metrics(data):
     metrics = data['record']['metrics']
     results = {}
     
-    # Extract LCP
-    if 'largest_contentful_paint' in metrics:
-        lcp_metric = metrics['largest_contentful_paint']
-        results['lcp_value'] = lcp_metric.get('percentiles', {}).get('p75')
+    for metric_key, prefix, value_column, _, _ in CRUX_METRICS:
+        metric = metrics.get(metric_key, {})
+        results[value_column] = metric.get('percentiles', {}).get('p75')
         
         # Distribution
-        if 'histogram' in lcp_metric:
-            lcp_hist = lcp_metric['histogram']
-            results['lcp_good_pct'] = lcp_hist[0].get('density', 0) * 100
-            results['lcp_ni_pct'] = lcp_hist[1].get('density', 0) * 100
-            results['lcp_poor_pct'] = lcp_hist[2].get('density', 0) * 100
-        else:
-            results['lcp_good_pct'] = None
-            results['lcp_ni_pct'] = None
-            results['lcp_poor_pct'] = None
+        histogram = metric.get('histogram')
+        if histogram:
+            results[f'{prefix}_good_pct'] = histogram[0].get('density', 0) * 100
+            results[f'{prefix}_ni_pct'] = histogram[1].get('density', 0) * 100
+            results[f'{prefix}_poor_pct'] = histogram[2].get('density', 0) * 100
+    
+    # Extract device split (only present in responses for all form factors)
+    fractions = metrics.get('form_factors', {}).get('fractions', {})
+    for device in DEVICE_FORM_FACTORS:
+        if device in fractions:
+            results[f'{device}_share_pct'] = fractions[device] * 100
+    
+    return results
+
+# Function to categorize all metrics as good, needs improvement, or poor and determine
+# whether Core Web Vitals are passed, for the whole results table at once
+def categorize_results(df):
+    import numpy as np
+    import pandas as pd
+    
+    columns = ['url', 'form_factor', 'granularity', 'core_web_vitals_status']
+    for _, prefix, value_column, _, _ in CRUX_METRICS:
+        columns += [f'{prefix}_status', value_column, f'{prefix}_good_pct', f'{prefix}_ni_pct', f'{prefix}_poor_pct']
+    columns += [f'{device}_share_pct' for device in DEVICE_FORM_FACTORS]
+    
+    # Rows for URLs without a record get "no data", missing metrics in a record get "unknown"
+    no_record = ~df['has_record'].astype(bool)
+    df = df.reindex(columns=columns)
+    
+    for _, prefix, value_column, good, poor in CRUX_METRICS:
+        values = pd.to_numeric(df[value_column], errors='coerce')
+        df[value_column] = values
+        df[f'{prefix}_status'] = np.select(
+            [no_record, values.isna(), values <= good, values <= poor],
+            ['no data', 'unknown', 'good', 'needs improvement'],
+            default='poor')
+    
+    cwv_statuses = df[[f'{prefix}_status' for prefix in CWV_METRICS]]
+    df['core_web_vitals_status'] = np.select(
+        [no_record, (cwv_statuses == 'good').all(axis=1), (cwv_statuses == 'unknown').any(axis=1)],
+        ['no data', 'passed', 'no data'],
+        default='failed')
+    
+    return df
+
+# Function to process a single URL and form factor and return its result row
+def process_url(url, form_factor, rate_limiter):
+    data = get_crux_data(url, form_factor, rate_limiter)
+    granularity = 'url'
+    
+    # Fall back to the origin of the URL when CrUX has no record of the URL itself (an archived
+    # 404 body has no record either); a failed query stays a failure and is retried next time
+    if ORIGIN_FALLBACK and data is not None and 'record' not in data:
+        data = get_origin_data(get_origin(url), form_factor, rate_limiter)
+        granularity = 'origin'
+    
+    result = {
+        "url": url,
+        "form_factor": form_factor,
+        "granularity": granularity,
+        "has_record": False,
+    }
+    if data and 'record' in data and 'metrics' in data['record']:
+        result["has_record"] = True
+        start = time.perf_counter()
+        result.update(extract_metrics(data))
+        add_timing('extract', time.perf_counter() - start)
     else:
-        results['lcp_value'] = None
-        results['lcp_good_pct'] = None
-        results['lcp_ni_pct'] = None
-        results['lcp_poor_pct'] = None
-    
-    # Extract CLS
-    if 'cumulative_layout_shift' in metrics:
-        cls_metric = metrics['cumulative_layout_shift']
-        results['cls_value'] = cls_metric.get('percentiles', {}).get('p75')
-        
-        # Distribution
-        if 'histogram' in cls_metric:
-            cls_hist = cls_metric['histogram']
-            results['cls_good_pct'] = cls_hist[0].get('density', 0) * 100
-            results['cls_ni_pct'] = cls_hist[1].get('density', 0) * 100
-            results['cls_poor_pct'] = cls_hist[2].get('density', 0) * 100
-        else:
-            results['cls_good_pct'] = None
-            results['cls_ni_pct'] = None
-            results['cls_poor_pct'] = None
+        # Row for URLs that failed to fetch data
+        result["granularity"] = None
+    return result
+
+# Function to read a list of URLs (one URL per line)
+def read_url_list(content):
+    if isinstance(content, bytes):
+        content = content.decode('utf-8')
+    return [line.strip() for line in content.split('\n') if line.strip()]
+
+# Function to collect the URLs to analyze: from the archive, a given list or the sitemaps of a domain
+def collect_urls(urls=None, domain=None):
+    if REEXTRACT:
+        # Origin lookups are archived under "origin:<origin>" and are not report rows
+        urls = [url for url in response_archive.urls() if not url.startswith('origin:')]
+        print(f"Found {len(urls)} URLs in the archive '{ARCHIVE_DIR}'")
+        return urls
+    if urls is not None:
+        return urls
+    
+    print(f"\nFetching sitemap from {domain}...")
+    
+    # Get URLs from the sitemaps listed in robots.txt (or /sitemap.xml); the URLs are streamed,
+    # so the queries start while the sitemaps are still downloading
+    sitemaps = find_sitemaps(domain)
+    print(f"Reading {len(sitemaps)} sitemap(s): {', '.join(sitemaps)}")
+    urls = peek(url for url, lastmod, priority in iter_sitemap_urls(sitemaps))
+    
+    # If sitemap approach fails, use a few known pages
+    if not urls:
+        print("Couldn't get URLs from sitemap. Using domain and some common paths.")
+        urls = [
+            domain,
+            f"{domain}/about",
+            f"{domain}/contact",
+            f"{domain}/services",
+            f"{domain}/blog"
+        ]
+    return urls
+
+# Function to run a CrUX batch and return the results table; the output file is written to the
+# working directory (its name is in df.attrs['output_file']) and downloaded in Colab with download=True.
+# URLs come from `urls` (a list or an iterable), the lines of `url_file`, the sitemaps of `domain`
+# or, with reextract=True, the raw response archive. resume=None asks before resuming a journal.
+# With a work_queue (an SQLite file or a redis:// URL) the queries are sent by the workers of
+# that queue (run_crux_worker()) and this run collects their results into the output file.
+def run_crux_batch(urls=None, url_file=None, domain=None, reextract=False, max_urls=None,
+                   form_factors=('ALL',), device_split=False, mode='record', level='url',
+                   origin_fallback=False, resume=True, download=False, api_key=None, work_queue=None):
+    global API_KEY, CRUX_MODE, HISTORY_LEVEL, FORM_FACTORS, DEVICE_SPLIT, ORIGIN_FALLBACK, REEXTRACT
+    global url_index, response_archive, response_cache, request_metrics, concurrency_controller, retry_policy
+    import pandas as pd
+    
+    if api_key:
+        API_KEY = api_key
+    if mode not in ('record', 'history'):
+        raise ValueError(f"Unknown CrUX mode: {mode!r} (expected 'record' or 'history')")
+    if level not in ('url', 'origin'):
+        raise ValueError(f"Unknown history level: {level!r} (expected 'url' or 'origin')")
+    CRUX_MODE = mode
+    HISTORY_LEVEL = level if mode == 'history' else 'url'
+    DEVICE_SPLIT = bool(device_split) and mode == 'record'
+    FORM_FACTORS = ['ALL'] if DEVICE_SPLIT else [form_factor.upper() for form_factor in form_factors] or ['ALL']
+    ORIGIN_FALLBACK = bool(origin_fallback) and mode == 'record'
+    REEXTRACT = reextract
+    
+    # Fresh per-run state (the module can run several batches in one process)
+    url_index = UrlIndex(CANONICAL_RULES if CANONICALIZE_URLS else {})
+    origin_lookups.clear()
+    
+    # Re-extraction reads the archive instead of querying the API
+    response_archive = ResponseArchive(ARCHIVE_DIR) if ARCHIVE_ENABLED or REEXTRACT else None
+    
+    if url_file is not None:
+        with open(url_file, 'rb') as f:
+            urls = read_url_list(f.read())
+        print(f"Found {len(urls)} URLs in {url_file}")
+    if domain and not domain.startswith(('http://', 'https://')):
+        domain = 'https://' + domain
+    if urls is not None and not isinstance(urls, list):
+        # Sized collections are read at once, other iterables are streamed like a sitemap
+        urls = list(urls) if hasattr(urls, '__len__') else peek(iter(urls)) or []
+    if domain is None and isinstance(urls, list) and urls:
+        # Try to determine domain from first URL for naming the output file
+        domain = urls[0].replace('https://', '').replace('http://', '').split('/')[0]
+    if not REEXTRACT and urls is None and not domain:
+        raise ValueError("No URL source: pass urls, url_file, domain or reextract=True")
+    urls = collect_urls(urls, domain)
+    
+    # Check if we have URLs to process
+    if not urls:
+        print("No URLs found.")
+        return pd.DataFrame()
+    
+    # Query each page only once (duplicates are filled in from its result at the end)
+    if isinstance(urls, list):
+        urls = list(url_index.dedup(urls))
+        if url_index.duplicates:
+            print(f"Skipping {url_index.duplicates} duplicate URLs (same page after canonicalization)")
     else:
-        results['cls_value'] = None
-        results['cls_good_pct'] = None
-        results['cls_ni_pct'] = None
-        results['cls_poor_pct'] = None
-    
-    # Extract FCP
-    if 'first_contentful_paint' in metrics:
-        fcp_metric = metrics['first_contentful_paint']
-        results['fcp_value'] = fcp_metric.get('percentiles', {}).get('p75')
-        
-        # Distribution
-        if 'histogram' in fcp_metric:
-            fcp_hist = fcp_metric['histogram']
-            results['fcp_good_pct'] = fcp_hist[0].get('density', 0) * 100
-            results['fcp_ni_pct'] = fcp_hist[1].get('density', 0) * 100
-            results['fcp_poor_pct'] = fcp_hist[2].get('density', 0) * 100
-        else:
-            results['fcp_good_pct'] = None
-            results['fcp_ni_pct'] = None
-            results['fcp_poor_pct'] = None
+        urls = url_index.dedup(urls)
+    
+    # Limit URLs if needed
+    if max_urls:
+        if not isinstance(urls, list):
+            print(f"Limiting analysis to the first {max_urls} URLs of the sitemap.")
+            urls = itertools.islice(urls, max_urls)
+        elif max_urls < len(urls):
+            print(f"Limiting analysis to {max_urls} URLs out of {len(urls)} found.")
+            urls = urls[:max_urls]
+    
+    # Origin-level history queries each origin once
+    if HISTORY_LEVEL == 'origin':
+        urls = list(dict.fromkeys(get_origin(url) for url in urls))
+    
+    # Main process
+    if isinstance(urls, list):
+        print(f"\nStarting CrUX data collection for {len(urls)} {'origins' if HISTORY_LEVEL == 'origin' else 'URLs'}")
     else:
-        results['fcp_value'] = None
-        results['fcp_good_pct'] = None
-        results['fcp_ni_pct'] = None
-        results['fcp_poor_pct'] = None
-    
-    # Extract FID
-    if 'first_input_delay' in metrics:
-        fid_metric = metrics['first_input_delay']
-        results['fid_value'] = fid_metric.get('percentiles', {}).get('p75')
-        
-        # Distribution
-        if 'histogram' in fid_metric:
-            fid_hist = fid_metric['histogram']
-            results['fid_good_pct'] = fid_hist[0].get('density', 0) * 100
-            results['fid_ni_pct'] = fid_hist[1].get('density', 0) * 100
-            results['fid_poor_pct'] = fid_hist[2].get('density', 0) * 100
-        else:
-            results['fid_good_pct'] = None
-            results['fid_ni_pct'] = None
-            results['fid_poor_pct'] = None
+        print("\nStarting CrUX data collection for the URLs as they are read from the sitemap")
+    print(f"Using form factors: {', '.join(FORM_FACTORS)}")
+    print(f"Rate limit: {RATE_LIMIT_QUERIES} queries per {RATE_LIMIT_WINDOW} seconds (bursts of up to {RATE_LIMIT_BURST})")
+    if ADAPTIVE_CONCURRENCY:
+        print(f"Adaptive concurrency: starting at {INITIAL_CONCURRENCY}, up to {MAX_CONCURRENT_REQUESTS} requests in flight")
     else:
-        results['fid_value'] = None
-        results['fid_good_pct'] = None
-        results['fid_ni_pct'] = None
-        results['fid_poor_pct'] = None
-    
-    # Extract INP
-    if 'interaction_to_next_paint' in metrics:
-        inp_metric = metrics['interaction_to_next_paint']
-        results['inp_value'] = inp_metric.get('percentiles', {}).get('p75')
-        
-        # Distribution
-        if 'histogram' in inp_metric:
-            inp_hist = inp_metric['histogram']
-            results['inp_good_pct'] = inp_hist[0].get('density', 0) * 100
-            results['inp_ni_pct'] = inp_hist[1].get('density', 0) * 100
-            results['inp_poor_pct'] = inp_hist[2].get('density', 0) * 100
-        else:
-            results['inp_good_pct'] = None
-            results['inp_ni_pct'] = None
-            results['inp_poor_pct'] = None
+        print(f"Using {MAX_CONCURRENT_REQUESTS} concurrent requests")
+    
+    # Every selected form factor is queried for each URL in the same pass
+    # (tasks are read lazily, so streamed sitemap URLs are queried as soon as they arrive)
+    task_queue = ((url, form_factor) for url in urls for form_factor in FORM_FACTORS)
+    
+    # Prepare data structure (one slot per task keeps the output in input order)
+    tasks = []
+    results = []
+    url_positions = {}  # Position of every URL in the input
+    successful_urls = 0
+    completed_urls = 0
+    
+    # Initialize rate limiter, retry policy and response cache (the retry budget grows with every query)
+    rate_limiter = RateLimiter(RATE_LIMIT_QUERIES, RATE_LIMIT_WINDOW, RATE_LIMIT_BURST)
+    concurrency_controller = new_concurrency_controller(MAX_CONCURRENT_REQUESTS, rate_limiter)
+    retry_policy = RetryPolicy(MAX_RETRIES, RETRY_BASE_DELAY, RETRY_MAX_DELAY, 10)
+    response_cache = ResponseCache(CACHE_PATH, CACHE_TTL, CACHE_MAX_ENTRIES, NEGATIVE_CACHE_TTL) if CACHE_ENABLED else None
+    
+    # Latest-record mode builds one row per task, history mode keeps the raw responses for decoding
+    task = get_crux_history if CRUX_MODE == 'history' else process_url
+    
+    # Resume an interrupted run with the same settings and input, started since the last CrUX data
+    # refresh (older results belong to an older collection period); a streamed run is identified
+    # by its domain, as its URLs are only known once the sitemaps are read
+    run_journal = None
+    journaled = {}
+    if isinstance(urls, list):
+        input_digest = hashlib.sha256('\n'.join(urls).encode()).hexdigest()
     else:
-        results['inp_value'] = None
-        results['inp_good_pct'] = None
-        results['inp_ni_pct'] = None
-        results['inp_poor_pct'] = None
-    
-    # Extract TTFB
-    if 'experimental_time_to_first_byte' in metrics:
-        ttfb_metric = metrics['experimental_time_to_first_byte']
-        results['ttfb_value'] = ttfb_metric.get('percentiles', {}).get('p75')
+        input_digest = hashlib.sha256(json.dumps([domain, max_urls]).encode()).hexdigest()
+    journal_config = {'mode': CRUX_MODE, 'level': HISTORY_LEVEL if CRUX_MODE == 'history' else 'url',
+                      'form_factors': FORM_FACTORS, 'origin_fallback': ORIGIN_FALLBACK, 'device_split': DEVICE_SPLIT,
+                      'input': input_digest, 'data_refresh': last_crux_update()}
+    
+    # Distributed run: the queries go to the work queue (which also keeps the results of an interrupted run)
+    queue = None
+    queued = {}  # {task: future resolved when a worker writes its result}
+    outbox = []  # Tasks not pushed to the queue yet
+    cursor = 0
+    if work_queue and not REEXTRACT:
+        queue = open_work_queue(work_queue)
+        if queue.open_job(journal_config, resume is not False):
+            entries, cursor = queue.results_since(0)
+            journaled = dict(entries)
+            print(f"Resuming: {len(journaled)} results taken from the work queue '{work_queue}'")
+        print(f"Distributed run: queries are sent by the workers of '{work_queue}' (start them with --worker --work-queue)")
+    elif JOURNAL_ENABLED and not REEXTRACT:
+        run_journal = RunJournal(JOURNAL_PATH)
+        entries = run_journal.load(journal_config)
+        if entries and resume is None:
+            resume_choice = input(f"\nFound {len(entries)} results of an interrupted run with the same settings. Resume it? (Y/n): ")
+            resume = resume_choice.strip().lower() not in ('n', 'no')
+        if entries and resume:
+            journaled = {tuple(entry['task']): entry['result'] for entry in entries}
+            print(f"Resuming: {len(journaled)} results taken from the journal '{JOURNAL_PATH}'")
+        run_journal.start(journal_config, entries if journaled else ())
+    
+    # Phase timings of every query (written periodically while the run goes on)
+    request_metrics = RequestMetrics('crux', METRICS_PATH, METRICS_FORMAT, METRICS_BUCKETS)
+    if METRICS_ENABLED and not REEXTRACT and not queue:
+        request_metrics.start(METRICS_FLUSH_INTERVAL)
+    
+    start_time = time.time()
+    
+    # Use ThreadPoolExecutor for parallel processing
+    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS) as executor:
+        future_to_index = {}
+        pending = set()
+        follow_up_queries = 0
+        resumed = set()
         
-        # Distribution
-        if 'histogram' in ttfb_metric:
-            ttfb_hist = ttfb_metric['histogram']
-            results['ttfb_good_pct'] = ttfb_hist[0].get('density', 0) * 100
-            results['ttfb_ni_pct'] = ttfb_hist[1].get('density', 0) * 100
-            results['ttfb_poor_pct'] = ttfb_hist[2].get('density', 0) * 100
+        # Function to queue a query and reserve its slot in the results
+        # (journaled results of a resumed run are queued as already finished)
+        def submit(url, form_factor):
+            url_positions.setdefault(url, len(url_positions))
+            tasks.append((url, form_factor))
+            results.append(None)
+            if (url, form_factor) in journaled:
+                future = concurrent.futures.Future()
+                future.set_result(journaled[(url, form_factor)])
+                resumed.add(future)
+            elif queue:
+                future = concurrent.futures.Future()
+                queued[(url, form_factor)] = future
+                outbox.append((url, form_factor))
+            else:
+                retry_policy.extend_budget(RETRY_BUDGET_RATIO)
+                future = executor.submit(request_metrics.run, task, url, form_factor, rate_limiter,
+                                         queued_at=time.perf_counter(), url=url, form_factor=form_factor)
+            future_to_index[future] = len(tasks) - 1
+            pending.add(future)
+        
+        # Process results as they complete, keeping only a few waiting queries per worker
+        # (a distributed run keeps a batch of tasks ahead of the results in the queue)
+        max_pending = WORK_QUEUE_BATCH if queue else MAX_CONCURRENT_REQUESTS * 2
+        while True:
+            for url, form_factor in itertools.islice(task_queue, max(0, max_pending - len(pending))):
+                submit(url, form_factor)
+            if not pending:
+                break
+            if queue:
+                queue.push(outbox)
+                outbox.clear()
+                entries, cursor = queue.results_since(cursor)
+                for queued_task, result in entries:
+                    if queued_task in queued:
+                        queued.pop(queued_task).set_result(result)
+                    else:
+                        journaled[queued_task] = result  # Task of a resumed job that is submitted later
+            done, pending = concurrent.futures.wait(pending, timeout=WORK_QUEUE_POLL_INTERVAL if queue else None,
+                                                    return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                i = future_to_index[future]
+                result = future.result()
+                results[i] = result
+                completed_urls += 1
+                
+                # URLs without data are not journaled, so a resumed run tries them again
+                found = result['has_record'] if CRUX_MODE == 'record' else result is not None
+                if run_journal and found and future not in resumed:
+                    run_journal.write({'task': tasks[i], 'result': result})
+                if CRUX_MODE == 'history':
+                    if result:
+                        successful_urls += 1
+                elif result['has_record']:
+                    successful_urls += 1
+                
+                # Query devices with enough traffic share separately
+                if DEVICE_SPLIT and CRUX_MODE == 'record' and tasks[i][1] == 'ALL':
+                    for device, form_factor in DEVICE_FORM_FACTORS.items():
+                        share = result.get(f'{device}_share_pct')
+                        if share is not None and share >= DEVICE_SPLIT_THRESHOLD:
+                            submit(tasks[i][0], form_factor)
+                            follow_up_queries += 1
+                
+                # Provide progress update every 10 URLs
+                if completed_urls % 10 == 0:
+                    print(f"Progress: {completed_urls}/{len(tasks)} queries processed. Found {successful_urls} records in CrUX database.")
+    
+    # Keep the device rows next to the ALL row of their URL
+    if follow_up_queries:
+        order = sorted(range(len(tasks)), key=lambda i: url_positions[tasks[i][0]])
+        tasks = [tasks[i] for i in order]
+        results = [results[i] for i in order]
+    
+    elapsed_time = time.time() - start_time
+    
+    # Let the workers stop
+    if queue:
+        queue.finish()
+        queue.close()
+    
+    http_transport.close()
+    if request_metrics.active:
+        request_metrics.close()
+        print(f"\nRequest phases (metrics written to '{request_metrics.path}'):")
+        for line in request_metrics.summary():
+            print(f"  {line}")
+    if ADAPTIVE_CONCURRENCY and not queue:
+        print(f"Adaptive concurrency: {concurrency_controller.summary()}")
+    if retry_policy.retries:
+        print("Retries: " + ", ".join(f"{reason} x{count}" for reason, count in retry_policy.retries.most_common()))
+    if retry_policy.failures:
+        print("Failed requests: " + ", ".join(f"{reason} x{count}" for reason, count in retry_policy.failures.most_common()))
+    if response_cache:
+        response_cache.close()
+    if response_archive:
+        response_archive.close()
+    
+    domain_name = domain.replace('https://', '').replace('http://', '').replace('www.', '').split('/')[0] if domain else "custom"
+    form_factor_str = '-'.join(FORM_FACTORS)
+    
+    if CRUX_MODE == 'history':
+        # Decode the time series into one row per target, metric and collection period
+        df = history_to_frame([target for target, form_factor in tasks], results)
+        if HISTORY_LEVEL == 'url':
+            df = fan_out(df)
+        
+        history_filename = f"crux_history_{domain_name}_{HISTORY_LEVEL}_{form_factor_str}_{time.strftime('%Y%m%d_%H%M%S')}"
+        if HISTORY_OUTPUT_FORMAT == 'parquet':
+            history_filename += '.parquet'
+            df.to_parquet(history_filename, index=False)
         else:
-            results['ttfb_good_pct'] = None
-            results['ttfb_ni_pct'] = None
-            results['ttfb_poor_pct'] = None
+            history_filename += '.csv'
+            df.to_csv(history_filename, index=False)
+        df.attrs['output_file'] = history_filename
+        
+        # Download the output file
+        if download:
+            from google.colab import files
+            files.download(history_filename)
+        if run_journal:
+            run_journal.finish()
+        
+        print("\nProcessing complete!")
+        print(f"Processed {len(url_positions)} {'origins' if HISTORY_LEVEL == 'origin' else 'URLs'}")
+        print(f"Found history for {successful_urls} of {len(tasks)} queries in CrUX database")
+        print(f"Rows written: {len(df)} ({df['period_end'].nunique() if len(df) else 0} collection periods)")
+        print(f"File '{history_filename}' has been {'downloaded' if download else 'saved'}.")
+        print(f"Form factors used: {', '.join(FORM_FACTORS)}")
+        print(f"Processing time: {elapsed_time:.1f} seconds ({elapsed_time/60:.1f} minutes)")
+        return df
+    
+    # Create DataFrame and categorize all metrics in one pass
+    df = categorize_results(pd.DataFrame(results))
+    
+    # One row per input URL and form factor: duplicates get the row of the URL that was queried
+    df = fan_out(df)
+    
+    # Save to CSV
+    csv_filename = f"crux_data_{domain_name}_{form_factor_str}_{time.strftime('%Y%m%d_%H%M%S')}.csv"
+    df.to_csv(csv_filename, index=False)
+    df.attrs['output_file'] = csv_filename
+    
+    # Download the CSV file
+    if download:
+        from google.colab import files
+        files.download(csv_filename)
+    if run_journal:
+        run_journal.finish()
+    
+    print(f"\nProcessing complete!")
+    print(f"Processed {len(url_positions)} URLs ({len(tasks)} queries)")
+    if url_index.duplicates:
+        print(f"Duplicate URLs answered without a query: {url_index.duplicates}")
+    print(f"Found {successful_urls} records in CrUX database")
+    print(f"CSV file '{csv_filename}' has been downloaded.")
+    print(f"Form factors used: {', '.join(FORM_FACTORS)}")
+    print(f"Processing time: {elapsed_time:.1f} seconds ({elapsed_time/60:.1f} minutes)")
+    if response_cache:
+        lookups = response_cache.hits + response_cache.misses
+        print(f"Cache: {response_cache.hits} hits, {response_cache.misses} misses "
+              f"({response_cache.hits/lookups*100 if lookups else 0:.1f}% hit rate)")
+        print(f"Known-absent URLs skipped: {response_cache.negative_hits}")
+    if ORIGIN_FALLBACK:
+        origin_rows = len(df[df['granularity'] == 'origin'])
+        print(f"Origin-level fallback: {origin_rows} URLs using data from {len(origin_lookups)} origin queries")
+    if DEVICE_SPLIT:
+        print(f"Device split: {follow_up_queries} per-device queries "
+              f"(instead of {len(url_positions) * len(DEVICE_FORM_FACTORS)} for every device and URL)")
+
+    # Print summary of results
+    if successful_urls > 0:
+        passed = len(df[df['core_web_vitals_status'] == 'passed'])
+        failed = len(df[df['core_web_vitals_status'] == 'failed'])
+        no_data = len(df[df['core_web_vitals_status'] == 'no data'])
+    
+        print("\nCore Web Vitals Summary:")
+        print(f"Passed: {passed} ({passed/len(df)*100:.1f}%)")
+        print(f"Failed: {failed} ({failed/len(df)*100:.1f}%)")
+        print(f"No data: {no_data} ({no_data/len(df)*100:.1f}%)")
+    
+        # Break the pass rate down when several form factors were collected
+        if df['form_factor'].nunique() > 1:
+            for form_factor in df['form_factor'].unique():
+                ff_df = df[df['form_factor'] == form_factor]
+                ff_passed = len(ff_df[ff_df['core_web_vitals_status'] == 'passed'])
+                print(f"  {form_factor}: {ff_passed} of {len(ff_df)} passed ({ff_passed/len(ff_df)*100:.1f}%)")
+    
+        # Print metric-specific summaries
+        print("\nMetric Performance Summary:")
+    
+        # Core Web Vitals summaries
+        for prefix in CWV_METRICS:
+            status_counts = df[f'{prefix}_status'].value_counts()
+            print(f"{prefix.upper()}: {status_counts.get('good', 0)} good, "
+                  f"{status_counts.get('needs improvement', 0)} needs improvement, {status_counts.get('poor', 0)} poor")
     else:
-        results['ttfb_value'] = None
-        results['ttfb_good_pct'] = None
-        results['ttfb_ni_pct'] = None
-        results['ttfb_poor_pct'] = None
+        print("\nNo URLs with CrUX data were found. Possible reasons:")
+        print("1. The URLs may not have enough traffic to be included in CrUX")
+        print("2. The selected form factor may not have sufficient data")
+        print("3. There might be an issue with the API key or request format")
     
-    return results
+        print("\nTry these solutions:")
+        print("- Use 'All form factors' instead of a specific device type")
+        print("- Check that your API key has access to the Chrome UX Report API")
+        print("- Verify the URLs are publicly accessible and have been for at least 28 days")
+        print("- Try more popular URLs from the site that are likely to have more traffic")
+    return df
 
-# Main process
-print(f"\nStarting CrUX data collection for {len(urls)} URLs")
+# Function to lease tasks from a work queue, run them on a thread pool and write their results
+# back until the coordinator finishes the job (leases are renewed while their tasks run)
+def process_work_queue(work_queue, worker_id, run_task, failed_result):
+    running = {}  # {future: (task id, task)}
+    processed = 0
+    last_renewal = time.monotonic()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS) as executor:
+        while True:
+            # Lease only what the current concurrency limit can start, leaving the rest to other workers
+            for task_id, task in work_queue.lease(worker_id, int(concurrency_controller.limit) + 1 - len(running), LEASE_TIMEOUT):
+                running[executor.submit(run_task, task)] = (task_id, task)
+            if not running:
+                if work_queue.finished():
+                    return processed
+                time.sleep(WORK_QUEUE_POLL_INTERVAL)
+                continue
+            
+            done, _ = concurrent.futures.wait(running, timeout=WORK_QUEUE_POLL_INTERVAL,
+                                              return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                task_id, task = running.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    print(f"Task {task} failed: {e}")
+                    result = failed_result(task)
+                work_queue.complete(task_id, result)
+                processed += 1
+                if processed % 10 == 0:
+                    print(f"Progress: {processed} tasks processed by {worker_id}")
+            
+            if running and time.monotonic() - last_renewal > LEASE_TIMEOUT / 3:
+                work_queue.renew(worker_id, [task_id for task_id, _ in running.values()], LEASE_TIMEOUT)
+                last_renewal = time.monotonic()
 
-# Prepare data structure
-results = []
-successful_urls = 0
+# Function to wait for the coordinator of a distributed run to open its job and return the job settings
+# (a finished job left in the queue by an earlier run is not worked on)
+def wait_for_job(work_queue):
+    while True:
+        config = work_queue.job_config()
+        if config is not None and not work_queue.finished():
+            return config
+        time.sleep(WORK_QUEUE_POLL_INTERVAL)
 
-# Process each URL
-for i, url in enumerate(urls):
-    print(f"Processing {i+1}/{len(urls)}: {url}")
+# Function to run a worker of a distributed run: it leases queries from the work queue of a
+# coordinator (run_crux_batch() with work_queue), sends them with its own API key, rate limit and
+# cache, and writes the results back until the coordinator has all of them
+def run_crux_worker(work_queue, worker_id=None, api_key=None):
+    global API_KEY, CRUX_MODE, HISTORY_LEVEL, FORM_FACTORS, ORIGIN_FALLBACK, REEXTRACT
+    global response_archive, response_cache, request_metrics, concurrency_controller, retry_policy
     
-    # Debug output for first URL to confirm form factor setting
-    if i == 0:
-        print(f"Using form factor: {FORM_FACTOR if FORM_FACTOR else 'ALL'}")
+    if api_key:
+        API_KEY = api_key
+    worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+    queue = open_work_queue(work_queue)
     
-    data = get_crux_data(url)
-    if data and 'record' in data and 'metrics' in data['record']:
-        successful_urls += 1
-        metrics_data = extract_metrics(data)
-        
-        # Categorize metrics
-        lcp_status = categorize_metric(metrics_data['lcp_value'], "LCP")
-        cls_status = categorize_metric(metrics_data['cls_value'], "CLS")
-        fcp_status = categorize_metric(metrics_data['fcp_value'], "FCP")
-        fid_status = categorize_metric(metrics_data['fid_value'], "FID")
-        inp_status = categorize_metric(metrics_data['inp_value'], "INP")
-        ttfb_status = categorize_metric(metrics_data['ttfb_value'], "TTFB")
-        
-        # Determine Core Web Vitals status (using INP instead of FID as per 2024 CWV)
-        cwv_status = check_cwv_status(lcp_status, cls_status, inp_status)
+    # The coordinator's settings decide what each query asks for
+    config = wait_for_job(queue)
+    CRUX_MODE = config['mode']
+    HISTORY_LEVEL = config['level']
+    FORM_FACTORS = config['form_factors']
+    ORIGIN_FALLBACK = config['origin_fallback']
+    REEXTRACT = False
+    origin_lookups.clear()
+    response_archive = ResponseArchive(ARCHIVE_DIR) if ARCHIVE_ENABLED else None
+    response_cache = ResponseCache(CACHE_PATH, CACHE_TTL, CACHE_MAX_ENTRIES, NEGATIVE_CACHE_TTL) if CACHE_ENABLED else None
+    rate_limiter = RateLimiter(RATE_LIMIT_QUERIES, RATE_LIMIT_WINDOW, RATE_LIMIT_BURST)
+    concurrency_controller = new_concurrency_controller(MAX_CONCURRENT_REQUESTS, rate_limiter)
+    retry_policy = RetryPolicy(MAX_RETRIES, RETRY_BASE_DELAY, RETRY_MAX_DELAY, 10)
+    request_metrics = RequestMetrics('crux', METRICS_PATH, METRICS_FORMAT, METRICS_BUCKETS)
+    if METRICS_ENABLED:
+        request_metrics.start(METRICS_FLUSH_INTERVAL)
+    task = get_crux_history if CRUX_MODE == 'history' else process_url
+    print(f"Worker {worker_id}: sending {CRUX_MODE} queries from '{work_queue}'")
+    
+    # The retry budget grows with every query, as in a streamed run
+    def run_task(entry):
+        url, form_factor = entry
+        retry_policy.extend_budget(RETRY_BUDGET_RATIO)
+        return request_metrics.run(task, url, form_factor, rate_limiter, url=url, form_factor=form_factor)
+    
+    # A query that raised is reported like a URL without data
+    def failed_result(entry):
+        if CRUX_MODE == 'history':
+            return None
+        return {"url": entry[0], "form_factor": entry[1], "granularity": None, "has_record": False}
+    
+    start_time = time.time()
+    processed = process_work_queue(queue, worker_id, run_task, failed_result)
+    elapsed_time = time.time() - start_time
+    
+    queue.close()
+    http_transport.close()
+    if request_metrics.active:
+        request_metrics.close()
+    if response_cache:
+        response_cache.close()
+    if response_archive:
+        response_archive.close()
+    print(f"Worker {worker_id}: {processed} queries in {elapsed_time:.1f} seconds")
+    if ADAPTIVE_CONCURRENCY:
+        print(f"Adaptive concurrency: {concurrency_controller.summary()}")
+    return processed
+
+# Function to upload the URL list file: the Colab upload dialog, or a local path outside Colab
+def upload_url_list():
+    try:
+        from google.colab import files
+    except ImportError:
+        path = input("\nEnter the path of a text file with URLs (one URL per line): ").strip()
+        if not path:
+            return None, None
+        with open(path, 'rb') as f:
+            return os.path.basename(path), f.read()
+    
+    print("\nPlease upload a text file containing URLs (one URL per line):")
+    uploaded = files.upload()
+    if not uploaded:
+        return None, None
+    file_name = list(uploaded.keys())[0]
+    return file_name, uploaded[file_name]
+
+# Function to ask the settings of a run interactively (the Colab front-end);
+# returns the keyword arguments of run_crux_batch()
+def ask_settings():
+    settings = {'resume': None}
+    
+    # Ask user how to collect URLs
+    print("How would you like to collect URLs for analysis?")
+    print("1. Fetch URLs from a website's sitemap")
+    print("2. Upload a text file with URLs (one URL per line)")
+    print("3. Re-extract results from the raw response archive (no API calls)")
+    url_source_choice = input("Enter your choice (1, 2 or 3): ")
+    
+    if url_source_choice == '3':
+        settings['reextract'] = True
+    elif url_source_choice == '2':
+        file_name, file_content = upload_url_list()
+        if not file_name:
+            print("No file was uploaded. Please run the script again.")
+            raise SystemExit
+        settings['urls'] = read_url_list(file_content)
+        print(f"Found {len(settings['urls'])} URLs in {file_name}")
+    else:
+        # Default to option 1 (sitemap) if anything else is entered
+        settings['domain'] = input("\nEnter the domain to analyze (e.g., https://www.example.com): ")
+    
+    # Limit URLs if needed
+    max_urls = input("\nEnter maximum number of URLs to analyze (leave blank for all): ")
+    if max_urls.strip() and max_urls.isdigit():
+        settings['max_urls'] = int(max_urls)
+    
+    # Form factor selection
+    print("\nSelect form factor for CrUX data:")
+    print("1. All form factors (Default)")
+    print("2. Mobile only (PHONE)")
+    print("3. Desktop only (DESKTOP)")
+    print("4. Tablet only (TABLET)")
+    print("5. Each of the above in a single pass (ALL, PHONE, DESKTOP, TABLET)")
+    print("6. All form factors, plus device queries only where the device has enough traffic")
+    print("Several choices can be combined, e.g. 2,3 for mobile and desktop")
+    
+    form_factor_choice = input("Enter your choice (1-6): ").strip()
+    
+    settings['device_split'] = form_factor_choice == '6'
+    if form_factor_choice == '5':
+        selected_choices = list(FORM_FACTOR_OPTIONS)
+    elif settings['device_split']:
+        selected_choices = ['1']
+        print(f"Selected: All form factors, plus per-device data for devices with at least {DEVICE_SPLIT_THRESHOLD}% share")
+    else:
+        selected_choices = [choice.strip() for choice in form_factor_choice.split(',') if choice.strip()]
+    
+    form_factors = []
+    for choice in selected_choices:
+        if choice in FORM_FACTOR_OPTIONS and FORM_FACTOR_OPTIONS[choice][0] not in form_factors:
+            form_factors.append(FORM_FACTOR_OPTIONS[choice][0])
+            print(f"Selected: {FORM_FACTOR_OPTIONS[choice][1]}")
+    
+    if not form_factors:
+        form_factors = ['ALL']
+        if form_factor_choice:
+            # For any other invalid input
+            print("Invalid choice. Defaulting to: All form factors")
+        else:
+            print("Selected: All form factors")
+    settings['form_factors'] = form_factors
+    
+    # Dataset selection
+    print("\nSelect CrUX dataset:")
+    print("1. Latest 28-day record (Default)")
+    print("2. History - weekly time series of the last 25 collection periods")
+    dataset_choice = input("Enter your choice (1 or 2): ").strip()
+    
+    if dataset_choice == '2':
+        settings['mode'] = 'history'
+        print("Selected: CrUX History API")
         
-        # Get form factor from response or use selected form factor
-        form_factor = data.get('record', {}).get('key', {}).get('formFactor', FORM_FACTOR if FORM_FACTOR else "ALL")
+        print("\nQuery history for:")
+        print("1. Each URL (Default)")
+        print("2. Each origin (URLs are grouped by origin)")
+        level_choice = input("Enter your choice (1 or 2): ").strip()
         
-        results.append({
-            "url": url,
-            "form_factor": form_factor,
-            "core_web_vitals_status": cwv_status,
-            
-            "lcp_status": lcp_status,
-            "lcp_value_ms": metrics_data['lcp_value'],
-            "lcp_good_pct": metrics_data['lcp_good_pct'],
-            "lcp_ni_pct": metrics_data['lcp_ni_pct'],
-            "lcp_poor_pct": metrics_data['lcp_poor_pct'],
-            
-            "cls_status": cls_status,
-            "cls_value": metrics_data['cls_value'],
-            "cls_good_pct": metrics_data['cls_good_pct'],
-            "cls_ni_pct": metrics_data['cls_ni_pct'],
-            "cls_poor_pct": metrics_data['cls_poor_pct'],
-            
-            "fcp_status": fcp_status,
-            "fcp_value_ms": metrics_data['fcp_value'],
-            "fcp_good_pct": metrics_data['fcp_good_pct'],
-            "fcp_ni_pct": metrics_data['fcp_ni_pct'],
-            "fcp_poor_pct": metrics_data['fcp_poor_pct'],
-            
-            "fid_status": fid_status,
-            "fid_value_ms": metrics_data['fid_value'],
-            "fid_good_pct": metrics_data['fid_good_pct'],
-            "fid_ni_pct": metrics_data['fid_ni_pct'],
-            "fid_poor_pct": metrics_data['fid_poor_pct'],
-            
-            "inp_status": inp_status,
-            "inp_value_ms": metrics_data['inp_value'],
-            "inp_good_pct": metrics_data['inp_good_pct'],
-            "inp_ni_pct": metrics_data['inp_ni_pct'],
-            "inp_poor_pct": metrics_data['inp_poor_pct'],
-            
-            "ttfb_status": ttfb_status,
-            "ttfb_value_ms": metrics_data['ttfb_value'],
-            "ttfb_good_pct": metrics_data['ttfb_good_pct'],
-            "ttfb_ni_pct": metrics_data['ttfb_ni_pct'],
-            "ttfb_poor_pct": metrics_data['ttfb_poor_pct']
-        })
+        if level_choice == '2':
+            settings['level'] = 'origin'
+            print("Selected: Origin-level history (URLs are grouped by origin)")
+        else:
+            print("Selected: URL-level history")
     else:
-        # Add a row for URLs that failed to fetch data
-        results.append({
-            "url": url,
-            "form_factor": FORM_FACTOR if FORM_FACTOR else "ALL",
-            "core_web_vitals_status": "no data",
-            
-            "lcp_status": "no data",
-            "lcp_value_ms": None,
-            "lcp_good_pct": None,
-            "lcp_ni_pct": None,
-            "lcp_poor_pct": None,
-            
-            "cls_status": "no data",
-            "cls_value": None,
-            "cls_good_pct": None,
-            "cls_ni_pct": None,
-            "cls_poor_pct": None,
-            
-            "fcp_status": "no data",
-            "fcp_value_ms": None,
-            "fcp_good_pct": None,
-            "fcp_ni_pct": None,
-            "fcp_poor_pct": None,
-            
-            "fid_status": "no data",
-            "fid_value_ms": None,
-            "fid_good_pct": None,
-            "fid_ni_pct": None,
-            "fid_poor_pct": None,
-            
-            "inp_status": "no data",
-            "inp_value_ms": None,
-            "inp_good_pct": None,
-            "inp_ni_pct": None,
-            "inp_poor_pct": None,
-            
-            "ttfb_status": "no data",
-            "ttfb_value_ms": None,
-            "ttfb_good_pct": None,
-            "ttfb_ni_pct": None,
-            "ttfb_poor_pct": None
-        })
-    
-    # Add a small delay to avoid rate limiting
-    time.sleep(1)
-    
-    # Provide progress update every 10 URLs
-    if (i + 1) % 10 == 0:
-        print(f"Progress: {i+1}/{len(urls)} URLs processed. Found {successful_urls} URLs in CrUX database.")
-
-# Create DataFrame
-df = pd.DataFrame(results)
-
-# Save to CSV
-form_factor_str = FORM_FACTOR if FORM_FACTOR else "ALL"
-domain_name = domain.replace('https://', '').replace('http://', '').replace('www.', '').split('/')[0] if domain else "custom"
-csv_filename = f"crux_data_{domain_name}_{form_factor_str}_{time.strftime('%Y%m%d_%H%M%S')}.csv"
-df.to_csv(csv_filename, index=False)
-
-# Download the CSV file
-files.download(csv_filename)
-
-print(f"\nProcessing complete!")
-print(f"Processed {len(urls)} URLs")
-print(f"Found {successful_urls} URLs in CrUX database")
-print(f"CSV file '{csv_filename}' has been downloaded.")
-print(f"Form factor used: {FORM_FACTOR if FORM_FACTOR else 'ALL'}")
-
-# Print summary of results
-if successful_urls > 0:
-    passed = len(df[df['core_web_vitals_status'] == 'passed'])
-    failed = len(df[df['core_web_vitals_status'] == 'failed'])
-    no_data = len(df[df['core_web_vitals_status'] == 'no data'])
-    
-    print("\nCore Web Vitals Summary:")
-    print(f"Passed: {passed} ({passed/len(urls)*100:.1f}%)")
-    print(f"Failed: {failed} ({failed/len(urls)*100:.1f}%)")
-    print(f"No data: {no_data} ({no_data/len(urls)*100:.1f}%)")
-    
-    # Print metric-specific summaries
-    print("\nMetric Performance Summary:")
-    
-    # LCP Summary
-    lcp_good = df[df['lcp_status'] == 'good'].shape[0]
-    lcp_ni = df[df['lcp_status'] == 'needs improvement'].shape[0]
-    lcp_poor = df[df['lcp_status'] == 'poor'].shape[0]
-    print(f"LCP: {lcp_good} good, {lcp_ni} needs improvement, {lcp_poor} poor")
-    
-    # CLS Summary
-    cls_good = df[df['cls_status'] == 'good'].shape[0]
-    cls_ni = df[df['cls_status'] == 'needs improvement'].shape[0]
-    cls_poor = df[df['cls_status'] == 'poor'].shape[0]
-    print(f"CLS: {cls_good} good, {cls_ni} needs improvement, {cls_poor} poor")
-    
-    # INP Summary (new Core Web Vital)
-    inp_good = df[df['inp_status'] == 'good'].shape[0]
-    inp_ni = df[df['inp_status'] == 'needs improvement'].shape[0]
-    inp_poor = df[df['inp_status'] == 'poor'].shape[0]
-    print(f"INP: {inp_good} good, {inp_ni} needs improvement, {inp_poor} poor")
-else:
-    print("\nNo URLs with CrUX data were found. Possible reasons:")
-    print("1. The URLs may not have enough traffic to be included in CrUX")
-    print("2. The selected form factor may not have sufficient data")
-    print("3. There might be an issue with the API key or request format")
-    
-    print("\nTry these solutions:")
-    print("- Use 'All form factors' instead of a specific device type")
-    print("- Check that your API key has access to the Chrome UX Report API")
-    print("- Verify the URLs are publicly accessible and have been for at least 28 days")
-    print("- Try more popular URLs from the site that are likely to have more traffic")
+        print("Selected: Latest 28-day record")
+        
+        fallback_choice = input("\nUse origin-level data for URLs without a CrUX record? (y/N): ").strip().lower()
+        settings['origin_fallback'] = fallback_choice in ('y', 'yes')
+        if settings['origin_fallback']:
+            print("Selected: Origin-level fallback for URLs without data")
+    return settings
+
+# Command line entry point: without arguments (and always in a notebook) the settings are asked
+# interactively, otherwise they come from the flags and/or a JSON config file with the keyword
+# arguments of run_crux_batch(), e.g.
+#   python batch-crux-api.py --sitemap https://www.example.com --form-factors PHONE,DESKTOP --max-urls 500
+#   python batch-crux-api.py --config crux.json --api-key "$CRUX_API_KEY"
+def main(argv=None):
+    import argparse
+    
+    if argv is None:
+        argv = [] if 'ipykernel' in sys.modules else sys.argv[1:]
+    if not argv:
+        settings = ask_settings()
+        run_crux_batch(**settings, download='google.colab' in sys.modules)
+        return
+    
+    parser = argparse.ArgumentParser(description="Query the CrUX API for a batch of URLs and export the results.")
+    parser.add_argument('--config', help="JSON file with the keyword arguments of run_crux_batch() (flags override it)")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument('--sitemap', dest='domain', help="Domain whose sitemaps are read")
+    source.add_argument('--url-file', help="Text file with URLs (one URL per line)")
+    source.add_argument('--reextract', action='store_true', default=None, help="Re-extract results from the raw response archive")
+    parser.add_argument('--max-urls', type=int, help="Maximum number of URLs to analyze")
+    parser.add_argument('--form-factors', type=lambda value: value.split(','), help="Comma-separated list: ALL, PHONE, DESKTOP, TABLET")
+    parser.add_argument('--device-split', action='store_true', default=None, help="ALL plus device queries where the device has enough traffic")
+    parser.add_argument('--mode', choices=['record', 'history'], help="Latest 28-day record (default) or weekly history")
+    parser.add_argument('--level', choices=['url', 'origin'], help="History per URL (default) or per origin")
+    parser.add_argument('--origin-fallback', action='store_true', default=None, help="Use origin-level data for URLs without a record")
+    parser.add_argument('--no-resume', dest='resume', action='store_false', default=None, help="Start over instead of resuming an interrupted run")
+    parser.add_argument('--api-key', help="CrUX API key (default: the API_KEY constant)")
+    parser.add_argument('--work-queue', help="Work queue of a distributed run (SQLite file or redis:// URL): "
+                                             "the run's queries are sent by the workers of the queue")
+    parser.add_argument('--worker', action='store_true', default=None, help="Work on the queries of --work-queue")
+    args = vars(parser.parse_args(argv))
+    
+    settings = {}
+    config = args.pop('config')
+    if config:
+        with open(config) as f:
+            settings.update(json.load(f))
+    settings.update({name: value for name, value in args.items() if value is not None})
+    if settings.pop('worker', False):
+        if not settings.get('work_queue'):
+            parser.error("--worker needs --work-queue")
+        run_crux_worker(settings['work_queue'], api_key=settings.get('api_key'))
+        return
+    run_crux_batch(**settings)
+
+if __name__ == '__main__':
+    main()
@@ -1,134 +1,1057 @@
-import requests
 import json
-import pandas as pd
 import time
-from google.colab import files
+import sys
+import bisect
+import contextlib
+import contextvars
 import concurrent.futures
 import threading
+import collections
+import queue
+import itertools
+import zlib
+import xml.etree.ElementTree as ET
+import random
+import email.utils
+import asyncio
+import os
+import gzip
+import hashlib
+import sqlite3
+import socket
+import datetime
 import math
-from tqdm.notebook import tqdm
 import re
+import fnmatch
+from urllib.parse import urlsplit, urlunsplit
+
+try:
+    import orjson  # Faster JSON decoding for large Lighthouse payloads
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
 
 # Constants
 API_KEY = 'YOUR_API_KEY'  # Replace with your actual API key
 API_URL = 'https://www.googleapis.com/pagespeedonline/v5/runPagespeed'
+USE_FIELDS_MASK = True  # Only download the fields the report uses (full responses are often 1-5 MB)
+ARCHIVE_ENABLED = False  # Keep every full raw response, so new columns can be re-extracted offline
+ARCHIVE_DIR = 'psi_archive'
+JOURNAL_ENABLED = True              # Write every result to a journal so interrupted runs can be resumed
+JOURNAL_PATH = 'psi_journal.jsonl'
+AUDIT_INDEX_PATH = 'psi_audit_index.sqlite'  # Last audit of every URL, used by the incremental mode
+INCREMENTAL_MAX_AGE = 30 * 24 * 60 * 60      # Unchanged URLs are still re-audited after this many seconds
 
-# Ask user how to collect URLs
-print("How would you like to collect URLs for analysis?")
-print("1. Fetch URLs from a website's sitemap")
-print("2. Upload a text file with URLs (one URL per line)")
-url_source_choice = input("Enter your choice (1 or 2): ")
+# URL canonicalization rules: variants of the same page are queried once and the result is
+# copied to every variant in the output (set CANONICALIZE_URLS = False to only drop exact duplicates)
+CANONICALIZE_URLS = True
+CANONICAL_RULES = {
+    'force_https': True,           # http:// and https:// variants are the same page
+    'lowercase_host': True,        # Host names are case-insensitive
+    'strip_default_port': True,    # :80 and :443
+    'strip_fragment': True,        # #section is never sent to the server
+    'strip_trailing_slash': True,  # /page/ and /page (the root path stays /)
+    'strip_query_params': ['utm_*', 'gclid', 'fbclid', 'msclkid', 'dclid', 'mc_cid', 'mc_eid', '_ga', '_gl'],
+}
 
-urls = []
-domain = None
+# Lab metrics: Lighthouse audit and column prefix (lab_<prefix>_score / lab_<prefix>_value)
+LAB_METRICS = [
+    ('largest-contentful-paint', 'lcp'),
+    ('cumulative-layout-shift', 'cls'),
+    ('first-contentful-paint', 'fcp'),
+    ('total-blocking-time', 'tbt'),
+    ('interactive', 'tti'),
+    ('speed-index', 'si'),
+]
 
-if url_source_choice == '1':
-    # Get domain for sitemap
-    domain = input("\nEnter the domain to analyze (e.g., https://www.example.com): ")
-    if not domain.startswith(('http://', 'https://')):
-        domain = 'https://' + domain
-    
-    print(f"\nFetching sitemap from {domain}...")
+# Lighthouse audits and field metrics read from the response; the fields mask is built from these
+LAB_AUDITS = [audit for audit, _ in LAB_METRICS]
+FIELD_METRICS = ['LARGEST_CONTENTFUL_PAINT_MS', 'CUMULATIVE_LAYOUT_SHIFT_SCORE', 'FIRST_INPUT_DELAY_MS']
+
+# Rate limiting constants
+RATE_LIMIT_QUERIES = 20  # PSI API has a limit of ~20 queries per minute
+RATE_LIMIT_WINDOW = 60   # 60 seconds window
+RATE_LIMIT_BURST = 5      # Requests that may start back-to-back before the steady rate applies
+MAX_CONCURRENT_REQUESTS = 16  # Upper bound of requests in flight (the adaptive controller finds the level in use)
+
+# Adaptive concurrency constants (AIMD): requests in flight grow by one per round of successful
+# requests while latency stays near its baseline, and are cut on overload responses and connection
+# errors; a 429 also lowers the request rate below RATE_LIMIT_QUERIES, which then grows back
+ADAPTIVE_CONCURRENCY = True  # False keeps MAX_CONCURRENT_REQUESTS in flight at the full rate
+INITIAL_CONCURRENCY = 4
+MIN_CONCURRENCY = 1
+AIMD_DECREASE = 0.5           # Factor applied to the limits after an overload signal
+AIMD_LATENCY_TOLERANCE = 2.0  # No increase while latency is above this multiple of its baseline
+MIN_RATE_SHARE = 0.1          # Lowest request rate, as a share of RATE_LIMIT_QUERIES
+OVERLOAD_STATUSES = (429, 502, 503, 504)  # Not 500: PSI answers 500 when Lighthouse fails on the audited page
+
+# Distributed run constants: a run with a work queue pushes its tasks to the queue instead of
+# querying, and workers (--worker, on any number of processes and machines) lease and run them
+WORK_QUEUE_NAME = 'psi'         # Key prefix of the job in a Redis queue
+LEASE_TIMEOUT = 300             # Seconds a leased task stays with its worker without a renewal
+WORK_QUEUE_POLL_INTERVAL = 1     # Seconds between queue polls of the coordinator and of idle workers
+WORK_QUEUE_BATCH = 500           # Tasks pushed ahead of the results (and per transaction)
+
+# HTTP transport constants
+MAX_REQUESTS_PER_HOST = MAX_CONCURRENT_REQUESTS  # Concurrent requests allowed to a single host
+HTTP2_ENABLED = False  # Use HTTP/2 via httpx (needs: pip install "httpx[http2]")
+
+# Request metrics constants: per-request phase timings aggregated into histograms, written at the
+# end of the run and every METRICS_FLUSH_INTERVAL seconds while it runs
+METRICS_ENABLED = True
+METRICS_FORMAT = 'prometheus'  # 'prometheus' (text format, e.g. for the node_exporter textfile collector), 'openmetrics' or 'jsonl'
+METRICS_PATH = 'psi_metrics'    # Output file without extension (.prom, .om or .jsonl is added)
+METRICS_FLUSH_INTERVAL = 30    # Seconds between writes during the run (0 only writes at the end)
+METRICS_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]  # Histogram bounds in seconds
+
+# Phases of a request, in the order they happen (total is the whole request including its retries)
+REQUEST_PHASES = ['queue_wait', 'limiter_wait', 'retry_wait', 'connect', 'ttfb', 'download', 'parse', 'extract', 'total']
+
+# Timings of the request being processed by the current thread or asyncio task: {phase: seconds}
+request_timings = contextvars.ContextVar('request_timings', default=None)
+
+# Function to add time spent in a phase to the timings of the current request (no-op outside a request)
+def add_timing(phase, seconds):
+    timings = request_timings.get()
+    if timings is not None:
+        timings[phase] = timings.get(phase, 0) + seconds
+
+# Request metrics: the phase timings of every request aggregated into histograms (and, in the
+# jsonl format, one record per request), so the wall-clock time of a run can be traced to
+# limiter waits, API latency, retry backoff or parsing
+class RequestMetrics:
+    def __init__(self, namespace, path, output_format, buckets):
+        self.lock = threading.Lock()
+        self.namespace = namespace
+        self.format = output_format
+        self.path = path + {'prometheus': '.prom', 'openmetrics': '.om', 'jsonl': '.jsonl'}[output_format]
+        self.buckets = buckets
+        self.histograms = {}  # {phase: [count per bucket..., count above the last bucket, sum]}
+        self.pending = []     # Request records not written yet (jsonl)
+        self.active = False
+        self.stop_event = threading.Event()
+        self.flusher = None
     
-    # Function to get URLs from the sitemap
-    def get_urls_from_sitemap(domain):
+    @contextlib.contextmanager
+    def track(self, queued_at=None, **labels):
+        """Collect the timings of one request in this thread or asyncio task and record them at the end"""
+        timings = {}
+        if queued_at is not None:
+            timings['queue_wait'] = time.perf_counter() - queued_at
+        token = request_timings.set(timings)
+        start = time.perf_counter()
         try:
-            sitemap_url = f"{domain}/sitemap.xml"
-            response = requests.get(sitemap_url, timeout=30)
-            if response.status_code == 200:
-                # Extract URLs using regex (simple approach)
-                urls = re.findall(r'<loc>(.*?)</loc>', response.text)
-                return urls
+            yield timings
+        finally:
+            request_timings.reset(token)
+            timings['total'] = time.perf_counter() - start + timings.get('queue_wait', 0)
+            self.record(labels, timings)
+    
+    def run(self, function, *args, queued_at=None, **labels):
+        """Call function(*args) with the timings of its requests tracked"""
+        with self.track(queued_at, **labels):
+            return function(*args)
+    
+    def record(self, labels, timings):
+        with self.lock:
+            for phase, seconds in timings.items():
+                histogram = self.histograms.setdefault(phase, [0] * (len(self.buckets) + 2))
+                histogram[bisect.bisect_left(self.buckets, seconds)] += 1
+                histogram[-1] += seconds
+            if self.active and self.format == 'jsonl':
+                self.pending.append({'type': 'request', **labels, **{phase: round(seconds, 6) for phase, seconds in timings.items()}})
+    
+    def cumulative(self, histogram):
+        """(upper bound, cumulative count) pairs of a histogram, ending with +Inf"""
+        return list(zip([str(float(bound)) for bound in self.buckets] + ['+Inf'], itertools.accumulate(histogram[:-1])))
+    
+    def render(self):
+        """Prometheus text format (or OpenMetrics) of the histograms"""
+        name = f"{self.namespace}_request_phase_seconds"
+        lines = [f"# HELP {name} Time spent in each phase of the API requests",
+                 f"# TYPE {name} histogram"]
+        if self.format == 'openmetrics':
+            lines.append(f"# UNIT {name} seconds")
+        with self.lock:
+            for phase in sorted(self.histograms, key=self.phase_order):
+                histogram = self.histograms[phase]
+                buckets = self.cumulative(histogram)
+                lines += [f'{name}_bucket{{phase="{phase}",le="{bound}"}} {count}' for bound, count in buckets]
+                lines.append(f'{name}_sum{{phase="{phase}"}} {histogram[-1]:.6f}')
+                lines.append(f'{name}_count{{phase="{phase}"}} {buckets[-1][1]}')
+        if self.format == 'openmetrics':
+            lines.append("# EOF")
+        return '\n'.join(lines) + '\n'
+    
+    def phase_order(self, phase):
+        return REQUEST_PHASES.index(phase) if phase in REQUEST_PHASES else len(REQUEST_PHASES)
+    
+    def flush(self, final=False):
+        """Write the metrics: the histogram file is replaced atomically, JSONL records are appended"""
+        if self.format != 'jsonl':
+            with open(self.path + '.tmp', 'w') as f:
+                f.write(self.render())
+            os.replace(self.path + '.tmp', self.path)
+            return
+        with self.lock:
+            records, self.pending = self.pending, []
+            if final:
+                records += [{'type': 'histogram', 'phase': phase, 'buckets': dict(self.cumulative(histogram)),
+                             'sum': round(histogram[-1], 6), 'count': sum(histogram[:-1])}
+                            for phase, histogram in self.histograms.items()]
+        with open(self.path, 'a') as f:
+            f.writelines(json.dumps(record) + '\n' for record in records)
+    
+    def start(self, flush_interval):
+        """Start collecting per-request records and flush every flush_interval seconds"""
+        if self.format == 'jsonl' and os.path.exists(self.path):
+            os.remove(self.path)
+        self.active = True
+        if flush_interval > 0:
+            def flush_periodically():
+                while not self.stop_event.wait(flush_interval):
+                    self.flush()
+            self.flusher = threading.Thread(target=flush_periodically, daemon=True)
+            self.flusher.start()
+    
+    def close(self):
+        self.stop_event.set()
+        if self.flusher:
+            self.flusher.join()
+        self.flush(final=True)
+        self.active = False
+    
+    def summary(self):
+        """One line per phase: requests, total seconds, mean and the bucket holding the 95th percentile"""
+        lines = []
+        with self.lock:
+            for phase in sorted(self.histograms, key=self.phase_order):
+                histogram = self.histograms[phase]
+                buckets = self.cumulative(histogram)
+                count = buckets[-1][1]
+                p95 = next(bound for bound, cumulative in buckets if cumulative >= 0.95 * count)
+                lines.append(f"{phase}: {count} requests, {histogram[-1]:.1f} s total, "
+                             f"{histogram[-1] / count * 1000:.0f} ms mean, p95 <= {p95} s")
+        return lines
+
+# Function to subclass a urllib3 connection pool so that opening a connection (TCP and TLS)
+# is added to the connect phase of the current request
+def timed_pool(pool_class):
+    class TimedConnection(pool_class.ConnectionCls):
+        def connect(self):
+            start = time.perf_counter()
+            try:
+                super().connect()
+            finally:
+                add_timing('connect', time.perf_counter() - start)
+    return type(f"Timed{pool_class.__name__}", (pool_class,), {'ConnectionCls': TimedConnection})
+
+# Function to add the connect, TTFB and download phases of a request from its httpx trace events
+def add_trace_timings(events, start, end):
+    connect_start = events.get('connection.connect_tcp.started')
+    connect_end = events.get('connection.start_tls.complete') or events.get('connection.connect_tcp.complete')
+    connect = connect_end - connect_start if connect_start and connect_end else 0
+    headers = events.get('http11.receive_response_headers.complete') or events.get('http2.receive_response_headers.complete') or end
+    if connect:
+        add_timing('connect', connect)
+    add_timing('ttfb', headers - start - connect)
+    add_timing('download', end - headers)
+
+# Shared HTTP transport: one keep-alive connection pool for API calls and sitemap fetches,
+# with gzip compression, optional HTTP/2 and a concurrency cap per host
+# (the client library is only imported when the first request is sent)
+class HttpTransport:
+    def __init__(self, pool_size, per_host_limit, http2=False):
+        self.lock = threading.Lock()
+        self.pool_size = pool_size
+        self.per_host_limit = per_host_limit
+        self.http2 = http2
+        self.host_slots = {}
+        self.session = None
+    
+    @property
+    def client(self):
+        """HTTP client, created on first use (and again after close())"""
+        with self.lock:
+            if self.session is None:
+                self.session = self.create_client()
+            return self.session
+    
+    def create_client(self):
+        headers = {'Accept-Encoding': 'gzip, deflate'}
+        if self.http2:
+            import httpx
+            return httpx.Client(http2=True, headers=headers, follow_redirects=True,
+                                limits=httpx.Limits(max_connections=self.pool_size,
+                                                    max_keepalive_connections=self.pool_size))
+        import requests
+        from requests.adapters import HTTPAdapter
+        client = requests.Session()
+        client.headers.update(headers)
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.pool_size)
+        adapter.poolmanager.pool_classes_by_scheme = {scheme: timed_pool(pool_class) for scheme, pool_class
+                                                      in adapter.poolmanager.pool_classes_by_scheme.items()}
+        client.mount('https://', adapter)
+        client.mount('http://', adapter)
+        return client
+    
+    @property
+    def timeout_errors(self):
+        if self.http2:
+            import httpx
+            return (httpx.TimeoutException,)
+        import requests
+        return (requests.exceptions.Timeout,)
+    
+    @property
+    def connection_errors(self):
+        if self.http2:
+            import httpx
+            return (httpx.TransportError,)
+        import requests
+        return (requests.exceptions.ConnectionError,)
+    
+    def host_slot(self, url):
+        """Semaphore limiting concurrent requests to the host of the URL"""
+        host = urlsplit(url).netloc
+        with self.lock:
+            if host not in self.host_slots:
+                self.host_slots[host] = threading.BoundedSemaphore(self.per_host_limit)
+            return self.host_slots[host]
+    
+    def request(self, method, url, **kwargs):
+        """Send a request and add its connect, TTFB and download phases to the current request timings"""
+        with self.host_slot(url):
+            start = time.perf_counter()
+            if self.http2:
+                events = {}
+                def trace(event_name, info):
+                    events[event_name] = time.perf_counter()
+                response = self.client.request(method, url, extensions={'trace': trace}, **kwargs)
+                add_trace_timings(events, start, time.perf_counter())
+                return response
+            
+            # The body is read separately (stream=True) so time to first byte and download are split
+            timings = request_timings.get() or {}
+            connect = timings.get('connect', 0)
+            response = self.client.request(method, url, stream=True, **kwargs)
+            headers = time.perf_counter()
+            response.content
+            add_timing('ttfb', headers - start - (timings.get('connect', 0) - connect))
+            add_timing('download', time.perf_counter() - headers)
+            return response
+    
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+    
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+    
+    def stream(self, url, chunk_size=65536, **kwargs):
+        """Yield the body of a GET request in chunks as it downloads"""
+        with self.host_slot(url):
+            if not self.http2:
+                with self.client.get(url, stream=True, **kwargs) as response:
+                    response.raise_for_status()
+                    yield from response.iter_content(chunk_size)
             else:
-                print(f"Failed to fetch sitemap: {response.status_code}")
-                return []
-        except Exception as e:
-            print(f"Error fetching sitemap: {e}")
+                with self.client.stream('GET', url, **kwargs) as response:
+                    response.raise_for_status()
+                    yield from response.iter_bytes(chunk_size)
+    
+    def close(self):
+        with self.lock:
+            if self.session is not None:
+                self.session.close()
+                self.session = None
+
+http_transport = HttpTransport(MAX_CONCURRENT_REQUESTS, MAX_REQUESTS_PER_HOST, HTTP2_ENABLED)
+
+# Run journal: every completed result is appended to a JSONL file as soon as it arrives, so an
+# interrupted run (disconnect, crash, Ctrl-C) can be resumed without repeating its queries
+class RunJournal:
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.path = path
+        self.file = None
+    
+    def load(self, config):
+        """Return the entries of an interrupted run with the same settings (empty list if none)"""
+        if not os.path.exists(self.path):
             return []
+        entries = []
+        with open(self.path, encoding='utf-8') as f:
+            try:
+                if json.loads(f.readline()).get('config') != config:
+                    return []
+                for line in f:
+                    entries.append(json.loads(line))
+            except ValueError:
+                pass  # A line cut off by the interruption ends the journal
+        return entries
     
-    # Get URLs from sitemap
-    urls = get_urls_from_sitemap(domain)
+    def start(self, config, entries=()):
+        """Start a new journal, keeping the entries of a resumed run"""
+        self.file = open(self.path, 'w', encoding='utf-8')
+        self.file.write(json.dumps({'config': config}) + '\n')
+        for entry in entries:
+            self.file.write(json.dumps(entry, default=str) + '\n')
+        self.file.flush()
     
-    # If sitemap approach fails, ask for manual input
-    if not urls:
-        print("\nCouldn't get URLs from sitemap. You have two options:")
-        print("1. Try a different sitemap URL")
-        print("2. Switch to file upload method")
-        fallback_choice = input("Enter your choice (1 or 2): ")
+    def write(self, entry):
+        with self.lock:
+            self.file.write(json.dumps(entry, default=str) + '\n')
+            self.file.flush()
+            os.fsync(self.file.fileno())
+    
+    def finish(self):
+        """Remove the journal once the output file has been written"""
+        with self.lock:
+            self.file.close()
+            os.remove(self.path)
+
+# Work queue of a distributed run in an SQLite file: the coordinator pushes tasks and collects
+# their results, workers in other processes lease tasks for a limited time and write the results
+# back (SQLite's file locking serializes them: use a local disk, or a network file system with
+# working locks for several machines). A task whose lease runs out goes to the next worker, so
+# every task is done at least once; the first result written for a task is kept.
+class SqliteWorkQueue:
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        with self.lock:
+            self.conn.executescript("""
+                CREATE TABLE IF NOT EXISTS job (key TEXT PRIMARY KEY, value TEXT);
+                CREATE TABLE IF NOT EXISTS tasks (
+                    id INTEGER PRIMARY KEY,
+                    task TEXT UNIQUE NOT NULL,
+                    worker TEXT,
+                    lease_until REAL NOT NULL DEFAULT 0,
+                    leases INTEGER NOT NULL DEFAULT 0,
+                    done_seq INTEGER,
+                    result TEXT
+                );
+                CREATE INDEX IF NOT EXISTS tasks_done_seq ON tasks (done_seq);
+            """)
+    
+    @contextlib.contextmanager
+    def transaction(self):
+        with self.lock:
+            self.conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield self.conn
+            except BaseException:
+                self.conn.execute('ROLLBACK')
+                raise
+            self.conn.execute('COMMIT')
+    
+    def open_job(self, config, resume=True):
+        """Open a job with these settings: an unfinished earlier job with the same settings is resumed,
+        any other job (a finished one included) is replaced (returns the number of tasks already done)"""
+        with self.transaction() as conn:
+            row = conn.execute("SELECT value FROM job WHERE key = 'config'").fetchone()
+            finished = conn.execute("SELECT 1 FROM job WHERE key = 'finished'").fetchone()
+            if resume and row and not finished and json.loads(row[0]) == config:
+                return conn.execute("SELECT COUNT(*) FROM tasks WHERE done_seq IS NOT NULL").fetchone()[0]
+            conn.execute("DELETE FROM tasks")
+            conn.execute("DELETE FROM job")
+            conn.execute("INSERT INTO job VALUES ('config', ?)", (json.dumps(config),))
+            return 0
+    
+    def job_config(self):
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM job WHERE key = 'config'").fetchone()
+        return json.loads(row[0]) if row else None
+    
+    def finished(self):
+        with self.lock:
+            return self.conn.execute("SELECT 1 FROM job WHERE key = 'finished'").fetchone() is not None
+    
+    def finish(self):
+        """Mark the job as finished, so idle workers stop and the next run starts a new job"""
+        with self.transaction() as conn:
+            conn.execute("INSERT OR REPLACE INTO job VALUES ('finished', '1')")
+    
+    def push(self, tasks):
+        """Add tasks (tasks already in the queue are not added again)"""
+        if tasks:
+            with self.transaction() as conn:
+                conn.executemany("INSERT OR IGNORE INTO tasks (task) VALUES (?)", [(json.dumps(task),) for task in tasks])
+    
+    def lease(self, worker, count, timeout):
+        """Lease up to count open tasks (never leased, or with an expired lease): [(task id, task)]"""
+        if count <= 0:
+            return []
+        now = time.time()
+        with self.transaction() as conn:
+            rows = conn.execute("SELECT id, task FROM tasks WHERE done_seq IS NULL AND lease_until < ? ORDER BY id LIMIT ?",
+                                (now, count)).fetchall()
+            conn.executemany("UPDATE tasks SET worker = ?, lease_until = ?, leases = leases + 1 WHERE id = ?",
+                             [(worker, now + timeout, task_id) for task_id, _ in rows])
+        return [(task_id, tuple(json.loads(task))) for task_id, task in rows]
+    
+    def renew(self, worker, task_ids, timeout):
+        """Extend the leases of tasks that are still running"""
+        with self.transaction() as conn:
+            conn.executemany("UPDATE tasks SET lease_until = ? WHERE id = ? AND worker = ? AND done_seq IS NULL",
+                             [(time.time() + timeout, task_id, worker) for task_id in task_ids])
+    
+    def complete(self, task_id, result):
+        with self.transaction() as conn:
+            conn.execute("UPDATE tasks SET result = ?, done_seq = (SELECT COALESCE(MAX(done_seq), 0) + 1 FROM tasks) "
+                         "WHERE id = ? AND done_seq IS NULL", (json.dumps(result, default=str), task_id))
+    
+    def results_since(self, cursor):
+        """Results written after the cursor: ([(task, result)], new cursor)"""
+        with self.lock:
+            rows = self.conn.execute("SELECT task, result, done_seq FROM tasks WHERE done_seq > ? ORDER BY done_seq",
+                                     (cursor,)).fetchall()
+        entries = [(tuple(json.loads(task)), json.loads(result)) for task, result, _ in rows]
+        return entries, rows[-1][2] if rows else cursor
+    
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+# The same work queue in Redis (or a server speaking its protocol, such as Valkey or KeyDB), for
+# workers on several machines (needs: pip install redis). Open tasks are a sorted set scored by
+# the time they can be leased (0 when new, the lease expiry once leased), so a task stays in the
+# set until its result is written and a crashed worker never loses it.
+class RedisWorkQueue:
+    def __init__(self, url, name):
+        import redis
+        self.client = redis.Redis.from_url(url, decode_responses=True)
+        self.keys = {part: f"{name}:{part}" for part in ('config', 'finished', 'open', 'results', 'done')}
+    
+    def open_job(self, config, resume=True):
+        stored = self.client.get(self.keys['config'])
+        if resume and stored and not self.finished() and json.loads(stored) == config:
+            return self.client.hlen(self.keys['results'])
+        self.client.delete(*self.keys.values())
+        self.client.set(self.keys['config'], json.dumps(config))
+        return 0
+    
+    def job_config(self):
+        stored = self.client.get(self.keys['config'])
+        return json.loads(stored) if stored else None
+    
+    def finished(self):
+        return bool(self.client.exists(self.keys['finished']))
+    
+    def finish(self):
+        self.client.set(self.keys['finished'], 1)
+    
+    def push(self, tasks):
+        encoded = [json.dumps(task) for task in tasks]
+        if encoded:
+            done = self.client.hmget(self.keys['results'], encoded)
+            new = {task: 0 for task, result in zip(encoded, done) if result is None}
+            if new:
+                self.client.zadd(self.keys['open'], new, nx=True)
+    
+    def lease(self, worker, count, timeout):
+        if count <= 0:
+            return []
+        
+        # Optimistic transaction: retried if another worker leased from the set in the meantime
+        def claim(pipe):
+            now = time.time()
+            tasks = pipe.zrangebyscore(self.keys['open'], '-inf', now, start=0, num=count)
+            pipe.multi()
+            if tasks:
+                pipe.zadd(self.keys['open'], {task: now + timeout for task in tasks}, xx=True)
+            return tasks
+        tasks = self.client.transaction(claim, self.keys['open'], value_from_callable=True)
+        return [(task, tuple(json.loads(task))) for task in tasks]
+    
+    def renew(self, worker, task_ids, timeout):
+        if task_ids:
+            self.client.zadd(self.keys['open'], {task: time.time() + timeout for task in task_ids}, xx=True)
+    
+    def complete(self, task_id, result):
+        pipe = self.client.pipeline()
+        pipe.zrem(self.keys['open'], task_id)
+        pipe.hsetnx(self.keys['results'], task_id, json.dumps(result, default=str))
+        pipe.rpush(self.keys['done'], task_id)
+        pipe.execute()
+    
+    def results_since(self, cursor):
+        tasks = self.client.lrange(self.keys['done'], cursor, -1)
+        results = self.client.hmget(self.keys['results'], tasks) if tasks else []
+        return [(tuple(json.loads(task)), json.loads(result)) for task, result in zip(tasks, results)], cursor + len(tasks)
+    
+    def close(self):
+        self.client.close()
+
+# Function to open the work queue of a distributed run: a redis:// (or rediss://) URL, or an SQLite file
+def open_work_queue(spec):
+    if spec.startswith(('redis://', 'rediss://')):
+        return RedisWorkQueue(spec, WORK_QUEUE_NAME)
+    return SqliteWorkQueue(spec)
+
+# Raw response archive: every API response is stored compressed under the SHA-256 of its body
+# (identical responses are stored once), with an SQLite index by URL, variant and fetch time
+class ResponseArchive:
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.path = path
+        os.makedirs(os.path.join(path, 'objects'), exist_ok=True)
+        
+        # zstd when available (pip install zstandard), gzip otherwise
+        try:
+            import zstandard
+            self.codec = 'zst'
+            # One-shot functions: compressor objects must not be shared between threads
+            self.compress = lambda body: zstandard.compress(body, 10)
+            self.decompressors = {'zst': zstandard.decompress, 'gz': gzip.decompress}
+        except ImportError:
+            self.codec = 'gz'
+            self.compress = gzip.compress
+            self.decompressors = {'gz': gzip.decompress}
         
-        if fallback_choice == '1':
-            custom_sitemap = input("Enter the full sitemap URL: ")
+        self.conn = sqlite3.connect(os.path.join(path, 'index.sqlite'), check_same_thread=False)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                url TEXT NOT NULL,
+                variant TEXT NOT NULL,
+                fetched_at REAL NOT NULL,
+                digest TEXT NOT NULL,
+                codec TEXT NOT NULL
+            )""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_url ON responses (url, variant, fetched_at)")
+    
+    def object_path(self, digest, codec):
+        return os.path.join(self.path, 'objects', digest[:2], f"{digest}.json.{codec}")
+    
+    def put(self, url, variant, body):
+        """Store a raw response body for the URL and variant (strategy or form factor)"""
+        digest = hashlib.sha256(body).hexdigest()
+        path = self.object_path(digest, self.codec)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(self.compress(body))
+            os.replace(tmp_path, path)
+        with self.lock:
+            self.conn.execute("INSERT INTO responses VALUES (?, ?, ?, ?, ?)",
+                              (url, variant, time.time(), digest, self.codec))
+            self.conn.commit()
+    
+    def get_latest(self, url, variant):
+        """Return the most recent archived response for the URL and variant, or None"""
+        with self.lock:
+            row = self.conn.execute("""
+                SELECT digest, codec FROM responses WHERE url = ? AND variant = ?
+                ORDER BY fetched_at DESC LIMIT 1""", (url, variant)).fetchone()
+        if not row or row[1] not in self.decompressors:
+            return None
+        with open(self.object_path(*row), 'rb') as f:
+            return json_loads(self.decompressors[row[1]](f.read()))
+    
+    def urls(self):
+        """All archived URLs in the order they were first stored"""
+        with self.lock:
+            rows = self.conn.execute("SELECT url FROM responses GROUP BY url ORDER BY MIN(rowid)").fetchall()
+        return [row[0] for row in rows]
+    
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+# Last-audit index: the latest result row of every URL and strategy, with the sitemap lastmod
+# it was audited against, so an incremental run can carry results forward for unchanged pages
+class AuditIndex:
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS audits (
+                url TEXT NOT NULL,
+                strategy TEXT NOT NULL,
+                audited_at REAL NOT NULL,
+                lastmod TEXT,
+                result TEXT NOT NULL,
+                PRIMARY KEY (url, strategy)
+            )""")
+    
+    def load(self, strategy):
+        """Return {url: (audited_at, lastmod, result row)} for every audited URL"""
+        rows = self.conn.execute("SELECT url, audited_at, lastmod, result FROM audits WHERE strategy = ?", (strategy,))
+        return {url: (audited_at, lastmod, json_loads(result)) for url, audited_at, lastmod, result in rows}
+    
+    def put_many(self, strategy, rows, lastmods):
+        """Store result rows (one transaction for the whole run)"""
+        now = time.time()
+        self.conn.executemany("INSERT OR REPLACE INTO audits VALUES (?, ?, ?, ?, ?)",
+                              [(row['url'], strategy, now, lastmods.get(row['url']), json.dumps(row, default=str))
+                               for row in rows])
+        self.conn.commit()
+    
+    def close(self):
+        self.conn.close()
+
+# Sitemap details of every URL found: {url: (lastmod, priority)}
+sitemap_entries = {}
+
+# URL index: groups the input URLs that are the same page after canonicalization so that each
+# page is queried once, under the first of its URLs exactly as written (the APIs match URLs
+# exactly, so the canonical form is only the grouping key), and remembers the aliases so each
+# result can be copied back to them
+class UrlIndex:
+    def __init__(self, rules):
+        self.lock = threading.Lock()
+        self.rules = rules
+        self.aliases = {}  # {canonical URL: [input URLs], the first of which is queried}
+        self.duplicates = 0
+        self.redirects = {}  # {canonical finalUrl: queried URL that redirected to it}
+        self.merged = {}     # {queried URL: queried URL whose audit it reuses}
+        self.started = set()
+    
+    def canonicalize(self, url):
+        """Apply the canonicalization rules to a URL (without rules it is only stripped of whitespace)"""
+        rules = self.rules
+        if not rules:
+            return url.strip()
+        parts = urlsplit(url.strip())
+        scheme = parts.scheme.lower() if rules.get('lowercase_host') else parts.scheme
+        netloc = parts.netloc.lower() if rules.get('lowercase_host') else parts.netloc
+        if rules.get('force_https') and scheme == 'http':
+            scheme = 'https'
+            netloc = netloc[:-len(':80')] if netloc.endswith(':80') else netloc
+        if rules.get('strip_default_port'):
+            default_port = {'http': ':80', 'https': ':443'}.get(scheme)
+            if default_port and netloc.endswith(default_port):
+                netloc = netloc[:-len(default_port)]
+        
+        path = parts.path
+        if rules.get('strip_trailing_slash'):
+            path = path.rstrip('/') or '/'
+        
+        query = parts.query
+        patterns = rules.get('strip_query_params')
+        if patterns and query:
+            query = '&'.join(param for param in query.split('&')
+                             if not any(fnmatch.fnmatchcase(param.split('=', 1)[0], pattern) for pattern in patterns))
+        
+        fragment = '' if rules.get('strip_fragment') else parts.fragment
+        return urlunsplit((scheme, netloc, path, query, fragment))
+    
+    def dedup(self, urls):
+        """Yield every URL whose page was not seen before, as written"""
+        for url in urls:
+            url = url.strip()
+            canonical = self.canonicalize(url)
+            with self.lock:
+                seen = canonical in self.aliases
+                self.aliases.setdefault(canonical, []).append(url)
+                if seen:
+                    self.duplicates += 1
+            if not seen:
+                yield url
+    
+    def record_redirect(self, url, final_url):
+        """Remember that an audited URL ended up at final_url (lighthouseResult.finalUrl)"""
+        final = self.canonicalize(final_url)
+        if final != self.canonicalize(url):
+            with self.lock:
+                self.redirects.setdefault(final, url)
+    
+    def claim(self, url):
+        """Return True if the URL should be audited, False if it is the known redirect target
+        of an audited URL (its aliases then reuse that audit)"""
+        with self.lock:
+            source = self.redirects.get(self.canonicalize(url))
+            if source is not None and url not in self.started:
+                self.merged[url] = source
+                return False
+            self.started.add(url)
+            return True
+    
+    def alias_frame(self, column):
+        """DataFrame mapping every queried URL (queried_url) to the input URLs it stands for"""
+        import pandas as pd
+        with self.lock:
+            pairs = [(self.merged.get(urls[0], urls[0]), url) for urls in self.aliases.values() for url in urls]
+        return pd.DataFrame(pairs, columns=['queried_url', column])
+
+# Function to copy the result rows of every queried URL to all of its input URLs
+def fan_out(df, column='url'):
+    df = df.rename(columns={column: 'queried_url'}).merge(url_index.alias_frame(column), on='queried_url', how='left')
+    df.insert(0, column, df.pop(column))
+    return df
+
+url_index = UrlIndex(CANONICAL_RULES if CANONICALIZE_URLS else {})
+
+# Sitemap constants
+SITEMAP_WORKERS = 4         # Child sitemaps of a sitemap index that are read in parallel
+SITEMAP_QUEUE_SIZE = 10000  # URLs read ahead of the API queries (keeps memory flat for huge sitemaps)
+
+# Function to find the sitemaps of a site: the Sitemap: lines of robots.txt, else /sitemap.xml
+def find_sitemaps(domain):
+    try:
+        response = http_transport.get(f"{domain}/robots.txt", timeout=30)
+        if response.status_code == 200:
+            sitemaps = re.findall(r'^\s*sitemap:\s*(\S+)', response.text, re.I | re.M)
+            if sitemaps:
+                return sitemaps
+    except Exception as e:
+        print(f"Error fetching robots.txt: {e}")
+    return [f"{domain}/sitemap.xml"]
+
+# Function to stream the entries of one sitemap while it downloads: ('url', loc, lastmod, priority)
+# for pages and ('sitemap', loc, lastmod, None) for the children of a sitemap index
+def parse_sitemap_stream(sitemap_url):
+    parser = ET.XMLPullParser(events=('start', 'end'))
+    decompressor = None
+    root = None
+    for chunk in http_transport.stream(sitemap_url, timeout=30):
+        # .xml.gz sitemaps are decompressed on the fly (gzip Content-Encoding is decoded by the transport)
+        if decompressor is None:
+            decompressor = zlib.decompressobj(31) if chunk[:2] == b'\x1f\x8b' else False
+        parser.feed(decompressor.decompress(chunk) if decompressor else chunk)
+        
+        for event, element in parser.read_events():
+            if root is None:
+                root = element
+            tag = element.tag.rsplit('}', 1)[-1]
+            if event != 'end' or tag not in ('url', 'sitemap'):
+                continue
+            fields = {child.tag.rsplit('}', 1)[-1]: (child.text or '').strip() for child in element}
+            if fields.get('loc'):
+                yield tag, fields['loc'], fields.get('lastmod') or None, fields.get('priority') or None
+            # Parsed entries are dropped, so memory does not grow with the sitemap size
+            root.clear()
+
+# Function to yield (url, lastmod, priority) for every page of the given sitemaps as they are read;
+# sitemap indexes are followed and their child sitemaps are fetched in parallel
+def iter_sitemap_urls(sitemap_urls):
+    entries = queue.Queue(maxsize=SITEMAP_QUEUE_SIZE)
+    stop = threading.Event()
+    lock = threading.Lock()
+    seen = set()
+    pending = [1]  # Sitemaps still being read (plus one until all top-level sitemaps are queued)
+    jobs = queue.Queue()
+    
+    def put(item):
+        # Waits while the queue is full, so reading only stays a little ahead of the queries
+        while not stop.is_set():
             try:
-                response = requests.get(custom_sitemap, timeout=30)
-                if response.status_code == 200:
-                    urls = re.findall(r'<loc>(.*?)</loc>', response.text)
-                    print(f"Found {len(urls)} URLs in the custom sitemap.")
-                else:
-                    print(f"Failed to fetch custom sitemap: {response.status_code}")
+                entries.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                pass
+    
+    def finished():
+        with lock:
+            pending[0] -= 1
+            done = pending[0] == 0
+        if done:
+            put(None)
+    
+    def submit(sitemap_url):
+        with lock:
+            if sitemap_url in seen:
+                return
+            seen.add(sitemap_url)
+            pending[0] += 1
+        jobs.put(sitemap_url)
+    
+    # Daemon threads, so a reader waiting on a full queue never blocks the end of the script
+    def worker():
+        while True:
+            sitemap_url = jobs.get()
+            if sitemap_url is None:
+                return
+            try:
+                for kind, loc, lastmod, priority in parse_sitemap_stream(sitemap_url):
+                    if stop.is_set():
+                        break
+                    if kind == 'sitemap':
+                        submit(loc)
+                    else:
+                        put((loc, lastmod, priority))
             except Exception as e:
-                print(f"Error fetching custom sitemap: {e}")
-        
-        if fallback_choice == '2' or not urls:
-            print("\nSwitching to file upload method...")
-            url_source_choice = '2'  # Switch to file upload method
+                print(f"Error reading sitemap {sitemap_url}: {e}")
+            finished()
+    
+    for _ in range(SITEMAP_WORKERS):
+        threading.Thread(target=worker, daemon=True).start()
+    
+    try:
+        for sitemap_url in sitemap_urls:
+            submit(sitemap_url)
+        finished()
+        while True:
+            item = entries.get()
+            if item is None:
+                return
+            yield item
+    finally:
+        stop.set()
+        for _ in range(SITEMAP_WORKERS):
+            jobs.put(None)
 
-if url_source_choice == '2' or not urls:
-    # Upload file with URLs
-    print("\nPlease upload a text file containing URLs (one URL per line):")
-    uploaded = files.upload()
+# Function to check whether an iterator yields anything (returns None if not, otherwise an equivalent iterator)
+def peek(iterator):
+    first = next(iterator, None)
+    return None if first is None else itertools.chain([first], iterator)
+
+# Function to yield the page URLs of sitemaps, keeping the lastmod and priority of each
+def sitemap_page_urls(sitemap_urls):
+    sitemap_entries.clear()
+    for url, lastmod, priority in iter_sitemap_urls(sitemap_urls):
+        try:
+            priority = float(priority) if priority else None
+        except ValueError:
+            priority = None
+        sitemap_entries[url] = (lastmod, priority)
+        yield url
+
+# Function to convert a sitemap lastmod (W3C datetime, date only means UTC midnight) to a timestamp
+def parse_lastmod(value):
+    if not value:
+        return None
+    try:
+        parsed = datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+    return parsed.timestamp()
+
+# Run settings used by the functions below (run_psi_batch() sets them for each run)
+STRATEGY = 'mobile'    # 'mobile' or 'desktop'
+LAB_RUNS = 1           # Lighthouse runs per URL (lab metrics are the median of the runs)
+REEXTRACT = False
+response_archive = None
+request_metrics = RequestMetrics('psi', METRICS_PATH, METRICS_FORMAT, METRICS_BUCKETS)
+run_journal = None
+carried_results = []   # Stored results of unchanged URLs in incremental mode
+
+# Function to get URLs from the sitemaps listed in robots.txt (or /sitemap.xml); the URLs
+# are streamed, so the analysis starts while the sitemaps are still downloading
+def get_urls_from_sitemap(domain, sitemaps=None):
+    sitemaps = sitemaps or find_sitemaps(domain)
+    print(f"Reading {len(sitemaps)} sitemap(s): {', '.join(sitemaps)}")
+    return peek(sitemap_page_urls(sitemaps))
+
+# Function to read a list of URLs (one URL per line)
+def read_url_list(content):
+    if isinstance(content, bytes):
+        content = content.decode('utf-8')
+    return [line.strip() for line in content.split('\n') if line.strip()]
+
+# Sampling constants
+SAMPLE_PER_TEMPLATE = 5      # URLs audited per page template in sampling mode
+SAMPLE_SEED = 42             # Same sample on every run (None draws a new sample each time)
+TEMPLATE_MIN_VARIANTS = 20   # A path segment with at least this many values under one parent is variable
+CONFIDENCE_Z = 1.96          # z-score of the confidence intervals (1.96 = 95%)
+
+# Function to find the page template of every URL: segments that look like IDs or slugs, and
+# segments with many values under the same parent, become placeholders (e.g. /product/{slug})
+def url_templates(urls):
+    import pandas as pd
     
-    if not uploaded:
-        print("No file was uploaded. Please run the script again.")
-        raise SystemExit
+    templates = []
+    for url in urls:
+        parts = urlsplit(url)
+        segments = []
+        for segment in parts.path.split('/'):
+            if re.fullmatch(r'\d+|[0-9a-fA-F-]{16,}', segment):
+                segment = '{id}'
+            elif re.search(r'\d', segment) or segment.count('-') >= 2 or len(segment) > 40:
+                segment = '{slug}'
+            segments.append(segment)
+        templates.append(parts.netloc + '/'.join(segments))
     
-    # Get the filename and content
-    file_name = list(uploaded.keys())[0]
-    file_content = uploaded[file_name]
-    
-    # Read URLs from the file
-    urls = [line.strip() for line in file_content.decode('utf-8').split('\n') if line.strip()]
-    print(f"Found {len(urls)} URLs in {file_name}")
-
-# Check if we have URLs to process
-if not urls:
-    print("No URLs found. Please run the script again.")
-    raise SystemExit
-
-# Limit URLs if needed
-max_urls = input("\nEnter maximum number of URLs to analyze (leave blank for all): ")
-if max_urls.strip() and max_urls.isdigit():
-    max_urls = int(max_urls)
-    if max_urls < len(urls):
-        print(f"Limiting analysis to {max_urls} URLs out of {len(urls)} found.")
-        urls = urls[:max_urls]
-
-# Ask user to select device type
-print("\nSelect device type for PageSpeed Insights analysis:")
-print("1. Mobile - Simulates a mobile device with mobile network conditions")
-print("2. Desktop - Simulates a desktop device with faster network")
-device_choice = input("Enter your choice (1 or 2): ")
-
-if device_choice == '2':
-    STRATEGY = 'desktop'
-    print("\nSelected: Desktop device simulation")
-    print("This will analyze performance as experienced on desktop computers.")
-else:
-    STRATEGY = 'mobile'  # Default to mobile
-    print("\nSelected: Mobile device simulation")
-    print("This will analyze performance as experienced on mobile phones.")
+    frame = pd.DataFrame({'template': templates})
+    # Templates without a path (bare hosts) have no last segment
+    split = frame['template'].str.rsplit('/', n=1, expand=True).reindex(columns=[0, 1]).fillna('')
+    variants = split[1].groupby(split[0]).transform('nunique')
+    variable = (variants >= TEMPLATE_MIN_VARIANTS) & ~split[1].str.startswith('{')
+    frame.loc[variable, 'template'] = split[0][variable] + '/{slug}'
+    return frame['template'].tolist()
 
-# Rate limiting constants
-RATE_LIMIT_QUERIES = 20  # PSI API has a limit of ~20 queries per minute
-RATE_LIMIT_WINDOW = 60   # 60 seconds window
-MAX_CONCURRENT_REQUESTS = min(5, RATE_LIMIT_QUERIES // 4)  # Set concurrency conservatively
+# Function to draw up to SAMPLE_PER_TEMPLATE random URLs of every template
+def sample_by_template(urls):
+    import pandas as pd
+    
+    frame = pd.DataFrame({'url': urls, 'template': url_templates(urls)})
+    sample = frame.sample(frac=1, random_state=SAMPLE_SEED).groupby('template', sort=False).head(SAMPLE_PER_TEMPLATE)
+    return sample['url'].tolist(), dict(zip(frame['url'], frame['template'])), frame['template'].value_counts()
+
+# Function to extrapolate the sample to every template and the whole site: mean performance
+# score and lab/field CWV pass rates with confidence intervals (stratified by template size,
+# with a finite population correction)
+def template_estimates(df, template_sizes):
+    import numpy as np
+    import pandas as pd
+    
+    audited = df.drop_duplicates('queried_url').copy()
+    audited['lab_pass'] = (audited['lab_cwv_status'] == 'passed').astype(float).where(audited['lab_cwv_status'].isin(['passed', 'failed']))
+    audited['field_pass'] = (audited['field_cwv_status'] == 'passed').astype(float).where(audited['field_cwv_status'].isin(['passed', 'failed']))
+    grouped = audited.groupby('template')
+    
+    stats = pd.DataFrame({'urls': template_sizes, 'sampled': grouped.size()}).fillna({'sampled': 0}).astype(int)
+    site = {}
+    weights = stats['urls'] / stats['urls'].sum()
+    for column, name in [('performance_score', 'score'), ('lab_pass', 'lab_pass_rate'), ('field_pass', 'field_pass_rate')]:
+        n = grouped[column].count().reindex(stats.index).fillna(0)
+        mean = grouped[column].mean().reindex(stats.index)
+        if name == 'score':
+            variance = grouped[column].var().reindex(stats.index).fillna(0)
+        else:
+            mean = mean * 100
+            variance = mean * (100 - mean)
+        # Sampling variance of the template mean, with the finite population correction
+        mean_variance = (variance / n.where(n > 0) * (1 - n / stats['urls']).clip(lower=0))
+        stats[name] = mean.round(1)
+        stats[f'{name}_ci'] = (CONFIDENCE_Z * np.sqrt(mean_variance)).round(1)
+        
+        # Site-wide estimate from the templates with data, weighted by template size
+        covered = mean.notna()
+        w = weights[covered] / weights[covered].sum()
+        site[name] = ((w * mean[covered]).sum(), CONFIDENCE_Z * np.sqrt((w ** 2 * mean_variance[covered]).sum()),
+                      stats.loc[covered, 'urls'].sum())
+    
+    return stats.sort_values('urls', ascending=False).rename_axis('template').reset_index(), site
+
+# Function to yield the URLs that need a new audit, carrying the stored results forward for the rest
+def select_changed_urls(urls, last_audits):
+    cutoff = time.time() - INCREMENTAL_MAX_AGE
+    for url in urls:
+        audit = last_audits.get(url)
+        lastmod = sitemap_entries.get(url, (None, None))[0]
+        modified = parse_lastmod(lastmod)
+        if (audit is None or audit[0] < cutoff or (modified is not None and modified > audit[0])
+                or (lastmod is not None and lastmod != audit[1])):
+            yield url
+        else:
+            carried_results.append(audit[2])
+
+# Engine constants
+ENGINE = 'async'     # 'async' (asyncio + httpx) or 'threads' (ThreadPoolExecutor)
+MAX_IN_FLIGHT = 200  # Requests the async engine may have open at once; the rate limiter sets the pace
+
+# Retry constants
+MAX_RETRIES = 5           # Retries for a single URL before giving up
+RETRY_BASE_DELAY = 2      # Backoff in seconds before the first retry, doubled on every attempt
+RETRY_MAX_DELAY = 60      # Upper bound for a single backoff
+RETRY_BUDGET_RATIO = 0.2  # Retries allowed for the whole run, as a share of the URL count (at least 10)
+RETRYABLE_STATUS_CODES = {429, 502, 503, 504}  # Not 500: a failed Lighthouse run fails again on the next attempt
 
 # Thread-safe counter and rate limiter
+# (GCRA scheduler: each caller reserves its own start slot under the lock and sleeps outside it)
 class RateLimiter:
-    def __init__(self, max_queries, time_window):
+    def __init__(self, max_queries, time_window, burst=1):
         self.lock = threading.Lock()
         self.max_queries = max_queries
         self.time_window = time_window
-        self.query_times = []
+        self.interval = time_window / max_queries  # Steady-state spacing between requests
+        self.tolerance = (min(burst, max_queries) - 1) * self.interval  # How far ahead a burst may run
+        self.next_slot = 0.0  # Theoretical arrival time of the next request
+        self.recent_slots = collections.deque(maxlen=max_queries)  # Enforces the per-window cap
         self.counter = 0
     
     def increment(self):
@@ -136,56 +1059,341 @@ class RateLimiter:
             self.counter += 1
             return self.counter
     
-    def wait_if_needed(self):
+    def reserve(self):
+        """Reserve the next request slot and return the seconds to wait for it"""
         with self.lock:
-            now = time.time()
+            now = time.monotonic()
+            slot = max(now, self.next_slot - self.tolerance)
+            
+            # Never start more than max_queries requests within one time window
+            if len(self.recent_slots) == self.max_queries:
+                slot = max(slot, self.recent_slots[0] + self.time_window)
             
-            # Remove timestamps older than the time window
-            self.query_times = [t for t in self.query_times if now - t < self.time_window]
+            self.next_slot = max(self.next_slot, slot) + self.interval
+            self.recent_slots.append(slot)
+        return slot - now
+    
+    def wait_if_needed(self):
+        delay = self.reserve()
+        if delay > 0:
+            add_timing('limiter_wait', delay)
+            time.sleep(delay)
+    
+    def set_rate(self, max_queries):
+        """Change the steady request rate (the cap per time window stays at the quota)"""
+        with self.lock:
+            self.interval = self.time_window / max_queries
+
+# Adaptive concurrency controller (AIMD): requests take a slot before they are sent; the number
+# of slots grows additively while responses succeed at a stable latency and is cut
+# multiplicatively on overload, so the run converges on the highest level the API key sustains
+class ConcurrencyController:
+    def __init__(self, initial, min_limit, max_limit, rate_limiter=None, decrease=0.5,
+                 latency_tolerance=2.0, min_rate_share=0.1):
+        self.condition = threading.Condition()
+        self.async_condition = None
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.limit = float(min(max(initial, min_limit), max_limit))
+        self.peak_limit = self.limit
+        self.in_flight = 0
+        self.decrease = decrease
+        self.latency_tolerance = latency_tolerance
+        self.recent_latency = None    # Smoothed latency of the latest responses
+        self.baseline_latency = None  # Latency without queueing at the API (slowly forgotten minimum)
+        self.last_decrease = float('-inf')
+        self.last_rate_decrease = float('-inf')
+        self.decreases = 0
+        
+        # Sustained 429s also lower the request rate of the rate limiter, which then recovers toward the quota
+        self.rate_limiter = rate_limiter
+        self.throttled = collections.deque(maxlen=50)  # Whether each of the latest responses was a 429
+        if rate_limiter:
+            self.max_rate = rate_limiter.max_queries
+            self.min_rate = max(1, self.max_rate * min_rate_share)
+            self.rate = self.max_rate
+    
+    def try_acquire(self):
+        if self.in_flight < int(self.limit):
+            self.in_flight += 1
+            return True
+        return False
+    
+    @contextlib.contextmanager
+    def slot(self):
+        """Hold a request slot while sending; set outcome['status'] to the HTTP status of the response"""
+        with self.condition:
+            self.condition.wait_for(self.try_acquire)
+        outcome = {'status': None}
+        start = time.perf_counter()
+        try:
+            yield outcome
+        finally:
+            with self.condition:
+                self.update(time.perf_counter() - start, outcome['status'])
+                self.condition.notify_all()
+    
+    @contextlib.asynccontextmanager
+    async def async_slot(self):
+        """slot() for the asyncio engine (its requests all run on one event loop)"""
+        if self.async_condition is None:
+            self.async_condition = asyncio.Condition()
+        async with self.async_condition:
+            await self.async_condition.wait_for(self.try_acquire)
+        outcome = {'status': None}
+        start = time.perf_counter()
+        try:
+            yield outcome
+        finally:
+            self.update(time.perf_counter() - start, outcome['status'])
+            async with self.async_condition:
+                self.async_condition.notify_all()
+    
+    def update(self, latency, status):
+        """Release a slot and adjust the limits to the outcome of its request"""
+        saturated = self.in_flight >= int(self.limit)
+        self.in_flight -= 1
+        self.throttled.append(status == 429)
+        
+        if status is None or status in OVERLOAD_STATUSES:
+            now = time.monotonic()
             
-            # If we're at the limit, wait until we can make another request
-            if len(self.query_times) >= self.max_queries:
-                oldest = min(self.query_times)
-                sleep_time = oldest + self.time_window - now
-                if sleep_time > 0:
-                    time.sleep(sleep_time)
+            # Overload: cut once per round trip, the other failures of the same burst carry the same signal
+            if now - self.last_decrease >= (self.recent_latency or 0):
+                self.last_decrease = now
+                self.decreases += 1
+                self.limit = max(self.min_limit, self.limit * self.decrease)
             
-            # Add current timestamp and return
-            self.query_times.append(time.time())
+            # An occasional 429 is noise, a run of them means the key's quota is below the rate
+            # (cut once per quota window: the window keeps answering 429 for a while after a cut)
+            if (status == 429 and self.rate_limiter and sum(self.throttled) >= 0.1 * len(self.throttled)
+                    and now - self.last_rate_decrease >= self.rate_limiter.time_window):
+                self.last_rate_decrease = now
+                self.rate = max(self.min_rate, self.rate * self.decrease)
+                self.rate_limiter.set_rate(self.rate)
+            return
+        
+        self.recent_latency = latency if self.recent_latency is None else 0.7 * self.recent_latency + 0.3 * latency
+        self.baseline_latency = min(self.recent_latency, (self.baseline_latency or latency) * 1.01)
+        
+        # The rate grows back by 10% of the quota per round of successful requests
+        if self.rate_limiter and self.rate < self.max_rate:
+            self.rate = min(self.max_rate, self.rate + self.max_rate * 0.1 / self.rate)
+            self.rate_limiter.set_rate(self.rate)
+        
+        # One more slot per round of requests (twice as many per round until the first overload, like
+        # TCP slow start), as long as the slots are used and latency holds
+        if saturated and self.recent_latency <= self.baseline_latency * self.latency_tolerance:
+            self.limit = min(self.max_limit, self.limit + (1 if self.decreases == 0 else 1 / self.limit))
+            self.peak_limit = max(self.peak_limit, self.limit)
+    
+    def summary(self):
+        text = f"{self.limit:.1f} requests in flight at the end (peak {self.peak_limit:.1f}), {self.decreases} backoffs"
+        if self.rate_limiter:
+            text += f", request rate {self.rate:.0f} of {self.max_rate} per window"
+        return text
 
-# Function to get data from PageSpeed Insights API for a specific URL
-def get_psi_data(url, rate_limiter):
-    # Wait if needed to respect rate limits
-    rate_limiter.wait_if_needed()
+# Function to create the concurrency controller of a run: adaptive between MIN_CONCURRENCY and
+# max_concurrency, or fixed at max_concurrency with ADAPTIVE_CONCURRENCY = False
+def new_concurrency_controller(max_concurrency, rate_limiter):
+    if not ADAPTIVE_CONCURRENCY:
+        return ConcurrencyController(max_concurrency, max_concurrency, max_concurrency)
+    return ConcurrencyController(INITIAL_CONCURRENCY, MIN_CONCURRENCY, max_concurrency, rate_limiter,
+                                 AIMD_DECREASE, AIMD_LATENCY_TOLERANCE, MIN_RATE_SHARE)
+
+concurrency_controller = new_concurrency_controller(MAX_CONCURRENT_REQUESTS, None)
+
+# Thread-safe retry policy with capped exponential backoff, full jitter and a per-run budget
+class RetryPolicy:
+    def __init__(self, max_retries, base_delay, max_delay, budget):
+        self.lock = threading.Lock()
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = budget
+        self.retries = collections.Counter()   # Retries by reason
+        self.failures = collections.Counter()  # Requests given up by reason
+        # Transport errors worth retrying (the async engine adds the httpx equivalents)
+        self.timeout_errors = http_transport.timeout_errors
+        self.connection_errors = http_transport.connection_errors
     
-    # Prepare request parameters
+    def classify(self, response=None, error=None):
+        """Return the failure reason and whether it is worth retrying"""
+        if error is not None:
+            if isinstance(error, self.timeout_errors):
+                return "timeout", True
+            if isinstance(error, self.connection_errors):
+                return "connection error", True
+            return type(error).__name__, False
+        return f"HTTP {response.status_code}", response.status_code in RETRYABLE_STATUS_CODES
+    
+    def retry_after(self, response):
+        """Seconds requested by a Retry-After header (delta-seconds or HTTP date)"""
+        value = response.headers.get('Retry-After') if response is not None else None
+        if not value:
+            return 0
+        if value.strip().isdigit():
+            return int(value)
+        try:
+            return max(0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return 0
+    
+    def extend_budget(self, amount):
+        """Allow more retries (streamed runs grow the budget with every URL queued)"""
+        with self.lock:
+            self.budget += amount
+    
+    def next_delay(self, attempt, response=None, error=None):
+        """Return the seconds to wait before retrying, or None to give up"""
+        reason, retryable = self.classify(response, error)
+        with self.lock:
+            if not retryable or attempt >= self.max_retries or self.budget <= 0:
+                self.failures[reason] += 1
+                return None
+            self.budget -= 1
+            self.retries[reason] += 1
+        
+        # Full jitter spreads retries of concurrent workers instead of firing them together
+        backoff = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        return max(backoff, self.retry_after(response))
+
+# Function to build the partial-response field mask for runPagespeed
+def build_fields_mask():
+    audits = ",".join(f"{audit}(numericValue,score)" for audit in LAB_AUDITS)
+    metrics = ",".join(f"{metric}(percentile,category)" for metric in FIELD_METRICS)
+    return (f"lighthouseResult(finalUrl,categories/performance/score,audits({audits})),"
+            f"loadingExperience(metrics({metrics}))")
+
+# Function to get the request parameters for a URL
+def get_psi_params(url):
     params = {
         'url': url,
         'key': API_KEY,
         'strategy': STRATEGY,
         'category': 'performance',
     }
+    # Skip screenshots, filmstrips and unused audits (the archive keeps full responses)
+    if USE_FIELDS_MASK and not response_archive:
+        params['fields'] = build_fields_mask()
+    return params
+
+# Function to get data from PageSpeed Insights API for a specific URL
+def get_psi_data(url, rate_limiter, retry_policy):
+    # Prepare request parameters
+    params = get_psi_params(url)
     
-    try:
-        response = requests.get(API_URL, params=params, timeout=60)
+    attempt = 0
+    while True:
+        # Wait if needed to respect rate limits
+        rate_limiter.wait_if_needed()
         
-        if response.status_code == 200:
-            return response.json()
-        elif response.status_code == 429:  # Rate limit exceeded
-            time.sleep(5)  # Wait a bit longer before retry
-            return get_psi_data(url, rate_limiter)  # Retry
-        else:
+        response = error = None
+        try:
+            with concurrency_controller.slot() as outcome:
+                response = http_transport.get(API_URL, params=params, timeout=60)
+                outcome['status'] = response.status_code
+            if response.status_code == 200:
+                if response_archive:
+                    response_archive.put(url, STRATEGY, response.content)
+                start = time.perf_counter()
+                data = json_loads(response.content)
+                add_timing('parse', time.perf_counter() - start)
+                return data
+        except Exception as e:
+            error = e
+        
+        # Back off and retry, or give up when the error is permanent or the budget is spent
+        delay = retry_policy.next_delay(attempt, response, error)
+        if delay is None:
             return None
-    except Exception as e:
-        return None
+        add_timing('retry_wait', delay)
+        time.sleep(delay)
+        attempt += 1
+
+# Async version of get_psi_data() for the asyncio engine
+async def async_get_psi_data(client, url, rate_limiter, retry_policy):
+    # Prepare request parameters
+    params = get_psi_params(url)
+    
+    attempt = 0
+    while True:
+        # Wait for our slot without blocking the event loop
+        delay = rate_limiter.reserve()
+        if delay > 0:
+            add_timing('limiter_wait', delay)
+            await asyncio.sleep(delay)
+        
+        # Connection and response header events of the request, for the phase timings
+        events = {}
+        async def trace(event_name, info):
+            events[event_name] = time.perf_counter()
+        
+        response = error = None
+        try:
+            async with concurrency_controller.async_slot() as outcome:
+                start = time.perf_counter()
+                response = await client.get(API_URL, params=params, extensions={'trace': trace})
+                add_trace_timings(events, start, time.perf_counter())
+                outcome['status'] = response.status_code
+            if response.status_code == 200:
+                # The compressed archive write runs off the event loop, so other requests keep going
+                if response_archive:
+                    await asyncio.to_thread(response_archive.put, url, STRATEGY, response.content)
+                start = time.perf_counter()
+                data = json_loads(response.content)
+                add_timing('parse', time.perf_counter() - start)
+                return data
+        except Exception as e:
+            error = e
+        
+        # Back off and retry, or give up when the error is permanent or the budget is spent
+        delay = retry_policy.next_delay(attempt, response, error)
+        if delay is None:
+            return None
+        add_timing('retry_wait', delay)
+        await asyncio.sleep(delay)
+        attempt += 1
 
 # Function to process a single URL and return the result
-def process_url(url, rate_limiter, pbar=None):
-    data = get_psi_data(url, rate_limiter)
+def process_url(url, rate_limiter, retry_policy, pbar=None):
+    # Known redirect targets of audited URLs reuse that audit
+    if not url_index.claim(url):
+        if pbar:
+            pbar.update(1)
+        return None
+    
+    data = get_psi_data(url, rate_limiter, retry_policy)
     
     if pbar:
         pbar.update(1)
-        
+    
+    return build_run_result(url, data)
+
+# Function to build the result row of one run; with several runs per URL the row also keeps
+# the raw lab numbers (raw_* columns) that aggregate_runs() reduces to medians
+def build_run_result(url, data):
+    if data and 'lighthouseResult' in data and data['lighthouseResult'].get('finalUrl'):
+        url_index.record_redirect(url, data['lighthouseResult']['finalUrl'])
+    start = time.perf_counter()
+    result = build_result(url, data)
+    add_timing('extract', time.perf_counter() - start)
+    if LAB_RUNS > 1:
+        lighthouse = (data or {}).get('lighthouseResult') or {}
+        audits = lighthouse.get('audits') or {}
+        performance = (lighthouse.get('categories') or {}).get('performance') or {}
+        result['raw_performance_score'] = performance.get('score')
+        for audit, prefix in LAB_METRICS:
+            result[f'raw_{prefix}_value'] = (audits.get(audit) or {}).get('numericValue')
+            result[f'raw_{prefix}_score'] = (audits.get(audit) or {}).get('score')
+    
+    # Failed audits are not journaled, so a resumed run tries them again
+    if run_journal and result['lab_cwv_status'] not in ('error', 'no data'):
+        run_journal.write(result)
+    return result
+
+# Function to build the result row for a URL from its PSI response
+def build_result(url, data):
     if data and 'lighthouseResult' in data:
         try:
             # Extract overall performance score
@@ -313,45 +1521,151 @@ def process_url(url, rate_limiter, pbar=None):
             }
         except Exception as e:
             # Return a row with error information
-            return {
-                "url": url,
-                "strategy": STRATEGY,
-                "performance_score": None,
-                
-                "lab_cwv_status": "error",
-                "lab_lcp_score": "error", "lab_lcp_value": None,
-                "lab_cls_score": "error", "lab_cls_value": None,
-                "lab_fcp_score": "error", "lab_fcp_value": None,
-                "lab_tbt_score": "error", "lab_tbt_value": None,
-                "lab_tti_score": "error", "lab_tti_value": None,
-                "lab_si_score": "error", "lab_si_value": None,
-                
-                "field_cwv_status": "error",
-                "field_lcp_status": "error", "field_lcp_value": None,
-                "field_cls_status": "error", "field_cls_value": None,
-                "field_fid_status": "error", "field_fid_value": None
-            }
+            return empty_result(url, "error")
     
     # Return a row for URLs that failed to fetch data
+    return empty_result(url, "no data")
+
+# Function to build a result row without metrics, marked with the given status
+def empty_result(url, status):
     return {
         "url": url,
         "strategy": STRATEGY,
         "performance_score": None,
         
-        "lab_cwv_status": "no data",
-        "lab_lcp_score": "no data", "lab_lcp_value": None,
-        "lab_cls_score": "no data", "lab_cls_value": None,
-        "lab_fcp_score": "no data", "lab_fcp_value": None,
-        "lab_tbt_score": "no data", "lab_tbt_value": None,
-        "lab_tti_score": "no data", "lab_tti_value": None,
-        "lab_si_score": "no data", "lab_si_value": None,
+        "lab_cwv_status": status,
+        "lab_lcp_score": status, "lab_lcp_value": None,
+        "lab_cls_score": status, "lab_cls_value": None,
+        "lab_fcp_score": status, "lab_fcp_value": None,
+        "lab_tbt_score": status, "lab_tbt_value": None,
+        "lab_tti_score": status, "lab_tti_value": None,
+        "lab_si_score": status, "lab_si_value": None,
         
-        "field_cwv_status": "no data",
-        "field_lcp_status": "no data", "field_lcp_value": None,
-        "field_cls_status": "no data", "field_cls_value": None,
-        "field_fid_status": "no data", "field_fid_value": None
+        "field_cwv_status": status,
+        "field_lcp_status": status, "field_lcp_value": None,
+        "field_cls_status": status, "field_cls_value": None,
+        "field_fid_status": status, "field_fid_value": None
     }
 
+# Function to combine the runs of each URL into one row: lab metrics become the median of the
+# successful runs (plus the IQR of each value), field data is taken from the first successful run
+def aggregate_runs(df):
+    import numpy as np
+    
+    raw_columns = [column for column in df.columns if column.startswith('raw_')]
+    
+    # One representative row per URL for the field data and for URLs without any successful run
+    order = df['raw_performance_score'].isna().to_numpy().argsort(kind='stable')
+    rows = df.iloc[order].drop_duplicates('url').set_index('url')
+    
+    grouped = df.groupby('url', sort=False)[raw_columns]
+    median = grouped.median()
+    rows = rows.reindex(median.index)
+    iqr = grouped.quantile(0.75) - grouped.quantile(0.25)
+    measured = median['raw_performance_score'].notna()
+    rows['lab_runs'] = grouped.count()['raw_performance_score']
+    
+    m = median[measured]
+    rows.loc[measured, 'performance_score'] = (m['raw_performance_score'] * 100).round(1)
+    for _, prefix in LAB_METRICS:
+        value, score = m[f'raw_{prefix}_value'], m[f'raw_{prefix}_score']
+        # Same rounding and categories as format_ms/format_cls and score_to_text
+        rows.loc[measured, f'lab_{prefix}_value'] = value.round(2 if prefix == 'cls' else 0)
+        rows.loc[measured, f'lab_{prefix}_score'] = np.select(
+            [score >= 0.9, score >= 0.5, score < 0.5], ['good', 'needs improvement', 'poor'], 'no data')
+        rows[f'lab_{prefix}_iqr'] = iqr[f'raw_{prefix}_value'].round(3 if prefix == 'cls' else 0)
+    
+    # Lab status from the median scores (TBT stands in for FID, as in check_lab_cwv_status)
+    cwv_scores = m[['raw_lcp_score', 'raw_cls_score', 'raw_tbt_score']]
+    rows.loc[measured, 'lab_cwv_status'] = np.where(
+        cwv_scores.isna().any(axis=1), 'insufficient data',
+        np.where((cwv_scores >= 0.9).all(axis=1), 'passed', 'failed'))
+    
+    return rows.drop(columns=raw_columns).reset_index()
+
+# Asyncio engine: a pool of coroutines shares one connection pool, so the number of requests
+# in flight is limited by the rate limiter and MAX_IN_FLIGHT instead of the thread count
+async def run_async_engine(urls, rate_limiter, retry_policy, pbar):
+    import httpx
+    retry_policy.timeout_errors += (httpx.TimeoutException,)
+    retry_policy.connection_errors += (httpx.TransportError,)
+    
+    results = []
+    url_iterator = iter(urls)
+    streamed = not isinstance(urls, list)
+    next_lock = asyncio.Lock()
+    
+    # Streamed URLs may have to wait for the sitemap download, which happens outside the event loop
+    async def next_url():
+        if not streamed:
+            return next(url_iterator, None)
+        async with next_lock:
+            return await asyncio.get_running_loop().run_in_executor(None, next, url_iterator, None)
+    
+    # Same transport settings as the thread engine, sized for MAX_IN_FLIGHT
+    limits = httpx.Limits(max_connections=MAX_IN_FLIGHT, max_keepalive_connections=MAX_IN_FLIGHT)
+    async with httpx.AsyncClient(limits=limits, timeout=60, http2=HTTP2_ENABLED,
+                                 headers={'Accept-Encoding': 'gzip, deflate'}) as client:
+        async def worker():
+            while True:
+                url = await next_url()
+                if url is None:
+                    break
+                # Known redirect targets of audited URLs reuse that audit
+                if not url_index.claim(url):
+                    pbar.update(1)
+                    continue
+                with request_metrics.track(url=url):
+                    try:
+                        data = await async_get_psi_data(client, url, rate_limiter, retry_policy)
+                        # Extraction and the journal write (fsync) run off the event loop
+                        result = await asyncio.to_thread(build_run_result, url, data)
+                    except Exception:
+                        result = empty_result(url, "error")
+                pbar.update(1)
+                results.append(result)
+        
+        workers = MAX_IN_FLIGHT if streamed else min(MAX_IN_FLIGHT, len(urls))
+        await asyncio.gather(*(worker() for _ in range(workers)))
+    return results
+
+# Function to run a coroutine from a script or from a notebook cell
+def run_coroutine(coro):
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    # Notebook kernels (Colab, Jupyter) already run an event loop, so use a separate thread
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coro).result()
+
+# Function to have the audits of a distributed run done by the workers of its work queue and
+# collect their result rows in task order (results already in the queue are reused)
+def run_queue_coordinator(tasks, queue, pbar):
+    # Repeated audits of a URL (LAB_RUNS > 1) are separate tasks
+    runs = collections.Counter()
+    order = []
+    for url in tasks:
+        runs[url] += 1
+        order.append((url, runs[url]))
+        if len(order) % WORK_QUEUE_BATCH == 0:
+            queue.push(order[-WORK_QUEUE_BATCH:])
+    queue.push(order[-(len(order) % WORK_QUEUE_BATCH):] if len(order) % WORK_QUEUE_BATCH else [])
+    
+    rows = {}
+    waiting = set(order)
+    cursor = 0
+    while waiting:
+        entries, cursor = queue.results_since(cursor)
+        for task, result in entries:
+            if task in waiting:
+                waiting.discard(task)
+                rows[task] = result
+                pbar.update(1)
+        if waiting:
+            time.sleep(WORK_QUEUE_POLL_INTERVAL)
+    return [rows[task] for task in order if rows[task]]
+
 # Helper functions for formatting and categorization
 def format_ms(value):
     """Format milliseconds to nearest integer"""
@@ -408,126 +1722,652 @@ def check_field_cwv_status(lcp_status, cls_status, fid_status):
     else:
         return "failed"
 
-# Main process - Now we have URLs either from sitemap or uploaded file
-print(f"Processing {len(urls)} URLs...")
+# Function to run a PSI batch and return the results table; the output file is written to the
+# working directory (its name is in df.attrs['output_file']) and downloaded in Colab with download=True.
+# URLs come from `urls` (a list or an iterable), the lines of `url_file`, the sitemaps of `domain`
+# (or the given `sitemaps`) or, with reextract=True, the raw response archive.
+# resume=None asks before resuming a journal. With a work_queue (an SQLite file or a redis:// URL)
+# the audits are run by the workers of that queue (run_psi_worker()) and this run collects their results.
+def run_psi_batch(urls=None, url_file=None, domain=None, sitemaps=None, reextract=False, max_urls=None,
+                  strategy='mobile', lab_runs=1, sampling=False, incremental=False, resume=True,
+                  download=False, api_key=None, work_queue=None):
+    global API_KEY, STRATEGY, LAB_RUNS, REEXTRACT, url_index, response_archive, run_journal, request_metrics
+    global concurrency_controller
+    import pandas as pd
+    
+    if api_key:
+        API_KEY = api_key
+    if strategy not in ('mobile', 'desktop'):
+        raise ValueError(f"Unknown strategy: {strategy!r} (expected 'mobile' or 'desktop')")
+    STRATEGY = strategy
+    LAB_RUNS = max(1, int(lab_runs))
+    REEXTRACT = reextract
+    SAMPLING = bool(sampling) and not REEXTRACT
+    INCREMENTAL = bool(incremental) and not (SAMPLING or REEXTRACT)
+    
+    # Fresh per-run state (the module can run several batches in one process)
+    url_index = UrlIndex(CANONICAL_RULES if CANONICALIZE_URLS else {})
+    carried_results.clear()
+    run_journal = None
+    
+    # Re-extraction reads the archive instead of querying the API
+    response_archive = ResponseArchive(ARCHIVE_DIR) if ARCHIVE_ENABLED or REEXTRACT else None
+    
+    if REEXTRACT:
+        urls = response_archive.urls()
+        print(f"Found {len(urls)} URLs in the archive '{ARCHIVE_DIR}'")
+    elif url_file is not None:
+        with open(url_file, 'rb') as f:
+            urls = read_url_list(f.read())
+        print(f"Found {len(urls)} URLs in {url_file}")
+    elif urls is not None and not isinstance(urls, list):
+        # Sized collections are read at once, other iterables are streamed like a sitemap
+        urls = list(urls) if hasattr(urls, '__len__') else peek(iter(urls))
+    
+    if domain and not domain.startswith(('http://', 'https://')):
+        domain = 'https://' + domain
+    if isinstance(urls, list):
+        # Sitemap details of an earlier run do not apply to a URL list
+        sitemap_entries.clear()
+    elif urls is None and (domain or sitemaps):
+        print(f"\nFetching sitemap from {domain or ', '.join(sitemaps)}...")
+        urls = get_urls_from_sitemap(domain, sitemaps)
+        if not urls:
+            print("Couldn't get URLs from sitemap.")
+    elif urls is None and not REEXTRACT:
+        raise ValueError("No URL source: pass urls, url_file, domain, sitemaps or reextract=True")
+    
+    # Check if we have URLs to process
+    if not urls:
+        print("No URLs found.")
+        return pd.DataFrame()
+    
+    # Query each page only once (duplicates are filled in from its result at the end)
+    if isinstance(urls, list):
+        urls = list(url_index.dedup(urls))
+        if url_index.duplicates:
+            print(f"Skipping {url_index.duplicates} duplicate URLs (same page after canonicalization)")
+    else:
+        urls = url_index.dedup(urls)
+    
+    # Limit URLs if needed
+    if max_urls:
+        if not isinstance(urls, list):
+            print(f"Limiting analysis to the first {max_urls} URLs of the sitemap.")
+            urls = itertools.islice(urls, max_urls)
+        elif max_urls < len(urls):
+            print(f"Limiting analysis to {max_urls} URLs out of {len(urls)} found.")
+            urls = urls[:max_urls]
+    
+    if SAMPLING:
+        urls = list(urls)
+        urls, url_template_map, template_sizes = sample_by_template(urls)
+        print(f"Selected: Sampling - {len(urls)} URLs from {len(template_sizes)} templates "
+              f"({template_sizes.sum()} URLs in total, up to {SAMPLE_PER_TEMPLATE} per template)")
+    
+    audit_index = AuditIndex(AUDIT_INDEX_PATH) if INCREMENTAL else None
+    if INCREMENTAL:
+        if isinstance(urls, list):
+            urls = list(select_changed_urls(urls, audit_index.load(STRATEGY)))
+            print(f"Selected: Incremental mode - {len(urls)} URLs to audit, "
+                  f"{len(carried_results)} unchanged results carried forward")
+        else:
+            urls = select_changed_urls(urls, audit_index.load(STRATEGY))
+            print("Selected: Incremental mode - unchanged URLs are carried forward as the sitemap is read")
+    
+    
+    # Main process - Now we have URLs either from sitemap or uploaded file
+    # (sitemap URLs are streamed, so their number is only known at the end)
+    if isinstance(urls, list):
+        print(f"Processing {len(urls)} URLs...")
+    else:
+        print("Processing URLs as they are read from the sitemap...")
+
+    # Display device selection summary
+    print(f"\nAnalyzing URLs using device type: {STRATEGY}")
 
-# Display device selection summary
-print(f"\nAnalyzing URLs using device type: {STRATEGY}")
+    print(f"Rate limit: {RATE_LIMIT_QUERIES} queries per {RATE_LIMIT_WINDOW} seconds (bursts of up to {RATE_LIMIT_BURST})")
+    # The async engine needs httpx (preinstalled on Colab)
+    engine = ENGINE
+    if engine == 'async':
+        try:
+            import httpx
+        except ImportError:
+            print("httpx is not installed - falling back to the thread pool engine")
+            engine = 'threads'
 
-print(f"Rate limit: {RATE_LIMIT_QUERIES} queries per {RATE_LIMIT_WINDOW} seconds")
-print(f"Using {MAX_CONCURRENT_REQUESTS} concurrent requests")
+    max_concurrency = MAX_IN_FLIGHT if engine == 'async' else MAX_CONCURRENT_REQUESTS
+    if engine == 'async':
+        print(f"Using asyncio engine with up to {MAX_IN_FLIGHT} requests in flight")
+    else:
+        print(f"Using {MAX_CONCURRENT_REQUESTS} concurrent requests")
+    if ADAPTIVE_CONCURRENCY:
+        print(f"Adaptive concurrency: starting at {INITIAL_CONCURRENCY}, up to {max_concurrency} requests in flight")
 
-# Prepare data structure
-results = []
+    # Every URL is audited LAB_RUNS times; the runs are interleaved (all URLs once, then again)
+    # so repeats of a URL are spread across the run instead of hitting the same warm caches
+    # (interleaving needs the full list, so only single runs are streamed)
+    if isinstance(urls, list) or LAB_RUNS > 1:
+        urls = list(urls)
+        tasks = [url for run in range(LAB_RUNS) for url in urls]
+    else:
+        tasks = urls
 
-# Initialize rate limiter
-rate_limiter = RateLimiter(RATE_LIMIT_QUERIES, RATE_LIMIT_WINDOW)
+    # Prepare data structure
+    results = []
 
-# Calculate estimated time (PSI is slower than CrUX)
-estimated_time = len(urls) * 5  # Rough estimate: 5 seconds per URL
-print(f"Estimated processing time: {estimated_time:.1f} seconds ({estimated_time/60:.1f} minutes)")
-print("Note: PageSpeed Insights runs full page analysis and may take longer than estimated.")
+    # Resume an interrupted run with the same settings and input: journaled audits are not repeated
+    # (a streamed run is identified by its sitemaps, as its URLs are only known once they are read)
+    resumed_results = []
+    if isinstance(urls, list):
+        input_digest = hashlib.sha256('\n'.join(urls).encode()).hexdigest()
+    else:
+        input_digest = hashlib.sha256(json.dumps([domain, sitemaps, max_urls]).encode()).hexdigest()
+    journal_config = {'strategy': STRATEGY, 'lab_runs': LAB_RUNS, 'fields_mask': USE_FIELDS_MASK and not response_archive,
+                      'input': input_digest}
+    
+    # Distributed run: the audits go to the work queue (which also keeps the results of an interrupted run)
+    queue = None
+    if work_queue and not REEXTRACT:
+        queue = open_work_queue(work_queue)
+        done_tasks = queue.open_job(journal_config, resume is not False)
+        if done_tasks:
+            print(f"Resuming: {done_tasks} results taken from the work queue '{work_queue}'")
+        print(f"Distributed run: audits are run by the workers of '{work_queue}' (start them with --worker --work-queue)")
+    elif JOURNAL_ENABLED and not REEXTRACT:
+        run_journal = RunJournal(JOURNAL_PATH)
+        entries = run_journal.load(journal_config)
+        if entries and resume is None:
+            resume_choice = input(f"\nFound {len(entries)} results of an interrupted run with the same settings. Resume it? (Y/n): ")
+            resume = resume_choice.strip().lower() not in ('n', 'no')
+        if entries and resume:
+            resumed_results = entries
+        run_journal.start(journal_config, resumed_results)
+    
+        if resumed_results:
+            # Skip one queued audit of a URL for every journaled run of it
+            completed = collections.Counter(row['url'] for row in resumed_results)
+        
+            def skip_completed(urls):
+                for url in urls:
+                    if completed[url]:
+                        completed[url] -= 1
+                    else:
+                        yield url
+            tasks = list(skip_completed(tasks)) if isinstance(tasks, list) else skip_completed(tasks)
+            print(f"Resuming: {len(resumed_results)} results taken from the journal '{JOURNAL_PATH}'")
+
+    # Initialize rate limiter and retry policy
+    rate_limiter = RateLimiter(RATE_LIMIT_QUERIES, RATE_LIMIT_WINDOW, RATE_LIMIT_BURST)
+    concurrency_controller = new_concurrency_controller(max_concurrency, rate_limiter)
+    if isinstance(tasks, list):
+        retry_policy = RetryPolicy(MAX_RETRIES, RETRY_BASE_DELAY, RETRY_MAX_DELAY, max(10, int(len(tasks) * RETRY_BUDGET_RATIO)))
+    
+        # Calculate estimated time (PSI is slower than CrUX)
+        estimated_time = len(tasks) * 5  # Rough estimate: 5 seconds per audit
+        print(f"Estimated processing time: {estimated_time:.1f} seconds ({estimated_time/60:.1f} minutes)")
+        print("Note: PageSpeed Insights runs full page analysis and may take longer than estimated.")
+    else:
+        # The retry budget grows with every streamed URL
+        retry_policy = RetryPolicy(MAX_RETRIES, RETRY_BASE_DELAY, RETRY_MAX_DELAY, 10)
+    
+        def budgeted(urls):
+            for url in urls:
+                retry_policy.extend_budget(RETRY_BUDGET_RATIO)
+                yield url
+        tasks = budgeted(tasks)
 
-start_time = time.time()
+    # Phase timings of every audit (written periodically while the run goes on)
+    request_metrics = RequestMetrics('psi', METRICS_PATH, METRICS_FORMAT, METRICS_BUCKETS)
+    if METRICS_ENABLED and not REEXTRACT and not queue:
+        request_metrics.start(METRICS_FLUSH_INTERVAL)
 
-# Create a progress bar
-with tqdm(total=len(urls), desc="Processing URLs") as pbar:
-    # Use ThreadPoolExecutor for parallel processing
+    start_time = time.time()
+
+    if REEXTRACT:
+        # Rebuild every row from the latest archived response for the selected strategy
+        results = [build_result(url, response_archive.get_latest(url, STRATEGY)) for url in urls]
+    else:
+        # Create a progress bar (a notebook widget in Colab and Jupyter)
+        if 'ipykernel' in sys.modules:
+            from tqdm.notebook import tqdm
+        else:
+            from tqdm import tqdm
+        with tqdm(total=len(tasks) if isinstance(tasks, list) else None, desc="Processing URLs") as pbar:
+            if queue:
+                results = run_queue_coordinator(tasks, queue, pbar)
+            elif engine == 'async':
+                results = run_coroutine(run_async_engine(tasks, rate_limiter, retry_policy, pbar))
+            else:
+                # Use ThreadPoolExecutor for parallel processing
+                with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS) as executor:
+                    future_to_url = {}
+                
+                    # Function to collect the results of finished tasks
+                    def collect(done):
+                        for future in done:
+                            url = future_to_url.pop(future)
+                            try:
+                                result = future.result()
+                                if result:
+                                    results.append(result)
+                            except Exception:
+                                # Add a failure entry
+                                results.append(empty_result(url, "error"))
+                
+                    # Submit tasks as URLs arrive, keeping only a few waiting tasks per worker
+                    for url in tasks:
+                        if len(future_to_url) >= MAX_CONCURRENT_REQUESTS * 2:
+                            done, _ = concurrent.futures.wait(future_to_url, return_when=concurrent.futures.FIRST_COMPLETED)
+                            collect(done)
+                        future = executor.submit(request_metrics.run, process_url, url, rate_limiter, retry_policy, pbar,
+                                                 queued_at=time.perf_counter(), url=url)
+                        future_to_url[future] = url
+                
+                    # Process the remaining results as they complete
+                    collect(concurrent.futures.as_completed(list(future_to_url)))
+
+    end_time = time.time()
+    # Journaled rows count only for URLs that are in this run's input
+    queried = {urls[0] for urls in url_index.aliases.values()}
+    results = [row for row in resumed_results if row['url'] in queried] + results
+    if queue:
+        # Let the workers stop
+        queue.finish()
+        queue.close()
+    http_transport.close()
+    if response_archive:
+        response_archive.close()
+    elapsed_time = end_time - start_time
+    if request_metrics.active:
+        request_metrics.close()
+        print(f"\nRequest phases (metrics written to '{request_metrics.path}'):")
+        for line in request_metrics.summary():
+            print(f"  {line}")
+    if ADAPTIVE_CONCURRENCY and not queue:
+        print(f"Adaptive concurrency: {concurrency_controller.summary()}")
+
+    # Create DataFrame
+    if results or carried_results:
+        df = pd.DataFrame(results)
+        if 'raw_performance_score' in df:
+            df = aggregate_runs(df)
+            results = df.to_dict('records')
+    
+        # Remember the new audits (failed ones are retried next time) and add the carried-forward rows
+        if INCREMENTAL:
+            audited = [row for row in results if row['lab_cwv_status'] not in ('error', 'no data')]
+            audit_index.put_many(STRATEGY, audited,
+                                 {url: lastmod for url, (lastmod, _) in sitemap_entries.items()})
+            audit_index.close()
+            df['carried_forward'] = False
+            if carried_results:
+                carried = pd.DataFrame(carried_results)
+                carried['carried_forward'] = True
+                df = pd.concat([df, carried], ignore_index=True)
+            results = df.to_dict('records')
+    
+        # One row per input URL: duplicates and redirect targets get the row of the URL that was queried
+        df = fan_out(df)
+        if SAMPLING:
+            df['template'] = df['queried_url'].map(url_template_map)
+    
+        # Sitemap lastmod and priority of each URL
+        if sitemap_entries:
+            df['sitemap_lastmod'] = df['url'].map(lambda url: sitemap_entries.get(url, (None, None))[0])
+            df['sitemap_priority'] = df['url'].map(lambda url: sitemap_entries.get(url, (None, None))[1])
+    
+        # Create a CSV version
+        site_name = domain.replace('https://', '').replace('http://', '').replace('www.', '').split('/')[0] if domain else "custom"
+        output_filename = f"psi_results_{site_name}_{STRATEGY}_{time.strftime('%Y%m%d_%H%M%S')}.csv"
+        df.to_csv(output_filename, index=False)
+        df.attrs['output_file'] = output_filename
+    
+        # Download the CSV file
+        if download:
+            from google.colab import files
+            files.download(output_filename)
+        if run_journal:
+            run_journal.finish()
+    
+        # Calculate statistics
+        total_urls = len(df)
+    
+        # Lab data statistics
+        lab_passed = len(df[df['lab_cwv_status'] == 'passed'])
+        lab_failed = len(df[df['lab_cwv_status'] == 'failed'])
+        lab_no_data = len(df[df['lab_cwv_status'] == 'insufficient data'])
+        lab_error = len(df[df['lab_cwv_status'] == 'error'])
+    
+        # Field data statistics
+        field_passed = len(df[df['field_cwv_status'] == 'passed'])
+        field_failed = len(df[df['field_cwv_status'] == 'failed'])
+        field_no_data = len(df[df['field_cwv_status'] == 'insufficient data'])
+        field_error = len(df[df['field_cwv_status'] == 'error'])
+    
+        # Calculate average performance score
+        avg_score = df['performance_score'].mean()
+    
+        print(f"\n===== PageSpeed Insights Results ({STRATEGY}) =====")
+        print(f"Total URLs processed: {total_urls}")
+        if url_index.duplicates or url_index.merged:
+            print(f"Queries saved: {url_index.duplicates} duplicate URLs, {len(url_index.merged)} known redirect targets")
+        if INCREMENTAL:
+            print(f"Audited: {(~df['carried_forward']).sum()}, carried forward from earlier runs: {df['carried_forward'].sum()}")
+        if 'lab_runs' in df:
+            print(f"Lab runs per URL: {LAB_RUNS} (median of {df['lab_runs'].sum()} successful runs)")
+        print(f"Average Performance Score: {avg_score:.1f}/100")
+    
+        print(f"\nLab Data - Core Web Vitals Status:")
+        print(f"✅ Passed: {lab_passed} ({lab_passed/total_urls*100:.1f}%)")
+        print(f"❌ Failed: {lab_failed} ({lab_failed/total_urls*100:.1f}%)")
+        print(f"ℹ️ Insufficient data: {lab_no_data} ({lab_no_data/total_urls*100:.1f}%)")
+        print(f"⚠️ Errors: {lab_error} ({lab_error/total_urls*100:.1f}%)")
+    
+        print(f"\nField Data - Core Web Vitals Status:")
+        print(f"✅ Passed: {field_passed} ({field_passed/total_urls*100:.1f}%)")
+        print(f"❌ Failed: {field_failed} ({field_failed/total_urls*100:.1f}%)")
+        print(f"ℹ️ Insufficient data: {field_no_data} ({field_no_data/total_urls*100:.1f}%)")
+        print(f"⚠️ Errors: {field_error} ({field_error/total_urls*100:.1f}%)")
+    
+        # Add metric-specific stats for lab data
+        print(f"\nLab Metrics (Good/Needs Improvement/Poor/No Data):")
+        for metric in ['lab_lcp_score', 'lab_cls_score', 'lab_tbt_score']:
+            metric_name = metric.split('_')[1].upper()
+            good = len(df[df[metric] == 'good'])
+            needs_improvement = len(df[df[metric] == 'needs improvement'])
+            poor = len(df[df[metric] == 'poor'])
+            no_data = len(df[df[metric] == 'no data'])
+        
+            print(f"{metric_name}: {good}/{needs_improvement}/{poor}/{no_data} " +
+                  f"({good/total_urls*100:.1f}%/{needs_improvement/total_urls*100:.1f}%/{poor/total_urls*100:.1f}%/{no_data/total_urls*100:.1f}%)")
+    
+        print(f"\nProcessing time: {elapsed_time:.1f} seconds ({elapsed_time/60:.1f} minutes)")
+        if retry_policy.retries:
+            print("Retries: " + ", ".join(f"{reason} x{count}" for reason, count in retry_policy.retries.most_common()))
+        if retry_policy.failures:
+            print("Failed requests: " + ", ".join(f"{reason} x{count}" for reason, count in retry_policy.failures.most_common()))
+        print(f"CSV file '{output_filename}' has been {'downloaded' if download else 'saved'}.")
+    
+        # Extrapolate the sample to every template and to the whole site
+        if SAMPLING:
+            template_stats, site = template_estimates(df, template_sizes)
+            templates_filename = f"psi_templates_{site_name}_{STRATEGY}_{time.strftime('%Y%m%d_%H%M%S')}.csv"
+            template_stats.to_csv(templates_filename, index=False)
+            df.attrs['templates_file'] = templates_filename
+            if download:
+                from google.colab import files
+                files.download(templates_filename)
+        
+            print(f"\nSite-wide estimates from {len(df)} sampled URLs (± {CONFIDENCE_Z} standard errors):")
+            for name, label in [('score', 'Performance score'), ('lab_pass_rate', 'Lab CWV pass rate (%)'),
+                                ('field_pass_rate', 'Field CWV pass rate (%)')]:
+                estimate, margin, covered = site[name]
+                if covered:
+                    print(f"{label}: {estimate:.1f} ± {margin:.1f} (templates covering {covered} of {template_sizes.sum()} URLs)")
+                else:
+                    print(f"{label}: no data")
+            print("\nLargest templates (score ± CI, lab pass rate ± CI):")
+            for row in template_stats.head(15).itertuples():
+                print(f"{row.template}: {row.urls} URLs, {row.sampled} sampled - "
+                      f"{row.score} ± {row.score_ci}, {row.lab_pass_rate}% ± {row.lab_pass_rate_ci}")
+            print(f"Template estimates file '{templates_filename}' has been {'downloaded' if download else 'saved'}.")
+        print("=================================================")
+    else:
+        print("\nNo valid results were obtained. Please check the API key and try again.")
+        df = pd.DataFrame()
+    return df
+
+# Function to lease tasks from a work queue, run them on a thread pool and write their results
+# back until the coordinator finishes the job (leases are renewed while their tasks run)
+def process_work_queue(work_queue, worker_id, run_task, failed_result):
+    running = {}  # {future: (task id, task)}
+    processed = 0
+    last_renewal = time.monotonic()
     with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS) as executor:
-        # Submit all tasks
-        future_to_url = {executor.submit(process_url, url, rate_limiter, pbar): url for url in urls}
+        while True:
+            # Lease only what the current concurrency limit can start, leaving the rest to other workers
+            for task_id, task in work_queue.lease(worker_id, int(concurrency_controller.limit) + 1 - len(running), LEASE_TIMEOUT):
+                running[executor.submit(run_task, task)] = (task_id, task)
+            if not running:
+                if work_queue.finished():
+                    return processed
+                time.sleep(WORK_QUEUE_POLL_INTERVAL)
+                continue
+            
+            done, _ = concurrent.futures.wait(running, timeout=WORK_QUEUE_POLL_INTERVAL,
+                                              return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                task_id, task = running.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    print(f"Task {task} failed: {e}")
+                    result = failed_result(task)
+                work_queue.complete(task_id, result)
+                processed += 1
+                if processed % 10 == 0:
+                    print(f"Progress: {processed} tasks processed by {worker_id}")
+            
+            if running and time.monotonic() - last_renewal > LEASE_TIMEOUT / 3:
+                work_queue.renew(worker_id, [task_id for task_id, _ in running.values()], LEASE_TIMEOUT)
+                last_renewal = time.monotonic()
+
+# Function to wait for the coordinator of a distributed run to open its job and return the job settings
+# (a finished job left in the queue by an earlier run is not worked on)
+def wait_for_job(work_queue):
+    while True:
+        config = work_queue.job_config()
+        if config is not None and not work_queue.finished():
+            return config
+        time.sleep(WORK_QUEUE_POLL_INTERVAL)
+
+# Function to run a worker of a distributed run: it leases audits from the work queue of a
+# coordinator (run_psi_batch() with work_queue), runs them with its own API key and rate limit,
+# and writes the result rows back until the coordinator has all of them
+def run_psi_worker(work_queue, worker_id=None, api_key=None):
+    global API_KEY, STRATEGY, LAB_RUNS, USE_FIELDS_MASK, REEXTRACT, url_index, response_archive, run_journal
+    global request_metrics, concurrency_controller
+    
+    if api_key:
+        API_KEY = api_key
+    worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+    queue = open_work_queue(work_queue)
+    
+    # The coordinator's settings decide what each audit asks for
+    config = wait_for_job(queue)
+    STRATEGY = config['strategy']
+    LAB_RUNS = config['lab_runs']
+    USE_FIELDS_MASK = config['fields_mask']
+    REEXTRACT = False
+    run_journal = None
+    url_index = UrlIndex(CANONICAL_RULES if CANONICALIZE_URLS else {})
+    response_archive = ResponseArchive(ARCHIVE_DIR) if ARCHIVE_ENABLED else None
+    rate_limiter = RateLimiter(RATE_LIMIT_QUERIES, RATE_LIMIT_WINDOW, RATE_LIMIT_BURST)
+    concurrency_controller = new_concurrency_controller(MAX_CONCURRENT_REQUESTS, rate_limiter)
+    retry_policy = RetryPolicy(MAX_RETRIES, RETRY_BASE_DELAY, RETRY_MAX_DELAY, 10)
+    request_metrics = RequestMetrics('psi', METRICS_PATH, METRICS_FORMAT, METRICS_BUCKETS)
+    if METRICS_ENABLED:
+        request_metrics.start(METRICS_FLUSH_INTERVAL)
+    print(f"Worker {worker_id}: running {STRATEGY} audits from '{work_queue}'")
+    
+    def audit(url):
+        return build_run_result(url, get_psi_data(url, rate_limiter, retry_policy))
+    
+    # The retry budget grows with every audit, as in a streamed run
+    def run_task(entry):
+        retry_policy.extend_budget(RETRY_BUDGET_RATIO)
+        return request_metrics.run(audit, entry[0], url=entry[0])
+    
+    start_time = time.time()
+    processed = process_work_queue(queue, worker_id, run_task, lambda entry: empty_result(entry[0], "error"))
+    elapsed_time = time.time() - start_time
+    
+    queue.close()
+    http_transport.close()
+    if request_metrics.active:
+        request_metrics.close()
+    if response_archive:
+        response_archive.close()
+    print(f"Worker {worker_id}: {processed} audits in {elapsed_time:.1f} seconds")
+    if ADAPTIVE_CONCURRENCY:
+        print(f"Adaptive concurrency: {concurrency_controller.summary()}")
+    return processed
+
+# Function to upload the URL list file: the Colab upload dialog, or a local path outside Colab
+def upload_url_list():
+    try:
+        from google.colab import files
+    except ImportError:
+        path = input("\nEnter the path of a text file with URLs (one URL per line): ").strip()
+        if not path:
+            return None, None
+        with open(path, 'rb') as f:
+            return os.path.basename(path), f.read()
+    
+    print("\nPlease upload a text file containing URLs (one URL per line):")
+    uploaded = files.upload()
+    if not uploaded:
+        return None, None
+    file_name = list(uploaded.keys())[0]
+    return file_name, uploaded[file_name]
+
+# Function to ask the settings of a run interactively (the Colab front-end);
+# returns the keyword arguments of run_psi_batch()
+def ask_settings():
+    settings = {'resume': None}
+    
+    # Ask user how to collect URLs
+    print("How would you like to collect URLs for analysis?")
+    print("1. Fetch URLs from a website's sitemap")
+    print("2. Upload a text file with URLs (one URL per line)")
+    print("3. Re-extract results from the raw response archive (no API calls)")
+    url_source_choice = input("Enter your choice (1, 2 or 3): ")
+    
+    if url_source_choice == '3':
+        settings['reextract'] = True
+    
+    if url_source_choice == '1':
+        # Get domain for sitemap
+        domain = input("\nEnter the domain to analyze (e.g., https://www.example.com): ")
+        if not domain.startswith(('http://', 'https://')):
+            domain = 'https://' + domain
+        settings['domain'] = domain
         
-        # Process results as they complete
-        for future in concurrent.futures.as_completed(future_to_url):
-            url = future_to_url[future]
-            try:
-                result = future.result()
-                if result:
-                    results.append(result)
-            except Exception as exc:
-                # Add a failure entry
-                results.append({
-                    "url": url,
-                    "strategy": STRATEGY,
-                    "performance_score": None,
-                    
-                    "lab_cwv_status": "error",
-                    "lab_lcp_score": "error", "lab_lcp_value": None,
-                    "lab_cls_score": "error", "lab_cls_value": None,
-                    "lab_fcp_score": "error", "lab_fcp_value": None,
-                    "lab_tbt_score": "error", "lab_tbt_value": None,
-                    "lab_tti_score": "error", "lab_tti_value": None,
-                    "lab_si_score": "error", "lab_si_value": None,
-                    
-                    "field_cwv_status": "error",
-                    "field_lcp_status": "error", "field_lcp_value": None,
-                    "field_cls_status": "error", "field_cls_value": None,
-                    "field_fid_status": "error", "field_fid_value": None
-                })
-
-end_time = time.time()
-elapsed_time = end_time - start_time
-
-# Create DataFrame
-if results:
-    df = pd.DataFrame(results)
-    
-    # Create a CSV version
-    site_name = domain.replace('https://', '').replace('http://', '').replace('www.', '').split('/')[0] if domain else "custom"
-    output_filename = f"psi_results_{site_name}_{STRATEGY}_{time.strftime('%Y%m%d_%H%M%S')}.csv"
-    df.to_csv(output_filename, index=False)
-    
-    # Download the CSV file
-    files.download(output_filename)
-    
-    # Calculate statistics
-    total_urls = len(results)
-    
-    # Lab data statistics
-    lab_passed = len(df[df['lab_cwv_status'] == 'passed'])
-    lab_failed = len(df[df['lab_cwv_status'] == 'failed'])
-    lab_no_data = len(df[df['lab_cwv_status'] == 'insufficient data'])
-    lab_error = len(df[df['lab_cwv_status'] == 'error'])
-    
-    # Field data statistics
-    field_passed = len(df[df['field_cwv_status'] == 'passed'])
-    field_failed = len(df[df['field_cwv_status'] == 'failed'])
-    field_no_data = len(df[df['field_cwv_status'] == 'insufficient data'])
-    field_error = len(df[df['field_cwv_status'] == 'error'])
-    
-    # Calculate average performance score
-    avg_score = df['performance_score'].mean()
-    
-    print(f"\n===== PageSpeed Insights Results ({STRATEGY}) =====")
-    print(f"Total URLs processed: {total_urls}")
-    print(f"Average Performance Score: {avg_score:.1f}/100")
-    
-    print(f"\nLab Data - Core Web Vitals Status:")
-    print(f"✅ Passed: {lab_passed} ({lab_passed/total_urls*100:.1f}%)")
-    print(f"❌ Failed: {lab_failed} ({lab_failed/total_urls*100:.1f}%)")
-    print(f"ℹ️ Insufficient data: {lab_no_data} ({lab_no_data/total_urls*100:.1f}%)")
-    print(f"⚠️ Errors: {lab_error} ({lab_error/total_urls*100:.1f}%)")
-    
-    print(f"\nField Data - Core Web Vitals Status:")
-    print(f"✅ Passed: {field_passed} ({field_passed/total_urls*100:.1f}%)")
-    print(f"❌ Failed: {field_failed} ({field_failed/total_urls*100:.1f}%)")
-    print(f"ℹ️ Insufficient data: {field_no_data} ({field_no_data/total_urls*100:.1f}%)")
-    print(f"⚠️ Errors: {field_error} ({field_error/total_urls*100:.1f}%)")
-    
-    # Add metric-specific stats for lab data
-    print(f"\nLab Metrics (Good/Needs Improvement/Poor/No Data):")
-    for metric in ['lab_lcp_score', 'lab_cls_score', 'lab_tbt_score']:
-        metric_name = metric.split('_')[1].upper()
-        good = len(df[df[metric] == 'good'])
-        needs_improvement = len(df[df[metric] == 'needs improvement'])
-        poor = len(df[df[metric] == 'poor'])
-        no_data = len(df[df[metric] == 'no data'])
+        print(f"\nFetching sitemap from {domain}...")
+        
+        # Get URLs from sitemap
+        urls = get_urls_from_sitemap(domain)
         
-        print(f"{metric_name}: {good}/{needs_improvement}/{poor}/{no_data} " +
-              f"({good/total_urls*100:.1f}%/{needs_improvement/total_urls*100:.1f}%/{poor/total_urls*100:.1f}%/{no_data/total_urls*100:.1f}%)")
-    
-    print(f"\nProcessing time: {elapsed_time:.1f} seconds ({elapsed_time/60:.1f} minutes)")
-    print(f"CSV file '{output_filename}' has been downloaded.")
-    print("=================================================")
-else:
-    print("\nNo valid results were obtained. Please check the API key and try again.")
+        # If sitemap approach fails, ask for manual input
+        if not urls:
+            print("\nCouldn't get URLs from sitemap. You have two options:")
+            print("1. Try a different sitemap URL")
+            print("2. Switch to file upload method")
+            fallback_choice = input("Enter your choice (1 or 2): ")
+            
+            if fallback_choice == '1':
+                custom_sitemap = input("Enter the full sitemap URL: ")
+                urls = get_urls_from_sitemap(domain, [custom_sitemap])
+                if urls:
+                    print("Reading URLs from the custom sitemap.")
+            
+            if fallback_choice == '2' or not urls:
+                print("\nSwitching to file upload method...")
+                url_source_choice = '2'  # Switch to file upload method
+        settings['urls'] = urls
+    
+    if url_source_choice == '2' or not (settings.get('urls') or settings.get('reextract')):
+        file_name, file_content = upload_url_list()
+        if not file_name:
+            print("No file was uploaded. Please run the script again.")
+            raise SystemExit
+        settings['urls'] = read_url_list(file_content)
+        print(f"Found {len(settings['urls'])} URLs in {file_name}")
+    
+    # Limit URLs if needed
+    max_urls = input("\nEnter maximum number of URLs to analyze (leave blank for all): ")
+    if max_urls.strip() and max_urls.isdigit():
+        settings['max_urls'] = int(max_urls)
+    
+    # Ask user to select device type
+    print("\nSelect device type for PageSpeed Insights analysis:")
+    print("1. Mobile - Simulates a mobile device with mobile network conditions")
+    print("2. Desktop - Simulates a desktop device with faster network")
+    device_choice = input("Enter your choice (1 or 2): ")
+    
+    if device_choice == '2':
+        settings['strategy'] = 'desktop'
+        print("\nSelected: Desktop device simulation")
+        print("This will analyze performance as experienced on desktop computers.")
+    else:
+        settings['strategy'] = 'mobile'  # Default to mobile
+        print("\nSelected: Mobile device simulation")
+        print("This will analyze performance as experienced on mobile phones.")
+    
+    # Lighthouse lab metrics vary from run to run, so several audits per URL can be combined
+    lab_runs_choice = input("\nNumber of Lighthouse runs per URL (leave blank for 1, 3 or 5 give stable medians): ").strip()
+    settings['lab_runs'] = int(lab_runs_choice) if lab_runs_choice.isdigit() and int(lab_runs_choice) > 0 else 1
+    if settings['lab_runs'] > 1:
+        print(f"Selected: {settings['lab_runs']} runs per URL, lab metrics are reported as median and IQR")
+    
+    # Sampling audits a few URLs per page template; the incremental mode only audits URLs changed
+    # since their last audit (per sitemap lastmod) or audited longer than INCREMENTAL_MAX_AGE ago
+    if not settings.get('reextract'):
+        sampling_choice = input("\nAudit only a sample of every page template (for very large sites)? (y/N): ").strip().lower()
+        settings['sampling'] = sampling_choice in ('y', 'yes')
+        if not settings['sampling']:
+            incremental_choice = input("\nOnly audit URLs changed since their last audit? (y/N): ").strip().lower()
+            settings['incremental'] = incremental_choice in ('y', 'yes')
+    return settings
+
+# Command line entry point: without arguments (and always in a notebook) the settings are asked
+# interactively, otherwise they come from the flags and/or a JSON config file with the keyword
+# arguments of run_psi_batch(), e.g.
+#   python batch-psi-api.py --sitemap https://www.example.com --strategy desktop --max-urls 200
+#   python batch-psi-api.py --config psi.json --api-key "$PSI_API_KEY"
+def main(argv=None):
+    import argparse
+    
+    if argv is None:
+        argv = [] if 'ipykernel' in sys.modules else sys.argv[1:]
+    if not argv:
+        settings = ask_settings()
+        run_psi_batch(**settings, download='google.colab' in sys.modules)
+        return
+    
+    parser = argparse.ArgumentParser(description="Run PageSpeed Insights for a batch of URLs and export the results.")
+    parser.add_argument('--config', help="JSON file with the keyword arguments of run_psi_batch() (flags override it)")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument('--sitemap', dest='domain', help="Domain whose sitemaps are read")
+    source.add_argument('--sitemap-url', dest='sitemaps', action='append', help="Sitemap URL to read (repeatable)")
+    source.add_argument('--url-file', help="Text file with URLs (one URL per line)")
+    source.add_argument('--reextract', action='store_true', default=None, help="Re-extract results from the raw response archive")
+    parser.add_argument('--max-urls', type=int, help="Maximum number of URLs to analyze")
+    parser.add_argument('--strategy', choices=['mobile', 'desktop'], help="Device simulated by Lighthouse (default: mobile)")
+    parser.add_argument('--lab-runs', type=int, help="Lighthouse runs per URL (lab metrics are the median)")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--sampling', action='store_true', default=None, help="Audit only a sample of every page template")
+    mode.add_argument('--incremental', action='store_true', default=None, help="Only audit URLs changed since their last audit")
+    parser.add_argument('--no-resume', dest='resume', action='store_false', default=None, help="Start over instead of resuming an interrupted run")
+    parser.add_argument('--api-key', help="PageSpeed Insights API key (default: the API_KEY constant)")
+    parser.add_argument('--work-queue', help="Work queue of a distributed run (SQLite file or redis:// URL): "
+                                             "the run's audits are run by the workers of the queue")
+    parser.add_argument('--worker', action='store_true', default=None, help="Work on the audits of --work-queue")
+    args = vars(parser.parse_args(argv))
+    
+    settings = {}
+    config = args.pop('config')
+    if config:
+        with open(config) as f:
+            settings.update(json.load(f))
+    settings.update({name: value for name, value in args.items() if value is not None})
+    if settings.pop('worker', False):
+        if not settings.get('work_queue'):
+            parser.error("--worker needs --work-queue")
+        run_psi_worker(settings['work_queue'], api_key=settings.get('api_key'))
+        return
+    run_psi_batch(**settings)
+
+if __name__ == '__main__':
+    main()
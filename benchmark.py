@@ -0,0 +1,436 @@
+import argparse
+import datetime
+import importlib.util
+import json
+import math
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import collections
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+from urllib.request import Request, urlopen
+
+# Offline benchmark: a local stand-in for runPagespeed, records:queryRecord and queryHistoryRecord
+# with configurable latency, error injection, quota enforcement and payload sizes. Every engine configuration runs
+# the real collectors (run_psi_batch() / run_crux_batch()) in its own process against it, e.g.
+#   python benchmark.py
+#   python benchmark.py --config bench.json --output results.json --baseline last_results.json
+
+SCRIPTS = {'psi': 'batch-psi-api.py', 'crux': 'batch-crux-api.py'}
+
+# Default scenario: what the stand-in server does (a configuration can override any key)
+DEFAULT_SCENARIO = {
+    'urls': 200,                   # URLs per configuration
+    'psi_latency': {'distribution': 'lognormal', 'median': 0.5, 'sigma': 0.6},
+    'crux_latency': {'distribution': 'lognormal', 'median': 0.08, 'sigma': 0.4},
+    'error_rates': {'404': 0.05, '429': 0.02, '500': 0.01, '503': 0.01},
+    'quota': 1200,                 # Queries allowed per quota window (over it the server answers 429)
+    'quota_window': 60,            # Seconds
+    'psi_payload_kb': 1500,        # Full Lighthouse response (without a fields mask)
+    'seed': 1,
+}
+
+# Default engine configurations: module constants to set and keyword arguments of the run function
+DEFAULT_CONFIGURATIONS = [
+    {'name': 'psi-async', 'script': 'psi', 'constants': {'ENGINE': 'async'}},
+    {'name': 'psi-threads', 'script': 'psi', 'constants': {'ENGINE': 'threads'}},
+    {'name': 'psi-async-full-payload', 'script': 'psi', 'constants': {'ENGINE': 'async', 'USE_FIELDS_MASK': False}},
+    {'name': 'crux-record', 'script': 'crux', 'constants': {}},
+    {'name': 'crux-device-split', 'script': 'crux', 'constants': {}, 'run': {'device_split': True}},
+    {'name': 'crux-history', 'script': 'crux', 'constants': {}, 'run': {'mode': 'history'}},
+    {'name': 'crux-record-static', 'script': 'crux', 'constants': {'ADAPTIVE_CONCURRENCY': False}},
+    # The key allows less than RATE_LIMIT_QUERIES (shared project, lowered quota)
+    {'name': 'crux-quota-drift', 'script': 'crux', 'constants': {'RATE_LIMIT_QUERIES': 1200}, 'scenario': {'quota': 100}},
+]
+
+# Function to draw one latency in seconds from a distribution setting
+def draw_latency(setting, rng):
+    distribution = setting.get('distribution', 'constant')
+    if distribution == 'constant':
+        return setting.get('value', 0)
+    if distribution == 'uniform':
+        return rng.uniform(setting.get('low', 0), setting.get('high', 1))
+    if distribution == 'exponential':
+        return rng.expovariate(1 / setting['mean'])
+    if distribution == 'lognormal':
+        return rng.lognormvariate(math.log(setting['median']), setting.get('sigma', 0.5))
+    raise ValueError(f"Unknown latency distribution: {distribution!r}")
+
+# Stand-in API server state: scenario, sliding-window quota and counters of what was served
+class MockApiState:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset(DEFAULT_SCENARIO)
+    
+    def reset(self, scenario):
+        with self.lock:
+            self.scenario = scenario
+            self.rng = random.Random(scenario.get('seed'))
+            self.quota_log = collections.deque()
+            self.counts = collections.Counter()
+            self.bytes_sent = 0
+            self.started = time.time()
+            self.filler = 'x' * (scenario['psi_payload_kb'] * 1024)
+    
+    def admit(self):
+        """Check the quota and draw the outcome of the next query: (error status or None, Retry-After or None)"""
+        with self.lock:
+            now = time.time()
+            window = self.scenario['quota_window']
+            while self.quota_log and self.quota_log[0] <= now - window:
+                self.quota_log.popleft()
+            if len(self.quota_log) >= self.scenario['quota']:
+                self.counts['429 quota'] += 1
+                return 429, math.ceil(self.quota_log[0] + window - now)
+            self.quota_log.append(now)
+            self.counts['quota used'] += 1
+            
+            draw = self.rng.random()
+            for status, rate in self.scenario['error_rates'].items():
+                if draw < rate:
+                    self.counts[f'{status} injected'] += 1
+                    return int(status), None
+                draw -= rate
+            self.counts['200'] += 1
+            return None, None
+    
+    def latency(self, api):
+        with self.lock:
+            return draw_latency(self.scenario[f'{api}_latency'], self.rng)
+    
+    def value(self, low, high):
+        with self.lock:
+            return self.rng.uniform(low, high)
+    
+    def stats(self):
+        with self.lock:
+            elapsed = time.time() - self.started
+            capacity = self.scenario['quota'] * elapsed / self.scenario['quota_window']
+            return {'counts': dict(self.counts), 'bytes_sent': self.bytes_sent, 'elapsed': elapsed,
+                    'quota_utilization': min(1.0, self.counts['quota used'] / capacity) if capacity else 0}
+
+mock_state = MockApiState()
+
+# Function to build a PSI response with the fields the report reads (plus filler for the full response)
+def psi_payload(url, masked):
+    audit = lambda value, score: {'numericValue': value, 'score': score}
+    field = lambda percentile, category: {'percentile': percentile, 'category': category}
+    lcp = mock_state.value(1500, 4500)
+    payload = {
+        'id': url,
+        'loadingExperience': {'metrics': {
+            'LARGEST_CONTENTFUL_PAINT_MS': field(int(lcp), 'FAST' if lcp <= 2500 else 'AVERAGE'),
+            'CUMULATIVE_LAYOUT_SHIFT_SCORE': field(5, 'FAST'),
+            'FIRST_INPUT_DELAY_MS': field(20, 'FAST'),
+        }},
+        'lighthouseResult': {
+            'finalUrl': url,
+            'categories': {'performance': {'score': round(mock_state.value(0.3, 1.0), 2)}},
+            'audits': {
+                'largest-contentful-paint': audit(lcp, 0.9 if lcp <= 2500 else 0.6),
+                'cumulative-layout-shift': audit(0.03, 0.95),
+                'first-contentful-paint': audit(lcp * 0.6, 0.9),
+                'total-blocking-time': audit(mock_state.value(50, 600), 0.8),
+                'interactive': audit(lcp * 1.4, 0.8),
+                'speed-index': audit(lcp * 1.1, 0.85),
+            },
+        },
+    }
+    if not masked:
+        # Screenshots, traces and the other audits make up most of a full response
+        payload['lighthouseResult']['fullPageScreenshot'] = {'screenshot': {'data': mock_state.filler}}
+    return payload
+
+# Function to build a CrUX record with histograms and p75 values of every metric
+def crux_payload(body):
+    def metric(p75, good, poor):
+        return {'histogram': [{'start': 0, 'end': good, 'density': 0.75}, {'start': good, 'end': poor, 'density': 0.17},
+                              {'start': poor, 'density': 0.08}], 'percentiles': {'p75': p75}}
+    key = {name: body[name] for name in ('url', 'origin', 'formFactor') if name in body}
+    metrics = {
+        'largest_contentful_paint': metric(int(mock_state.value(1500, 4500)), 2500, 4000),
+        'cumulative_layout_shift': metric(f"{mock_state.value(0, 0.3):.2f}", 0.1, 0.25),
+        'interaction_to_next_paint': metric(int(mock_state.value(80, 600)), 200, 500),
+        'first_contentful_paint': metric(int(mock_state.value(900, 3500)), 1800, 3000),
+        'experimental_time_to_first_byte': metric(int(mock_state.value(300, 2000)), 800, 1800),
+        'form_factors': {'fractions': {'phone': 0.62, 'desktop': 0.35, 'tablet': 0.03}},
+    }
+    period = {'firstDate': {'year': 2026, 'month': 1, 'day': 1}, 'lastDate': {'year': 2026, 'month': 1, 'day': 28}}
+    return {'record': {'key': key, 'metrics': metrics, 'collectionPeriod': period}}
+
+# Function to build a CrUX History record: weekly collection periods with p75 and histogram time series
+def crux_history_payload(body):
+    periods = body.get('collectionPeriodCount', 25)
+    def metric(low, high, good, poor, digits=0):
+        p75s = [round(mock_state.value(low, high), digits) for _ in range(periods)]
+        return {'histogramTimeseries': [{'start': 0, 'end': good, 'densities': [0.75] * periods},
+                                        {'start': good, 'end': poor, 'densities': [0.17] * periods},
+                                        {'start': poor, 'densities': [0.08] * periods}],
+                'percentilesTimeseries': {'p75s': [f"{p75:.2f}" for p75 in p75s] if digits else [int(p75) for p75 in p75s]}}
+    key = {name: body[name] for name in ('url', 'origin', 'formFactor') if name in body}
+    metrics = {
+        'largest_contentful_paint': metric(1500, 4500, 2500, 4000),
+        'cumulative_layout_shift': metric(0, 0.3, 0.1, 0.25, digits=2),
+        'interaction_to_next_paint': metric(80, 600, 200, 500),
+        'first_contentful_paint': metric(900, 3500, 1800, 3000),
+        'experimental_time_to_first_byte': metric(300, 2000, 800, 1800),
+    }
+    first = datetime.date(2026, 1, 1)
+    date = lambda day: {'year': day.year, 'month': day.month, 'day': day.day}
+    collection_periods = [{'firstDate': date(first + datetime.timedelta(weeks=week)),
+                           'lastDate': date(first + datetime.timedelta(weeks=week, days=27))} for week in range(periods)]
+    return {'record': {'key': key, 'metrics': metrics, 'collectionPeriods': collection_periods}}
+
+# Request handler of the stand-in server (keep-alive, like the real APIs)
+class MockApiHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    
+    def log_message(self, *args):
+        pass
+    
+    def send_json(self, status, payload, headers=()):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+        with mock_state.lock:
+            mock_state.bytes_sent += len(body)
+    
+    def answer(self, api, build):
+        status, retry_after = mock_state.admit()
+        if status == 429 and retry_after is not None:
+            return self.send_json(429, {'error': {'code': 429, 'status': 'RESOURCE_EXHAUSTED'}},
+                                  [('Retry-After', str(retry_after))])
+        time.sleep(mock_state.latency(api))
+        if status:
+            return self.send_json(status, {'error': {'code': status, 'message': 'injected error'}})
+        self.send_json(200, build())
+    
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        if parts.path == '/__stats':
+            return self.send_json(200, mock_state.stats())
+        query = parse_qs(parts.query)
+        if parts.path.endswith('/runPagespeed'):
+            return self.answer('psi', lambda: psi_payload(query['url'][0], 'fields' in query))
+        self.send_json(404, {'error': {'code': 404}})
+    
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        if self.path == '/__reset':
+            mock_state.reset({**DEFAULT_SCENARIO, **body})
+            return self.send_json(200, {})
+        if 'records:queryHistoryRecord' in self.path:
+            return self.answer('crux', lambda: crux_history_payload(body))
+        if 'records:queryRecord' in self.path:
+            return self.answer('crux', lambda: crux_payload(body))
+        self.send_json(404, {'error': {'code': 404}})
+
+# Function to run the stand-in server until the process is stopped (prints its port first)
+def serve():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), MockApiHandler)
+    server.daemon_threads = True
+    print(server.server_address[1], flush=True)
+    server.serve_forever()
+
+# Function to load one of the collector scripts as a module (the file names contain hyphens)
+def load_script(name):
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), SCRIPTS[name])
+    spec = importlib.util.spec_from_file_location(f"{name}_batch", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+# Function to run one configuration against the server and write its measurements as JSON
+# (runs in its own process, so the peak RSS belongs to this configuration only)
+def run_configuration(configuration, scenario, base_url, output_path):
+    module = load_script(configuration['script'])
+    latencies = []
+    
+    # Point the collector at the stand-in server, with the quota of the scenario and no state on disk
+    module.API_URL = f"{base_url}/pagespeedonline/v5/runPagespeed" if configuration['script'] == 'psi' else f"{base_url}/v1/records:queryRecord"
+    module.HISTORY_API_URL = f"{base_url}/v1/records:queryHistoryRecord"
+    module.RATE_LIMIT_QUERIES = scenario['quota']
+    module.RATE_LIMIT_WINDOW = scenario['quota_window']
+    module.JOURNAL_ENABLED = False
+    module.ARCHIVE_ENABLED = False
+    module.CACHE_ENABLED = False
+    for name, value in configuration.get('constants', {}).items():
+        setattr(module, name, value)
+    if 'MAX_REQUESTS_PER_HOST' not in configuration.get('constants', {}):
+        module.MAX_REQUESTS_PER_HOST = module.MAX_CONCURRENT_REQUESTS
+    module.http_transport = module.HttpTransport(module.MAX_CONCURRENT_REQUESTS, module.MAX_REQUESTS_PER_HOST,
+                                                 module.HTTP2_ENABLED)
+    
+    # Query latency: from the start of a query to its parsed response, including limiter waits and retries
+    def timed(function):
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                latencies.append(time.perf_counter() - start)
+        return wrapper
+    
+    def timed_async(function):
+        async def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return await function(*args, **kwargs)
+            finally:
+                latencies.append(time.perf_counter() - start)
+        return wrapper
+    
+    if configuration['script'] == 'psi':
+        module.get_psi_data = timed(module.get_psi_data)
+        module.async_get_psi_data = timed_async(module.async_get_psi_data)
+        run = module.run_psi_batch
+    else:
+        module.post_crux_query = timed(module.post_crux_query)
+        run = module.run_crux_batch
+    
+    urls = [f"https://bench.example/page/{i}" for i in range(scenario['urls'])]
+    with tempfile.TemporaryDirectory() as work_dir:
+        os.chdir(work_dir)
+        start = time.perf_counter()
+        df = run(urls=urls, resume=False, **configuration.get('run', {}))
+        elapsed = time.perf_counter() - start
+    
+    try:
+        import resource
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+    except ImportError:
+        peak_rss = None
+    
+    cut_points = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+    with open(output_path, 'w') as f:
+        json.dump({'urls': len(urls), 'rows': len(df), 'queries': len(latencies), 'elapsed': elapsed,
+                   'urls_per_sec': len(urls) / elapsed if elapsed else 0,
+                   'p50': cut_points[49] if cut_points else None, 'p95': cut_points[94] if cut_points else None,
+                   'p99': cut_points[98] if cut_points else None, 'peak_rss_mb': peak_rss}, f)
+
+# Function to send a control request to the stand-in server
+def control(base_url, path, payload=None):
+    data = json.dumps(payload).encode() if payload is not None else None
+    with urlopen(Request(f"{base_url}{path}", data=data, headers={'Content-Type': 'application/json'}), timeout=30) as response:
+        return json.load(response)
+
+# Function to benchmark every configuration and return one result dict per configuration
+def run_benchmark(configurations, scenario):
+    script = os.path.abspath(__file__)
+    server = subprocess.Popen([sys.executable, script, '--serve'], stdout=subprocess.PIPE, text=True)
+    base_url = f"http://127.0.0.1:{server.stdout.readline().strip()}"
+    results = []
+    try:
+        for configuration in configurations:
+            config_scenario = {**scenario, **configuration.get('scenario', {})}
+            control(base_url, '/__reset', config_scenario)
+            print(f"Running {configuration['name']} ({config_scenario['urls']} URLs)...", flush=True)
+            
+            with tempfile.NamedTemporaryFile(suffix='.json', delete=False) as f:
+                output_path = f.name
+            child = subprocess.run([sys.executable, script, '--run-configuration', json.dumps(configuration),
+                                    '--scenario', json.dumps(config_scenario), '--base-url', base_url,
+                                    '--output', output_path],
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True,
+                                   env={**os.environ, 'TQDM_DISABLE': '1'})
+            if child.returncode:
+                print(f"{configuration['name']} failed:\n{child.stderr[-3000:]}")
+                os.remove(output_path)
+                continue
+            with open(output_path) as f:
+                result = json.load(f)
+            os.remove(output_path)
+            
+            stats = control(base_url, '/__stats')
+            result.update({'name': configuration['name'], 'quota_utilization': stats['quota_utilization'],
+                           'server_counts': stats['counts'], 'mb_sent': stats['bytes_sent'] / 1e6})
+            results.append(result)
+    finally:
+        server.terminate()
+        server.wait()
+    return results
+
+# Function to print the results as a table
+def print_results(results):
+    print(f"\n{'configuration':<26}{'URLs/s':>8}{'p50 s':>8}{'p95 s':>8}{'p99 s':>8}{'quota':>8}"
+          f"{'429':>6}{'errors':>8}{'MB sent':>9}{'peak RSS MB':>13}")
+    for result in results:
+        counts = result['server_counts']
+        injected = sum(count for name, count in counts.items() if name.endswith('injected'))
+        print(f"{result['name']:<26}{result['urls_per_sec']:>8.2f}{result['p50']:>8.3f}{result['p95']:>8.3f}"
+              f"{result['p99']:>8.3f}{result['quota_utilization']*100:>7.1f}%{counts.get('429 quota', 0):>6}"
+              f"{injected:>8}{result['mb_sent']:>9.2f}{result['peak_rss_mb'] or 0:>13.1f}")
+
+# Function to compare the results with a baseline: throughput and p95 latency may not get worse
+# by more than the tolerance; returns the list of regressions
+def find_regressions(results, baseline, tolerance):
+    previous = {result['name']: result for result in baseline}
+    regressions = []
+    for result in results:
+        before = previous.get(result['name'])
+        if not before:
+            continue
+        if result['urls_per_sec'] < before['urls_per_sec'] * (1 - tolerance):
+            regressions.append(f"{result['name']}: {result['urls_per_sec']:.2f} URLs/s (was {before['urls_per_sec']:.2f})")
+        if result['p95'] > before['p95'] * (1 + tolerance):
+            regressions.append(f"{result['name']}: p95 {result['p95']:.3f} s (was {before['p95']:.3f} s)")
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the CrUX and PSI collectors against a local stand-in API.")
+    parser.add_argument('--config', help="JSON file with a 'scenario' dict and/or a 'configurations' list")
+    parser.add_argument('--only', help="Comma-separated configuration names to run")
+    parser.add_argument('--urls', type=int, help="URLs per configuration")
+    parser.add_argument('--output', help="Write the results as JSON")
+    parser.add_argument('--baseline', help="Results JSON of an earlier benchmark to compare with")
+    parser.add_argument('--tolerance', type=float, default=0.1, help="Allowed regression against the baseline (default 0.1)")
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--run-configuration', help=argparse.SUPPRESS)
+    parser.add_argument('--scenario', help=argparse.SUPPRESS)
+    parser.add_argument('--base-url', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    
+    # Internal modes: the stand-in server and the per-configuration worker
+    if args.serve:
+        return serve()
+    if args.run_configuration:
+        return run_configuration(json.loads(args.run_configuration), json.loads(args.scenario), args.base_url, args.output)
+    
+    scenario, configurations = dict(DEFAULT_SCENARIO), DEFAULT_CONFIGURATIONS
+    if args.config:
+        with open(args.config) as f:
+            config = json.load(f)
+        scenario.update(config.get('scenario', {}))
+        configurations = config.get('configurations', configurations)
+    if args.urls:
+        scenario['urls'] = args.urls
+    if args.only:
+        names = args.only.split(',')
+        configurations = [configuration for configuration in configurations if configuration['name'] in names]
+    
+    results = run_benchmark(configurations, scenario)
+    print_results(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = find_regressions(results, json.load(f), args.tolerance)
+        if regressions:
+            print("\nRegressions against the baseline:\n" + "\n".join(regressions))
+            raise SystemExit(1)
+        print("\nNo regressions against the baseline.")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,64 @@
+import argparse
+import ast
+import difflib
+import os
+
+# Consistency check of the code both collectors carry: each script stays a single file for Colab,
+# so the HTTP transport, rate limiter, journal, work queue, metrics and sitemap helpers are copied
+# between them. Every top-level class and function defined in both scripts must be identical,
+# except the ones listed below, e.g.
+#   python check_shared.py
+
+SCRIPTS = ['batch-crux-api.py', 'batch-psi-api.py']
+
+# Definitions that are meant to differ between the scripts (API-specific, or extended by PSI)
+DIVERGENT = {
+    'main': "CLI options of each API",
+    'ask_settings': "Colab prompts of each API",
+    'process_url': "one query vs one audit",
+    'UrlIndex': "PSI also follows redirects (finalUrl)",
+    'ConcurrencyController': "PSI adds async_slot() for the asyncio engine",
+    'ResponseArchive': "PSI parses with orjson when available",
+}
+
+# Function to read the top-level classes and functions of a script: {name: source}
+def read_definitions(path):
+    with open(path, newline='') as f:
+        source = f.read().replace('\r\n', '\n')
+    definitions = {}
+    for node in ast.parse(source, path).body:
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            definitions[node.name] = ast.get_source_segment(source, node)
+    return definitions
+
+# Function to compare the shared definitions of two scripts and return the diffs of those that differ
+def compare(first_path, second_path):
+    first, second = read_definitions(first_path), read_definitions(second_path)
+    diffs = []
+    for name in sorted(set(first) & set(second) - set(DIVERGENT)):
+        if first[name] != second[name]:
+            diffs.append('\n'.join(difflib.unified_diff(first[name].splitlines(), second[name].splitlines(),
+                                                        f"{first_path}:{name}", f"{second_path}:{name}", lineterm='')))
+    return diffs
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check that the code shared by the CrUX and PSI scripts is identical.")
+    parser.add_argument('--list', action='store_true', help="List the shared definitions")
+    args = parser.parse_args(argv)
+    
+    paths = [os.path.join(os.path.dirname(os.path.abspath(__file__)), name) for name in SCRIPTS]
+    if args.list:
+        first, second = (read_definitions(path) for path in paths)
+        print("\n".join(sorted(set(first) & set(second) - set(DIVERGENT))))
+        return
+    
+    diffs = compare(*paths)
+    if diffs:
+        print("\n\n".join(diffs))
+        print(f"\nShared definitions that differ: {len(diffs)} - apply the change to both scripts "
+              f"(or list a deliberate difference in DIVERGENT)")
+        raise SystemExit(1)
+    print("Shared definitions are identical.")
+
+if __name__ == '__main__':
+    main()